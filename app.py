@@ -1,17 +1,29 @@
 import logging
 import os
+import re
 from pathlib import Path
-from typing import Any
+from typing import Any, Iterator
 import gradio as gr
 
 import dotenv
+from page_insights.async_webpage_reader import AsyncWebpageReader
+from page_insights.batch_jobs import BatchJobManager
+from page_insights.concurrency import ConflictError
+from page_insights.json_log_formatter import JsonLogFormatter
 from page_insights.llm_adapter import LlmAdapter
-from page_insights.prompts_manager import PromptsManager
+from page_insights.metrics import metrics
+from page_insights.page_cache import PageCache
+from page_insights.prompts_manager import PromptsManager, prompt_version
 from page_insights.summarizer import Summarizer
 from page_insights.research_manager import ResearchManager
+from page_insights.research_refresher import ResearchRefresher
+from page_insights.response_cache import ResponseCache
+from page_insights.webpage_reader import WebpageReader
 
-logging.basicConfig(level=logging.INFO)
 dotenv.load_dotenv()
+# the research listing choices: sort order -> (sort_by, descending) and filter -> archived
+RESEARCH_SORT_ORDERS = {"Newest first": ("date", True), "Oldest first": ("date", False), "Name": ("name", False)}
+RESEARCH_FILTERS = {"Active": False, "Archived": True, "All": None}
 
 ##################################################################################
 # 
@@ -22,197 +34,431 @@ dotenv.load_dotenv()
 ##################################################################################
 
 
-with gr.Blocks(title="Page insights") as demo:
-
-    openai_key: str = os.getenv("OPENAI_API_KEY") # type: ignore
-    assets_dir: Path = Path(os.getenv("ASSETS_FOLDER_PATH")) # type: ignore
-
-    prompts_manager = PromptsManager(assets_dir)
-    llm_adapter = LlmAdapter(openai_key, resp_max_tokens=1024)
-    research_manager = ResearchManager(assets_dir)
-    summarizer = Summarizer(prompts_manager, llm_adapter)
-
-
-    def update_prompt(prompt_name: str, value: str) -> None:
-        gr.Info("Prompt updated")
-        prompts_manager.update_prompt(prompt_name, value)
-
-
-    def load_prompt(prompt_name: str) -> str:
-        return prompts_manager.get_prompt(prompt_name)
+def create_demo() -> gr.Blocks:
+    with gr.Blocks(title="Page insights") as demo:
+
+        openai_key: str = os.getenv("OPENAI_API_KEY") # type: ignore
+        assets_dir: Path = Path(os.getenv("ASSETS_FOLDER_PATH")) # type: ignore
+
+        prompts_manager = PromptsManager(assets_dir)
+        page_cache = PageCache(assets_dir)
+        response_cache_enabled = os.getenv("LLM_RESPONSE_CACHE_ENABLED", "false").lower() == "true"
+        response_cache = ResponseCache(assets_dir) if response_cache_enabled else None
+        llm_adapter = LlmAdapter(openai_key, resp_max_tokens=1024, webpage_reader=WebpageReader(page_cache),
+                                 response_cache=response_cache)
+        research_manager = ResearchManager(assets_dir)
+        summarizer = Summarizer(prompts_manager, llm_adapter, AsyncWebpageReader(page_cache),
+                                fingerprint_index=research_manager.fingerprint_index)
+        batch_job_manager = BatchJobManager(assets_dir, summarizer, research_manager)
+        research_refresher = ResearchRefresher(summarizer, research_manager)
+        research_page_size = int(os.getenv("RESEARCH_PAGE_SIZE", 25))
+
+
+        def update_prompt(prompt_name: str, value: str, loaded_version: str | None) -> str:
+            # the update is refused if someone else saved the prompt after it was loaded here
+            try:
+                version = prompts_manager.update_prompt(prompt_name, value, expected_version=loaded_version)
+            except (ValueError, ConflictError) as e:
+                raise gr.Error(str(e))
+            gr.Info("Prompt updated")
+            return version
+
+
+        def load_prompt(prompt_name: str) -> tuple[str, str]:
+            prompt_text = prompts_manager.get_prompt(prompt_name)
+            # the version of the text loaded, the prompt may have changed since
+            return prompt_text, prompt_version(prompt_text)
     
-    def save_new_prompt(prompt_name: str, prompt_text: str) -> tuple[dict[str, Any], dict[str, Any]]:
-        prompts_manager.add_prompt(prompt_name, prompt_text)
-        gr.Info("New prompt saved")
-        return gr.Dropdown.update(choices=prompts_manager.get_prompt_names(), value=prompt_name), \
-            gr.Dropdown.update(choices=prompts_manager.get_prompt_names())
+        def save_new_prompt(prompt_name: str, prompt_text: str) -> tuple[dict[str, Any], dict[str, Any], dict[str, Any], dict[str, Any], str]:
+            try:
+                version = prompts_manager.add_prompt(prompt_name, prompt_text)
+            except ValueError as e:
+                raise gr.Error(str(e))
+            gr.Info("New prompt saved")
+            return gr.Dropdown.update(choices=prompts_manager.get_prompt_names(), value=prompt_name), \
+                gr.Dropdown.update(choices=prompts_manager.get_prompt_names()), \
+                gr.Dropdown.update(choices=prompts_manager.get_prompt_names()), \
+                gr.Dropdown.update(choices=prompts_manager.get_prompt_names()), \
+                version
+
+        def refresh_prompt_names() -> tuple[dict[str, Any], dict[str, Any], dict[str, Any], dict[str, Any]]:
+            # prompts may have been added or deleted on disk since the page was built
+            prompt_names = prompts_manager.get_prompt_names()
+            return gr.Dropdown.update(choices=prompt_names), gr.Dropdown.update(choices=prompt_names), \
+                gr.Dropdown.update(choices=prompt_names), gr.Dropdown.update(choices=prompt_names)
     
 
-    def save_page_analysis(research_text: str, research_name: str, link: str) -> tuple[dict[str, Any],dict[str, Any],dict[str, Any],dict[str, Any],dict[str, Any]]:
-        if not research_name.strip():
-            raise gr.Error("Research name cannot be empty")
-        try:
-            research_manager.persist_research(research_text, research_name, [link])
-            gr.Info("Research saved.  You can view it on the View Research tab")
-        except Exception as e:
-            raise gr.Error(str(e))
-        # returns to blank out forms and update the research list on View Research tab
-        return gr.Dropdown.update(choices=research_manager.get_research_ids()), \
-            gr.Textbox.update(value=""), \
-            gr.TextArea.update(value=""), \
-            gr.Markdown.update(value=""), \
-            gr.Textbox.update(value="")
-
-
-    def research_preview(research_markdown: str) -> tuple[dict[str, Any]]:
-        # The gradio ML viewer required 2 newlines to rener a single newline
-        research_markdown = research_markdown.replace("\n", "\n\n")
-        return gr.TextArea.update(visible=False), gr.Markdown.update(visible=True, value=research_markdown) # type: ignore
-
-    def research_edit() -> tuple[dict[str, Any]]:
-        return gr.TextArea.update(visible=True), gr.Markdown.update(visible=False) # type: ignore
+        def save_page_analysis(research_text: str, research_name: str, link: str,
+                               analysis: dict[str, Any] | list[dict[str, Any]] | None) -> tuple[dict[str, Any],dict[str, Any],dict[str, Any],dict[str, Any]]:
+            if not research_name.strip():
+                raise gr.Error("Research name cannot be empty")
+            if isinstance(analysis, list) and all(prompt_analysis["link"] == link for prompt_analysis in analysis):
+                # an analysis with several prompts is saved as a research per prompt, linked to each other
+                sections = split_prompt_sections(research_text, [prompt_analysis["prompt_name"] for prompt_analysis in analysis])
+                if sections is None:
+                    raise gr.Error("Keep the '## <prompt name>' heading of every prompt to save the analyses")
+                analyses = [prompt_analysis if prompt_analysis["error"] else dict(prompt_analysis, summary=section)
+                            for prompt_analysis, section in zip(analysis, sections)]
+                try:
+                    research_manager.persist_linked_analyses(research_name, analyses)
+                    gr.Info(f"{len(analyses)} linked research saved.  You can view them on the View Research tab")
+                except Exception as e:
+                    raise gr.Error(str(e))
+            else:
+                # the analysis record makes the research refreshable, it is saved with the text as edited
+                analyses = [dict(analysis, summary=research_text)] \
+                    if isinstance(analysis, dict) and analysis["link"] == link else None
+                try:
+                    research_manager.persist_research(research_text, research_name, [link], analyses=analyses)
+                    gr.Info("Research saved.  You can view it on the View Research tab")
+                except Exception as e:
+                    raise gr.Error(str(e))
+            # returns to blank out forms, the research list on View Research tab is reloaded after
+            return gr.Textbox.update(value=""), \
+                gr.TextArea.update(value=""), \
+                gr.Markdown.update(value=""), \
+                gr.Textbox.update(value="")
+
+
+        def research_preview(research_markdown: str) -> tuple[dict[str, Any]]:
+            # The gradio ML viewer required 2 newlines to rener a single newline
+            research_markdown = research_markdown.replace("\n", "\n\n")
+            return gr.TextArea.update(visible=False), gr.Markdown.update(visible=True, value=research_markdown) # type: ignore
+
+        def research_edit() -> tuple[dict[str, Any]]:
+            return gr.TextArea.update(visible=True), gr.Markdown.update(visible=False) # type: ignore
+    
+        def get_research_details(research_id: str) -> tuple[dict[str, Any], dict[str, Any]]:
+            # archived research is only listed when asked for, so it can be viewed.  The content is
+            # rendered with 2 newlines per newline for the gradio ML viewer, cached per revision
+            research_metadata, research_markdown_txt = research_manager.get_rendered_research(research_id,
+                                                                                               include_archived=True)
+            return gr.JSON.update(value=research_metadata), gr.Markdown.update(value=research_markdown_txt)
+
+        def show_research_page(page: int, sort_order: str, show: str) -> tuple[dict[str, Any], int, dict[str, Any]]:
+            sort_by, descending = RESEARCH_SORT_ORDERS[sort_order]
+            listing = research_manager.list_research(max(1, page), research_page_size, sort_by, descending,
+                                                     RESEARCH_FILTERS[show])
+            if listing["page"] > listing["pages"]:
+                # past the end, e.g. after archiving the last research of the last page
+                listing = research_manager.list_research(listing["pages"], research_page_size, sort_by, descending,
+                                                         RESEARCH_FILTERS[show])
+            page_info = f"Page {listing['page']} of {listing['pages']}, {listing['total']} page insights"
+            return gr.Dropdown.update(choices=[record["id"] for record in listing["records"]]), listing["page"], \
+                gr.Markdown.update(value=page_info)
+
+        def show_first_research_page(sort_order: str, show: str) -> tuple[dict[str, Any], int, dict[str, Any]]:
+            return show_research_page(1, sort_order, show)
+
+        def show_previous_research_page(page: int, sort_order: str, show: str) -> tuple[dict[str, Any], int, dict[str, Any]]:
+            return show_research_page(page - 1, sort_order, show)
+
+        def show_next_research_page(page: int, sort_order: str, show: str) -> tuple[dict[str, Any], int, dict[str, Any]]:
+            return show_research_page(page + 1, sort_order, show)
     
-    def get_research_details(research_id: str) -> tuple[dict[str, Any], dict[str, Any]]:
-        research_metadata, research_text  = research_manager.get_research_details(research_id)
-        # The gradio ML viewer required 2 newlines to rener a single newline
-        research_markdown_txt = research_text.replace("\n", "\n\n")
-        return gr.JSON.update(value=research_metadata), gr.Markdown.update(value=research_markdown_txt)
     
+        def get_page_analysis(link: str, temprature: float, prompt_select: str, output_max_range: str) -> Iterator[tuple[str, str, dict[str, Any] | None]]:
+            # raise error if link or prompt or output_max_range is empty
+            if not link.strip() or not prompt_select.strip() or not output_max_range.strip():
+                raise gr.Error("Link, prompt, and/or output_max_range cannot be empty")
+            # stream the analysis into the output as it is generated, the debug output arrives with the last update
+            analysis = ""
+            try:
+                for delta, debug, analysis_record in summarizer.stream_summary_for_url(link, temprature, prompt_select, output_max_range):
+                    analysis += delta
+                    yield analysis, debug, analysis_record
+            except Exception as e:
+                raise gr.Error(str(e))
     
-    def get_page_analysis(link: str, temprature: float, prompt_select: str, output_max_range: str) -> tuple[str, str]:
-        # raise error if link or prompt or output_max_range is empty
-        if not link.strip() or not prompt_select.strip() or not output_max_range.strip():
-            raise gr.Error("Link, prompt, and/or output_max_range cannot be empty")
-        return summarizer.get_summary_for_url(link, temprature, prompt_select, output_max_range)
+        def get_page_analysis_with_prompts(link: str, temprature: float, prompt_names: list[str], output_max_range: str) -> tuple[str, str, list[dict[str, Any]]]:
+            if not link.strip() or not prompt_names or not output_max_range.strip():
+                raise gr.Error("Link, prompts, and/or output_max_range cannot be empty")
+            # the page is read once and the prompts are applied to it in parallel
+            try:
+                results = summarizer.analyze_link_with_prompts(link, temprature, prompt_names, output_max_range)
+            except Exception as e:
+                raise gr.Error(str(e))
+            analyses = [analysis for analysis, _ in results]
+            research_text = "\n\n".join(
+                f"## {analysis['prompt_name']}\n{analysis['summary'] or f'ERROR[{link}]: ' + analysis['error']}"
+                for analysis in analyses)
+            return research_text, "\n\n".join(debug for _, debug in results if debug), analyses
+
+        def split_prompt_sections(research_text: str, prompt_names: list[str]) -> list[str] | None:
+            # the (possibly edited) output of an analysis with several prompts, back into a text per prompt
+            headings = "|".join(re.escape(prompt_name) for prompt_name in prompt_names)
+            parts = re.split(rf"^## ({headings})[ \t]*$", research_text, flags=re.MULTILINE)
+            sections = dict(zip(parts[1::2], (part.strip() for part in parts[2::2])))
+            if len(parts) != 2 * len(prompt_names) + 1 or sections.keys() != set(prompt_names):
+                return None
+            return [sections[prompt_name] for prompt_name in prompt_names]
     
-    def archive_research(research_id: str) -> tuple[dict[str,Any], dict[str,Any], dict[str,Any]]:
-        research_manager.delete_research(research_id)
-        gr.Info(f"Research {research_id} archived")
-        return gr.Dropdown.update(choices=research_manager.get_research_ids(), value=None), \
-            gr.JSON.update(value=None), \
-            gr.Markdown.update(value="")
-
-
-    gr.Markdown("# Page insights; a research assistant")
-
-    ###############################################################
-    # Page analysis
-    with gr.Tab("Page analysis"):
-        gr.Markdown("""## Apply a prompt instruction to the content of the link supplied
-                1. Select a prompt (*prompts can be viewed/edited on the `[Manage Prompts]` tab*)
-                2. Select a [temperature](https://learnprompting.org/docs/basics/configuration_hyperparameters#temperature)
-                3. Input a wordcount range applied to each summary. This can be used in the prompt to control the length of the summary from the LLM
-                3. Supply a link to be analyzed
-                4. Click **Analyze**
+        def search_research(query: str, page: int, sort_order: str, show: str) -> tuple[dict[str, Any], dict[str, Any]]:
+            if not query.strip():
+                # back to the listing
+                return show_research_page(page, sort_order, show)[0], gr.Markdown.update(value="")
+            results = research_manager.search_research(query, archived=RESEARCH_FILTERS[show])
+            results_md = "\n".join(f"- **{result['id']}**: {result['snippet']}" for result in results)
+            return gr.Dropdown.update(choices=[result["id"] for result in results]), \
+                gr.Markdown.update(value=results_md or "No matching page insights")
+
+        def submit_batch_job(links_text: str, temprature: float, prompt_select: str, output_max_range: str,
+                             research_name: str) -> tuple[dict[str, Any], dict[str, Any]]:
+            links = [link.strip() for link in links_text.splitlines() if link.strip()]
+            if not links or not prompt_select or not output_max_range.strip() or not research_name.strip():
+                raise gr.Error("Links, prompt, output_max_range and name cannot be empty")
+            try:
+                job_id = batch_job_manager.submit(links, prompt_select, temprature, output_max_range, research_name)
+            except Exception as e:
+                raise gr.Error(str(e))
+            gr.Info(f"Batch job {job_id} submitted.  The result is saved to Page insights when it completes")
+            return gr.Dropdown.update(choices=batch_job_manager.get_job_ids(), value=job_id), \
+                gr.JSON.update(value=batch_job_manager.get_job_progress(job_id))
+
+        def get_batch_job_progress(job_id: str) -> dict[str, Any]:
+            return gr.JSON.update(value=batch_job_manager.get_job_progress(job_id) if job_id else None)
+
+        def refresh_research(research_id: str) -> tuple[dict[str, Any], dict[str, Any]]:
+            if not research_id:
+                raise gr.Error("Select a page insight to refresh")
+            try:
+                refresh = research_refresher.refresh(research_id)
+            except (ValueError, ConflictError) as e:
+                raise gr.Error(str(e))
+            gr.Info(f"{refresh['unchanged']} unchanged, {refresh['reanalyzed']} re-analyzed, {refresh['failed']} failed")
+            return get_research_details(research_id)
+
+        def archive_research(research_id: str) -> tuple[dict[str,Any], dict[str,Any], dict[str,Any]]:
+            research_manager.delete_research(research_id)
+            gr.Info(f"Research {research_id} archived")
+            # the research list is reloaded after
+            return gr.Dropdown.update(value=None), \
+                gr.JSON.update(value=None), \
+                gr.Markdown.update(value="")
+
+
+        gr.Markdown("# Page insights; a research assistant")
+
+        ###############################################################
+        # Page analysis
+        with gr.Tab("Page analysis"):
+            gr.Markdown("""## Apply a prompt instruction to the content of the link supplied
+                    1. Select a prompt (*prompts can be viewed/edited on the `[Manage Prompts]` tab*)
+                    2. Select a [temperature](https://learnprompting.org/docs/basics/configuration_hyperparameters#temperature)
+                    3. Input a wordcount range applied to each summary. This can be used in the prompt to control the length of the summary from the LLM
+                    3. Supply a link to be analyzed
+                    4. Click **Analyze**
                 
-                You will then be able to preview and edit (supports markdown) the generated research
+                    You will then be able to preview and edit (supports markdown) the generated research
                     
-                Finally, click Save to persist the insight document.
-                Saved insights documents can be found on the `[Page Insights]` tab""")
-        page_analyze_prompt_select = gr.Dropdown(
-            choices=prompts_manager.get_prompt_names(),
-            label="Prompt",
-            type="value",
-        )
-        page_analysis_link = gr.Textbox(label="URL", placeholder="https://example.com")
-        temp_input = gr.Slider(0.0, 2.0, label="LLM Temperature", step=0.1, value=0.0)
-        output_max_range = gr.Text(label="LLM output min,max range", value="150, 200", lines=1)
-        analysys_btn = gr.Button("Analyze")
-        page_analysis_output_md = gr.Textbox(label="Output", lines=10, show_copy_button=True)
-        page_analysis_output_rendered = gr.Markdown(label="Output", visible=False)
-        with gr.Row():
-            page_analysis_view_md_btn = gr.Button("View markdown")
-            page_analysis_view_rendered_btn = gr.Button("View rendered")
-        with gr.Accordion("Debug output", open=False):
-            txt_debug = gr.Textbox(label="Output", lines=10)
-        with gr.Row():
-            with gr.Column(scale=2):
-                page_analyze_name = gr.Textbox(label="Name", lines=1)
-            with gr.Column(scale=1):
-                page_analyze_save_btn = gr.Button("Save")
+                    Finally, click Save to persist the insight document.
+                    Saved insights documents can be found on the `[Page Insights]` tab""")
+            page_analyze_prompt_select = gr.Dropdown(
+                choices=prompts_manager.get_prompt_names(),
+                label="Prompt",
+                type="value",
+            )
+            page_analysis_link = gr.Textbox(label="URL", placeholder="https://example.com")
+            temp_input = gr.Slider(0.0, 2.0, label="LLM Temperature", step=0.1, value=0.0)
+            output_max_range = gr.Text(label="LLM output min,max range", value="150, 200", lines=1)
+            analysys_btn = gr.Button("Analyze")
+            with gr.Accordion("Apply several prompts", open=False):
+                gr.Markdown("""The page is read once and the selected prompts are applied to it in parallel.
+                            Each prompt's analysis is saved as its own page insight, linked to the others""")
+                page_analyze_prompts_select = gr.Dropdown(
+                    choices=prompts_manager.get_prompt_names(),
+                    label="Prompts",
+                    type="value",
+                    multiselect=True,
+                )
+                analysys_prompts_btn = gr.Button("Analyze with the selected prompts")
+            page_analysis_output_md = gr.Textbox(label="Output", lines=10, show_copy_button=True)
+            page_analysis_output_rendered = gr.Markdown(label="Output", visible=False)
+            with gr.Row():
+                page_analysis_view_md_btn = gr.Button("View markdown")
+                page_analysis_view_rendered_btn = gr.Button("View rendered")
+            with gr.Accordion("Debug output", open=False):
+                txt_debug = gr.Textbox(label="Output", lines=10)
+            # the analysis record of the last analysis (one per prompt with several prompts), saved with the
+            # research so it can be refreshed
+            page_analysis_state = gr.State()
+            with gr.Row():
+                with gr.Column(scale=2):
+                    page_analyze_name = gr.Textbox(label="Name", lines=1)
+                with gr.Column(scale=1):
+                    page_analyze_save_btn = gr.Button("Save")
         
-    ###############################################################
-    # View research tab
-
-    with gr.Tab("Page insights"):
-        gr.Markdown("""## View saved page insights   
-                    Select an insight and view its metadata and content
-                    """)
-        view_research_list = gr.Dropdown(
-            choices=research_manager.get_research_ids(),
-            label="Select page insight",
-            type="value",
-        )
-        view_research_details = gr.JSON(label="Page insight details")
-        gr.Markdown("View a the plain text markdown or rendered")
-        with gr.Row():
-                view_research_edit_btn = gr.Button("Markdown")
-                view_research_preview_btn = gr.Button("Rendered")
-        view_research_md = gr.TextArea(label="Markdown", lines=30, show_copy_button=True, interactive=False)
-        view_research_rendered = gr.Markdown(label="Rendered", visible=False)
-        gr.Markdown("Archive this research doc")
-        view_research_archive_btn = gr.Button("Archive")
-
-    ###############################################################
-    # Manage prompts
-    with gr.Tab("Manage prompts"):
-        gr.Markdown("""## Manage your prompts   
-                    You can have as many prompts as you want.  This tab allows you to edit and create new prompts.
-
-                    Available placeholders are `{{min_llm_resp_word_count}}` and `{{max_llm_resp_word_count}}`
-
-                    `{{web_page_content}}` is the content of the webpage you are summarizing, this is **Required**
-
-                    To create a new prompt, select and exiting prompt, then supplay a new name and click Save As New
-                    """)
-        prompt_select = gr.Dropdown(
-            choices=prompts_manager.get_prompt_names(),
-            label="Prompt",
-            type="value",
-        )
-        prompt_edit_input = gr.Textbox(label="Prompt", lines=20, show_copy_button=True)
-        update_prompt_button = gr.Button("Update")
-        with gr.Row():
-            with gr.Column():
-                prompt_name = gr.Textbox(label="New prompt name", lines=1)
-            with gr.Column():
-                save_new_prompt_button = gr.Button("Save as new")
+        ###############################################################
+        # View research tab
+
+        with gr.Tab("Page insights"):
+            gr.Markdown("""## View saved page insights   
+                        Select an insight and view its metadata and content
+                        """)
+            view_research_search = gr.Textbox(label="Search page insights", placeholder="Search names, links and content")
+            view_research_search_results = gr.Markdown()
+            with gr.Row():
+                view_research_sort = gr.Dropdown(choices=list(RESEARCH_SORT_ORDERS), value="Newest first", label="Sort by")
+                view_research_filter = gr.Radio(choices=list(RESEARCH_FILTERS), value="Active", label="Show")
+            # listed a page at a time, loaded when the page is opened
+            view_research_page = gr.State(1)
+            with gr.Row():
+                view_research_previous_btn = gr.Button("Previous page")
+                view_research_page_info = gr.Markdown()
+                view_research_next_btn = gr.Button("Next page")
+            view_research_list = gr.Dropdown(
+                choices=[],
+                label="Select page insight",
+                type="value",
+            )
+            view_research_details = gr.JSON(label="Page insight details")
+            gr.Markdown("View a the plain text markdown or rendered")
+            with gr.Row():
+                    view_research_edit_btn = gr.Button("Markdown")
+                    view_research_preview_btn = gr.Button("Rendered")
+            view_research_md = gr.TextArea(label="Markdown", lines=30, show_copy_button=True, interactive=False)
+            view_research_rendered = gr.Markdown(label="Rendered", visible=False)
+            gr.Markdown("Re-analyze the pages that changed since this research was saved")
+            view_research_refresh_btn = gr.Button("Refresh")
+            gr.Markdown("Archive this research doc")
+            view_research_archive_btn = gr.Button("Archive")
+
+        ###############################################################
+        # Batch analysis tab
+
+        with gr.Tab("Batch analysis"):
+            gr.Markdown("""## Apply a prompt to a list of links in the background
+                        The links are analyzed by background workers, so you can close the browser and check back later.
+                        When all links are done the combined analysis is saved to the `[Page insights]` tab
+                        """)
+            batch_prompt_select = gr.Dropdown(
+                choices=prompts_manager.get_prompt_names(),
+                label="Prompt",
+                type="value",
+            )
+            batch_links = gr.TextArea(label="URLs, one per line", lines=8)
+            batch_temp_input = gr.Slider(0.0, 2.0, label="LLM Temperature", step=0.1, value=0.0)
+            batch_output_max_range = gr.Text(label="LLM output min,max range", value="150, 200", lines=1)
+            batch_research_name = gr.Textbox(label="Name", lines=1)
+            batch_submit_btn = gr.Button("Submit")
+            with gr.Row():
+                with gr.Column(scale=2):
+                    batch_job_list = gr.Dropdown(
+                        choices=batch_job_manager.get_job_ids(),
+                        label="Batch job",
+                        type="value",
+                    )
+                with gr.Column(scale=1):
+                    batch_refresh_btn = gr.Button("Refresh progress")
+            batch_job_progress = gr.JSON(label="Batch job progress")
+
+        ###############################################################
+        # Manage prompts
+        with gr.Tab("Manage prompts"):
+            gr.Markdown("""## Manage your prompts   
+                        You can have as many prompts as you want.  This tab allows you to edit and create new prompts.
+
+                        Available placeholders are `{{min_llm_resp_word_count}}` and `{{max_llm_resp_word_count}}`
+
+                        `{{web_page_content}}` is the content of the webpage you are summarizing, this is **Required**
+
+                        To create a new prompt, select and exiting prompt, then supplay a new name and click Save As New
+                        """)
+            prompt_select = gr.Dropdown(
+                choices=prompts_manager.get_prompt_names(),
+                label="Prompt",
+                type="value",
+            )
+            prompt_edit_input = gr.Textbox(label="Prompt", lines=20, show_copy_button=True)
+            # the version of the prompt being edited, to detect edits saved by someone else meanwhile
+            prompt_version_state = gr.State()
+            update_prompt_button = gr.Button("Update")
+            with gr.Row():
+                with gr.Column():
+                    prompt_name = gr.Textbox(label="New prompt name", lines=1)
+                with gr.Column():
+                    save_new_prompt_button = gr.Button("Save as new")
 
 
             
 
-    ###############################################################
-    # Listeners
+        ###############################################################
+        # Listeners
 
-    analysys_btn.click(
-        get_page_analysis,
-        inputs=[page_analysis_link, temp_input, page_analyze_prompt_select, output_max_range],
-        outputs=[page_analysis_output_md, txt_debug],
-    )
+        analysys_btn.click(
+            get_page_analysis,
+            inputs=[page_analysis_link, temp_input, page_analyze_prompt_select, output_max_range],
+            outputs=[page_analysis_output_md, txt_debug, page_analysis_state],
+        )
+        analysys_prompts_btn.click(
+            get_page_analysis_with_prompts,
+            inputs=[page_analysis_link, temp_input, page_analyze_prompts_select, output_max_range],
+            outputs=[page_analysis_output_md, txt_debug, page_analysis_state],
+        )
     
-    # Promts management
-    save_new_prompt_button.click(save_new_prompt, inputs=[prompt_name, prompt_edit_input], 
-                                 outputs=[prompt_select, page_analyze_prompt_select])
-    update_prompt_button.click(update_prompt, inputs=[prompt_select, prompt_edit_input])
-    prompt_select.select(load_prompt, inputs=[prompt_select], outputs=[prompt_edit_input])
-
-    # Reseach Viewer
-    view_research_preview_btn.click(research_preview, inputs=[view_research_md], outputs=[view_research_md, view_research_rendered])
-    view_research_edit_btn.click(research_edit, inputs=None, outputs=[view_research_md, view_research_rendered])
-    view_research_list.select(get_research_details, inputs=[view_research_list], outputs=[view_research_details, view_research_md])
-    view_research_archive_btn.click(archive_research, inputs=[view_research_list], outputs=[view_research_list,view_research_details,view_research_rendered])
-
-    # Page Analysis
-    page_analysis_view_rendered_btn.click(research_preview, inputs=[page_analysis_output_md], outputs=[page_analysis_output_md, page_analysis_output_rendered])
-    page_analysis_view_md_btn.click(research_edit, inputs=None, outputs=[page_analysis_output_md, page_analysis_output_rendered])
-    page_analyze_save_btn.click(save_page_analysis, 
-                                inputs=[page_analysis_output_md, page_analyze_name, page_analysis_link],
-                                outputs=[view_research_list, page_analysis_link, page_analysis_output_md, page_analysis_output_rendered, page_analyze_name])
-
-
-    # handle browser refreshes
-    # demo.load()
-
-
-demo.queue().launch(debug=True) # YOu need queue in order for UI info/warn messages to show
-
+        # Promts management
+        save_new_prompt_button.click(save_new_prompt, inputs=[prompt_name, prompt_edit_input], 
+                                     outputs=[prompt_select, page_analyze_prompt_select, page_analyze_prompts_select, batch_prompt_select,
+                                              prompt_version_state])
+        update_prompt_button.click(update_prompt, inputs=[prompt_select, prompt_edit_input, prompt_version_state],
+                                   outputs=[prompt_version_state])
+        prompt_select.select(load_prompt, inputs=[prompt_select], outputs=[prompt_edit_input, prompt_version_state])
+
+        # Reseach Viewer
+        view_research_preview_btn.click(research_preview, inputs=[view_research_md], outputs=[view_research_md, view_research_rendered])
+        view_research_edit_btn.click(research_edit, inputs=None, outputs=[view_research_md, view_research_rendered])
+        view_research_search.submit(search_research,
+                                    inputs=[view_research_search, view_research_page, view_research_sort, view_research_filter],
+                                    outputs=[view_research_list, view_research_search_results])
+        research_page_inputs = [view_research_page, view_research_sort, view_research_filter]
+        research_page_outputs = [view_research_list, view_research_page, view_research_page_info]
+        view_research_previous_btn.click(show_previous_research_page, inputs=research_page_inputs, outputs=research_page_outputs)
+        view_research_next_btn.click(show_next_research_page, inputs=research_page_inputs, outputs=research_page_outputs)
+        view_research_sort.change(show_first_research_page, inputs=[view_research_sort, view_research_filter],
+                                  outputs=research_page_outputs)
+        view_research_filter.change(show_first_research_page, inputs=[view_research_sort, view_research_filter],
+                                    outputs=research_page_outputs) \
+            .then(search_research, inputs=[view_research_search, view_research_page, view_research_sort, view_research_filter],
+                  outputs=[view_research_list, view_research_search_results])
+        view_research_list.select(get_research_details, inputs=[view_research_list], outputs=[view_research_details, view_research_md])
+        view_research_refresh_btn.click(refresh_research, inputs=[view_research_list], outputs=[view_research_details, view_research_md])
+        view_research_archive_btn.click(archive_research, inputs=[view_research_list], outputs=[view_research_list,view_research_details,view_research_rendered]) \
+            .then(show_research_page, inputs=research_page_inputs, outputs=research_page_outputs)
+
+        # Batch analysis
+        batch_submit_btn.click(submit_batch_job,
+                               inputs=[batch_links, batch_temp_input, batch_prompt_select, batch_output_max_range, batch_research_name],
+                               outputs=[batch_job_list, batch_job_progress])
+        batch_job_list.select(get_batch_job_progress, inputs=[batch_job_list], outputs=[batch_job_progress]) \
+            .then(show_research_page, inputs=research_page_inputs, outputs=research_page_outputs)
+        batch_refresh_btn.click(get_batch_job_progress, inputs=[batch_job_list], outputs=[batch_job_progress]) \
+            .then(show_research_page, inputs=research_page_inputs, outputs=research_page_outputs)
+
+        # Page Analysis
+        page_analysis_view_rendered_btn.click(research_preview, inputs=[page_analysis_output_md], outputs=[page_analysis_output_md, page_analysis_output_rendered])
+        page_analysis_view_md_btn.click(research_edit, inputs=None, outputs=[page_analysis_output_md, page_analysis_output_rendered])
+        page_analyze_save_btn.click(save_page_analysis, 
+                                    inputs=[page_analysis_output_md, page_analyze_name, page_analysis_link, page_analysis_state],
+                                    outputs=[page_analysis_link, page_analysis_output_md, page_analysis_output_rendered, page_analyze_name]) \
+            .then(show_research_page, inputs=research_page_inputs, outputs=research_page_outputs)
+
+
+        # handle browser refreshes
+        demo.load(refresh_prompt_names, inputs=None,
+                  outputs=[prompt_select, page_analyze_prompt_select, page_analyze_prompts_select, batch_prompt_select])
+        demo.load(show_research_page, inputs=research_page_inputs, outputs=research_page_outputs)
+    return demo
+
+
+# The text extraction processes of the AsyncWebpageReader start from a fresh interpreter that
+# re-imports this module as __mp_main__, they must not set up or launch the app
+if __name__ != "__mp_main__":
+    log_handler = logging.StreamHandler()
+    if os.getenv("LOG_FORMAT", "text").lower() == "json":
+        log_handler.setFormatter(JsonLogFormatter())
+    logging.basicConfig(level=logging.INFO, handlers=[log_handler])
+    metrics_port = int(os.getenv("METRICS_PORT", 0))
+    if metrics_port:
+        metrics.start_http_server(metrics_port, os.getenv("METRICS_HOST", "127.0.0.1"))
+    demo = create_demo()
+    demo.queue().launch(debug=True) # YOu need queue in order for UI info/warn messages to show
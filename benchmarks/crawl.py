@@ -0,0 +1,202 @@
+"""
+Crawls a generated docs site, served locally, and analyzes its pages with the local fake OpenAI
+API, reporting pages/min for the crawl (discovery) and for the analyses separately.
+
+The site has a docs index, sections and pages linking to each other, a robots.txt disallowing
+/private/ and a sitemap.xml.  The pages also link to what a crawl must not follow: another site,
+a disallowed page, a page outside the path filter, a PDF and a rel="nofollow" link.  The checks:
+only the docs pages are read, each once, requests are at least the politeness delay apart, the
+page, depth and frontier limits hold, a sitemap seeds the crawl in priority order, and the
+analyses start while the crawl is still going.
+
+    python -m benchmarks.crawl
+    python -m benchmarks.crawl --sections 8 --pages-per-section 20 --delay 0.01
+
+The exit code is 1 when a check failed.
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from benchmarks.fake_openai import FakeOpenAIServer
+from benchmarks.fixture_server import ARTICLE_PATTERN, FIXTURES_DIR, FixtureServer, fixture_names
+
+PROMPT_NAME = "crawl"
+PROMPT_TEXT = """Summarize the page in {{min_llm_resp_word_count}} to {{max_llm_resp_word_count}} words.
+---Web page content---
+{{web_page_content}}
+"""
+# linked from every page, none of them may be read by a crawl of /docs/*
+OFF_LIMITS_LINKS = ['<a href="https://elsewhere.example/docs/">Elsewhere</a>',
+                    '<a href="/private/notes.html">Notes</a>',
+                    '<a href="/blog/post.html">Blog</a>',
+                    '<a href="/docs/manual.pdf">Manual</a>',
+                    '<a href="/docs/drafts.html" rel="nofollow">Drafts</a>']
+OFF_LIMITS_PATHS = ("/private/notes.html", "/blog/post.html", "/docs/manual.pdf", "/docs/drafts.html")
+
+
+def fixture_sentences() -> list[str]:
+    text = " ".join(re.sub(r"<[^>]+>", " ", ARTICLE_PATTERN.search(FIXTURES_DIR.joinpath(name).read_text()).group(1))
+                    for name in fixture_names())
+    return [sentence.strip() + "." for sentence in " ".join(text.split()).split(". ") if len(sentence.split()) > 4]
+
+
+def make_page(title: str, links: list[str], sentences: list[str]) -> bytes:
+    # sentences picked per page, so no two pages have near duplicate text
+    paragraphs = random.Random(title).sample(sentences, min(16, len(sentences)))
+    body = "".join(f"<p>{' '.join(paragraphs[index:index + 4])}</p>" for index in range(0, len(paragraphs), 4))
+    return (f"<!DOCTYPE html><html><head><title>{title}</title></head><body><nav>{' '.join(links)}</nav>"
+            f"<main><article><h1>{title}</h1>{body}</article></main><footer>{' '.join(OFF_LIMITS_LINKS)}</footer>"
+            "</body></html>").encode("utf-8")
+
+
+def make_site(sections: int, pages_per_section: int) -> tuple[dict[str, bytes], dict[str, int]]:
+    """the site's pages by path, and the depth of each docs page from /docs/"""
+    sentences = fixture_sentences()
+    site, depths = {}, {"/docs/": 0}
+    section_paths = [f"/docs/section-{section}/" for section in range(sections)]
+    site["/docs/"] = make_page("Docs", [f'<a href="{path}">Section</a>' for path in section_paths], sentences)
+    for section, section_path in enumerate(section_paths):
+        page_names = [f"page-{page}.html" for page in range(pages_per_section)]
+        site[section_path] = make_page(f"Section {section}", ['<a href="../">Docs</a>'] +
+                                       [f'<a href="{name}">{name}</a>' for name in page_names], sentences)
+        depths[section_path] = 1
+        for page, name in enumerate(page_names):
+            links = ['<a href="/docs/">Docs</a>', '<a href="./">Section</a>', f'<a href="{name}#top">Top</a>',
+                     f'<a href="{name}?utm_source=nav">Share</a>']
+            if page + 1 < pages_per_section:
+                links.append(f'<a href="{page_names[page + 1]}">Next</a>')
+            site[section_path + name] = make_page(f"Section {section} page {page}", links, sentences)
+            depths[section_path + name] = 2
+    for path in OFF_LIMITS_PATHS:
+        site[path] = make_page(path, [], sentences)
+    site["/"] = make_page("Home", ['<a href="/docs/">Docs</a>', '<a href="/blog/post.html">Blog</a>',
+                                   '<a href="/private/notes.html">Notes</a>'], sentences)
+    site["/robots.txt"] = b"User-agent: *\nDisallow: /private/\n"
+    entries = "".join(f"<url><loc>{{base}}{path}</loc><priority>{1.0 - depth * 0.2:.1f}</priority></url>"
+                      for path, depth in depths.items())
+    site["/sitemap.xml"] = ('<?xml version="1.0" encoding="UTF-8"?>'
+                            f'<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">{entries}</urlset>'
+                            ).encode("utf-8")
+    return site, depths
+
+
+def requested_paths(fixture_server: FixtureServer, since: int) -> list[str]:
+    return [path for _, path in fixture_server.requests[since:]]
+
+
+def check_politeness(fixture_server: FixtureServer, since: int, delay: float) -> list[str]:
+    times = [request_time for request_time, _ in fixture_server.requests[since:]]
+    # the server logs a request once it arrives, allow for the scheduling of its handler thread
+    gaps = [later - earlier for earlier, later in zip(times, times[1:]) if later - earlier < delay * 0.8]
+    return [f"{len(gaps)} requests less than the {delay}s delay apart, the closest {min(gaps):.3f}s"] if gaps else []
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sections", type=int, default=4)
+    parser.add_argument("--pages-per-section", type=int, default=10)
+    parser.add_argument("--delay", type=float, default=0.02, help="politeness delay between requests, seconds")
+    parser.add_argument("--concurrency", type=int, default=4, help="pages analyzed in parallel")
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="seconds before a fake llm response starts")
+    args = parser.parse_args()
+
+    fake_openai = FakeOpenAIServer(latency=args.llm_latency, token_latency=0.001).start()
+    fixture_server = FixtureServer(latency=0.005).start()
+    base_url = fixture_server.url("")[:-1]
+    site, depths = make_site(args.sections, args.pages_per_section)
+    site["/sitemap.xml"] = site["/sitemap.xml"].replace(b"{base}", base_url.encode("utf-8"))
+    fixture_server.pages.update(site)
+    # the openai client reads its api base when it is imported
+    os.environ["OPENAI_API_BASE"] = fake_openai.api_base
+    os.environ.setdefault("OPENAI_LLM", "gpt-3.5-turbo")
+    os.environ["LLM_API_REQUESTS_PER_MINUTE"] = str(10 ** 6)
+    os.environ["LLM_API_TOKENS_PER_MINUTE"] = str(10 ** 9)
+
+    from page_insights.pipeline import AnalysisPipeline
+    from page_insights.site_crawler import SiteCrawler
+    from page_insights.webpage_reader import WebpageReader
+
+    failures: list[str] = []
+    docs_paths = set(depths)
+
+    # the whole docs site, analyzed while it is crawled
+    pipeline = AnalysisPipeline(Path(tempfile.mkdtemp(prefix="page-insights-crawl-")), "sk-crawl", args.concurrency)
+    pipeline.prompts_manager.add_prompt(PROMPT_NAME, PROMPT_TEXT, persist=False)
+    crawler = SiteCrawler(pipeline.llm_adapter.webpage_reader, max_pages=len(docs_paths) + 10, max_depth=5,
+                          include_paths=["/docs/*"], delay_seconds=args.delay)
+    since = len(fixture_server.requests)
+    start = time.perf_counter()
+    first_analysis_seconds = None
+    analyses = []
+    for analysis in pipeline.crawl_and_analyze(f"{base_url}/docs/", PROMPT_NAME, 0, "50, 80", crawler):
+        first_analysis_seconds = first_analysis_seconds or time.perf_counter() - start
+        analyses.append(analysis)
+    analysis_seconds = time.perf_counter() - start
+    report = crawler.report()
+    paths = requested_paths(fixture_server, since)
+    page_paths = [path for path in paths if path != "/robots.txt"]
+    if set(page_paths) != docs_paths or len(page_paths) != len(docs_paths):
+        failures.append(f"docs crawl read {len(page_paths)} pages, expected the {len(docs_paths)} docs pages once: "
+                        f"missing {sorted(docs_paths - set(page_paths))[:5]}, extra {sorted(set(page_paths) - docs_paths)[:5]}")
+    failures.extend(f"docs crawl requested {path}" for path in OFF_LIMITS_PATHS if path in paths)
+    failures.extend(check_politeness(fixture_server, since, args.delay))
+    if len(analyses) != len(docs_paths) or any(analysis["error"] for analysis in analyses):
+        failures.append(f"{len(analyses)} analyses for {len(docs_paths)} pages, "
+                        f"{sum(1 for analysis in analyses if analysis['error'])} failed")
+    if first_analysis_seconds is None or first_analysis_seconds >= report["seconds"]:
+        failures.append(f"the first analysis finished after the crawl ({first_analysis_seconds}s, "
+                        f"crawl {report['seconds']:.2f}s), pages were not streamed into the analysis")
+
+    # the limits, crawling only
+    reader = WebpageReader()
+    limited = list(SiteCrawler(reader, max_pages=1 + args.sections, max_depth=5, include_paths=["/docs/*"],
+                               delay_seconds=0).crawl(f"{base_url}/docs/"))
+    expected = {f"{base_url}{path}" for path, depth in depths.items() if depth <= 1}
+    if {webpage.link for webpage in limited} != expected:
+        failures.append(f"max pages {1 + args.sections}: read {sorted(webpage.link for webpage in limited)}, "
+                        "expected the docs index and sections, the shallowest pages first")
+    shallow = list(SiteCrawler(reader, max_pages=1000, max_depth=1, include_paths=["/docs/*"],
+                               delay_seconds=0).crawl(f"{base_url}/docs/"))
+    if {webpage.link for webpage in shallow} != expected:
+        failures.append(f"max depth 1: read {len(shallow)} pages, expected the docs index and sections")
+    small_frontier = SiteCrawler(reader, max_pages=1000, max_depth=5, delay_seconds=0)
+    small_frontier.CRAWL_MAX_FRONTIER = 3
+    list(small_frontier.crawl(f"{base_url}/docs/"))
+    if not small_frontier.stats["links_dropped"]:
+        failures.append("a frontier of 3 links dropped none")
+    from_sitemap = list(SiteCrawler(reader, max_pages=1 + args.sections, max_depth=0, delay_seconds=0).crawl(
+        f"{base_url}/sitemap.xml"))
+    if {webpage.link for webpage in from_sitemap} != expected:
+        failures.append(f"sitemap seed: read {sorted(webpage.link for webpage in from_sitemap)}, "
+                        "expected the highest priority pages first")
+    everything = list(SiteCrawler(reader, max_pages=1000, max_depth=5, delay_seconds=0).crawl(f"{base_url}/"))
+    read_paths = {webpage.link[len(base_url):] for webpage in everything}
+    if "/private/notes.html" in read_paths or "/blog/post.html" not in read_paths:
+        failures.append(f"robots.txt: /private/ read or /blog/ not read from /: {sorted(read_paths)[:8]}")
+    if any("elsewhere" in webpage.link for webpage in everything) or "/docs/drafts.html" in read_paths:
+        failures.append("followed a link to another site or a nofollow link")
+    fake_openai.stop()
+    fixture_server.stop()
+
+    print(f"{len(docs_paths)} docs pages, {args.delay}s politeness delay, {args.concurrency} analyses in parallel")
+    print(f"discovery: {report['pages_read']} pages in {report['seconds']:.2f}s, "
+          f"{report['pages_per_minute']:.1f} pages/min, {report['links_found']} links found, "
+          f"{report['links_skipped']} skipped")
+    print(f"analysis:  {len(analyses)} pages in {analysis_seconds:.2f}s, "
+          f"{len(analyses) / analysis_seconds * 60:.1f} pages/min, first done after {first_analysis_seconds or 0:.2f}s, "
+          f"{fake_openai.stats['requests']} llm requests")
+    for failure in failures[:20]:
+        print(f"FAILED {failure}")
+    if failures:
+        sys.exit(1)
+    print("OK, the crawl kept to the site, its limits and the politeness delay")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+"""
+A local stand-in for the OpenAI chat completions API, for running the pipeline offline.
+
+Serves `POST /v1/chat/completions` with and without `stream`, with a configurable response
+latency (a fixed part plus a per completion token part) and optional requests/tokens per minute
+limits answered with 429s and the retry-after / x-ratelimit-* headers the real API sends.
+Point the openai client at it with `OPENAI_API_BASE=http://127.0.0.1:<port>/v1`.  With
+`echo_prompt` the completion is the request's system message, for checking what was sent.
+
+    python -m benchmarks.fake_openai --port 8089 --latency 0.2 --rpm 60
+"""
+import argparse
+import json
+import math
+import threading
+import time
+import uuid
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+COMPLETION_WORDS = ("the page describes how the system processes requests and stores results while "
+                    "keeping latency low under load with caching batching and careful resource limits").split()
+
+
+class FakeOpenAIServer(object):
+
+    def __init__(self, port: int = 0, latency: float = 0.2, token_latency: float = 0.001,
+                 completion_words: int = 150, requests_per_minute: int = 0, tokens_per_minute: int = 0,
+                 echo_prompt: bool = False):
+        self.latency = latency
+        self.token_latency = token_latency
+        self.completion_words = completion_words
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.echo_prompt = echo_prompt
+        self.stats = {"requests": 0, "streamed": 0, "rate_limited": 0}
+        self._lock = threading.Lock()
+        # (time, tokens) of the requests accepted in the last minute
+        self._accepted: deque[tuple[float, int]] = deque()
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), self._handler_class())
+        self._server.daemon_threads = True
+
+    @property
+    def api_base(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_port}/v1"
+
+    def start(self) -> "FakeOpenAIServer":
+        threading.Thread(target=self._server.serve_forever, name="fake-openai", daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _admit(self, tokens: int) -> float:
+        """0 if the request is within the rate limits, otherwise the seconds until it would be"""
+        with self._lock:
+            now = time.monotonic()
+            while self._accepted and now - self._accepted[0][0] >= 60:
+                self._accepted.popleft()
+            over_requests = self.requests_per_minute and len(self._accepted) >= self.requests_per_minute
+            over_tokens = self.tokens_per_minute and \
+                sum(accepted_tokens for _, accepted_tokens in self._accepted) + tokens > self.tokens_per_minute
+            if (over_requests or over_tokens) and self._accepted:
+                self.stats["rate_limited"] += 1
+                return 60 - (now - self._accepted[0][0])
+            self._accepted.append((now, tokens))
+            self.stats["requests"] += 1
+            return 0.0
+
+    def _handler_class(self) -> type[BaseHTTPRequestHandler]:
+        server = self
+
+        class ChatCompletionsHandler(BaseHTTPRequestHandler):
+
+            def do_POST(self):
+                if self.path.rstrip("/") != "/v1/chat/completions":
+                    self._send_json(404, {"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}})
+                    return
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                prompt_tokens = sum(_count_tokens(message["content"]) for message in request["messages"])
+                if server.echo_prompt:
+                    content = request["messages"][0]["content"]
+                else:
+                    words = COMPLETION_WORDS * math.ceil(server.completion_words / len(COMPLETION_WORDS))
+                    content = " ".join(words[:server.completion_words])
+                    # ~4 characters per token, like the app's own estimate
+                    content = content[:request.get("max_tokens", 1024) * 4]
+                completion_tokens = _count_tokens(content)
+
+                retry_after = server._admit(prompt_tokens + completion_tokens)
+                if retry_after:
+                    self._send_json(429, {"error": {"message": "Rate limit reached for requests", "type": "requests",
+                                                    "code": "rate_limit_exceeded"}},
+                                    {"retry-after": f"{math.ceil(retry_after)}",
+                                     "x-ratelimit-remaining-requests": "0",
+                                     "x-ratelimit-reset-requests": f"{retry_after:.3f}s"})
+                    return
+
+                completion_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+                created = int(time.time())
+                model = request["model"]
+                time.sleep(server.latency)
+                if request.get("stream"):
+                    with server._lock:
+                        server.stats["streamed"] += 1
+                    self._stream(completion_id, created, model, content)
+                    return
+                time.sleep(server.token_latency * completion_tokens)
+                self._send_json(200, {
+                    "id": completion_id, "object": "chat.completion", "created": created, "model": model,
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": content},
+                                 "finish_reason": "stop"}],
+                    "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                              "total_tokens": prompt_tokens + completion_tokens},
+                })
+
+            def _stream(self, completion_id: str, created: int, model: str, content: str) -> None:
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.end_headers()
+                deltas = [{"role": "assistant"}] + [{"content": word + " "} for word in content.split(" ")]
+                for index, delta in enumerate(deltas):
+                    if index > 1:
+                        time.sleep(server.token_latency)
+                    self._send_event({"id": completion_id, "object": "chat.completion.chunk", "created": created,
+                                      "model": model, "choices": [{"index": 0, "delta": delta, "finish_reason": None}]})
+                self._send_event({"id": completion_id, "object": "chat.completion.chunk", "created": created,
+                                  "model": model, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+                self.wfile.write(b"data: [DONE]\n\n")
+
+            def _send_event(self, chunk: dict) -> None:
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+
+            def _send_json(self, status: int, body: dict, headers: dict[str, str] | None = None) -> None:
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return ChatCompletionsHandler
+
+
+def _count_tokens(text: str) -> int:
+    return math.ceil(len(text) / 4)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds before a response starts")
+    parser.add_argument("--token-latency", type=float, default=0.001, help="seconds per completion token")
+    parser.add_argument("--completion-words", type=int, default=150)
+    parser.add_argument("--rpm", type=int, default=0, help="requests per minute limit, 0 = unlimited")
+    parser.add_argument("--tpm", type=int, default=0, help="tokens per minute limit, 0 = unlimited")
+    args = parser.parse_args()
+    fake_server = FakeOpenAIServer(args.port, args.latency, args.token_latency, args.completion_words, args.rpm, args.tpm)
+    print(f"Fake OpenAI API on {fake_server.api_base}")
+    fake_server._server.serve_forever()
@@ -0,0 +1,85 @@
+"""
+Serves the recorded HTML pages in benchmarks/fixtures from a local HTTP server.
+
+Any query string is ignored, so `/blog_post.html?n=1` and `/blog_post.html?n=2` are distinct
+links with the same page.  `/large.html` is a long page assembled from the article bodies of
+all the fixtures, for exercising the map-reduce path for pages beyond the context window.
+Pages can be added to `pages`, e.g. a whole site with its sitemap.xml and robots.txt, and every
+request is logged in `requests` with the time it arrived.
+"""
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import urlsplit
+
+FIXTURES_DIR = Path(__file__).parent.joinpath("fixtures")
+ARTICLE_PATTERN = re.compile(r"<article[^>]*>(.*?)</article>", re.DOTALL)
+CONTENT_TYPES = {".xml": "application/xml", ".txt": "text/plain", ".pdf": "application/pdf"}
+
+
+def fixture_names() -> list[str]:
+    return sorted(path.name for path in FIXTURES_DIR.glob("*.html"))
+
+
+def make_large_page(size_kb: int) -> bytes:
+    articles = [ARTICLE_PATTERN.search(FIXTURES_DIR.joinpath(name).read_text()).group(1)  # type: ignore
+                for name in fixture_names()]
+    sections = []
+    size = 0
+    while size < size_kb * 1024:
+        article = articles[len(sections) % len(articles)]
+        section = f"<section><h2>Part {len(sections) + 1}</h2>{article}</section>"
+        sections.append(section)
+        size += len(section)
+    return ("<!DOCTYPE html><html><head><title>The complete reference</title></head><body><main><article>"
+            f"<h1>The complete reference</h1>{''.join(sections)}</article></main></body></html>").encode("utf-8")
+
+
+class FixtureServer(object):
+
+    def __init__(self, port: int = 0, latency: float = 0.05, large_page_kb: int = 500):
+        self.latency = latency
+        self.pages = {f"/{name}": FIXTURES_DIR.joinpath(name).read_bytes() for name in fixture_names()}
+        self.pages["/large.html"] = make_large_page(large_page_kb)
+        # (time.monotonic(), path) of every request
+        self.requests: list[tuple[float, str]] = []
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), self._handler_class())
+        self._server.daemon_threads = True
+
+    def url(self, page_name: str) -> str:
+        return f"http://127.0.0.1:{self._server.server_port}/{page_name}"
+
+    def start(self) -> "FixtureServer":
+        threading.Thread(target=self._server.serve_forever, name="fixture-server", daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _handler_class(self) -> type[BaseHTTPRequestHandler]:
+        server = self
+
+        class FixtureHandler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                path = urlsplit(self.path).path
+                server.requests.append((time.monotonic(), path))
+                body = server.pages.get(path)
+                time.sleep(server.latency)
+                if body is None:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                content_type = CONTENT_TYPES.get(Path(path).suffix, "text/html")
+                self.send_header("Content-Type", f"{content_type}; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return FixtureHandler
@@ -0,0 +1,89 @@
+"""
+Peak memory of reading pages of increasing size.
+
+Every page size is read by the real WebpageReader in its own process, served by the local
+FixtureServer running in this process, so the measurements only include the reader's memory.
+The reported growth is the peak RSS while reading the page minus the peak RSS after a warm up
+read of a small page (imports, parser initialization).
+
+    python -m benchmarks.memory                                 # default page sizes
+    python -m benchmarks.memory --page-kb 500 --page-kb 20000   # chosen page sizes
+    python -m benchmarks.memory --max-download-mb 2             # with a lower download cap
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+from typing import Any
+
+from benchmarks.fixture_server import FixtureServer, fixture_names, make_large_page
+
+DEFAULT_PAGE_KB = (100, 1000, 5000, 20000)
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    rss_unit = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / rss_unit
+
+
+def read_page(url: str, warm_up_url: str) -> dict[str, Any]:
+    """reads the page in this process, only call it in a fresh process"""
+    from page_insights.webpage_reader import WebpageReader
+
+    reader = WebpageReader()
+    reader.read(warm_up_url)
+    baseline_rss_mb = peak_rss_mb()
+    webpage = reader.read(url)
+    return {
+        "baseline_rss_mb": baseline_rss_mb,
+        "peak_rss_mb": peak_rss_mb(),
+        "text_chars": webpage.content_chars if webpage else 0,
+        "truncated": webpage.truncated if webpage else False,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--page-kb", type=int, action="append", help="page size to read, default: "
+                                                                     f"{', '.join(map(str, DEFAULT_PAGE_KB))}")
+    parser.add_argument("--max-download-mb", type=float, help="PAGE_MAX_DOWNLOAD_MB for the reader")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    parser.add_argument("--read-page", nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.read_page:
+        print(json.dumps(read_page(*args.read_page)))
+        return
+
+    fixture_server = FixtureServer(latency=0).start()
+    page_sizes = args.page_kb or DEFAULT_PAGE_KB
+    for size_kb in page_sizes:
+        fixture_server.pages[f"/page-{size_kb}kb.html"] = make_large_page(size_kb)
+    env = dict(os.environ)
+    if args.max_download_mb is not None:
+        env["PAGE_MAX_DOWNLOAD_MB"] = str(args.max_download_mb)
+
+    results = {}
+    for size_kb in page_sizes:
+        completed = subprocess.run(
+            [sys.executable, "-m", "benchmarks.memory", "--read-page",
+             fixture_server.url(f"page-{size_kb}kb.html"), fixture_server.url(fixture_names()[0])],
+            stdout=subprocess.PIPE, text=True, check=True, env=env)
+        results[size_kb] = json.loads(completed.stdout.strip().splitlines()[-1])
+    fixture_server.stop()
+
+    if args.json:
+        print(json.dumps(results, indent=4))
+        return
+    print(f"{'page KB':>8} {'text chars':>11} {'truncated':>9} {'peak MB':>8} {'growth MB':>9} {'growth/page':>11}")
+    for size_kb, result in results.items():
+        growth_mb = result["peak_rss_mb"] - result["baseline_rss_mb"]
+        print(f"{size_kb:>8} {result['text_chars']:>11} {str(result['truncated']):>9} {result['peak_rss_mb']:>8.1f} "
+              f"{growth_mb:>9.1f} {growth_mb * 1024 / size_kb:>10.1f}x")
+
+
+if __name__ == "__main__":
+    main()
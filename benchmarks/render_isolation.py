@@ -0,0 +1,126 @@
+"""
+Checks that analyses running at the same time never see each other's prompt values.
+
+Many simulated users start at once, each analyzing its own pages with its own word count range,
+through the real Summarizer / LlmAdapter.  The local fake OpenAI API echoes back the prompt it
+received, so every summary is the prompt rendered for that page: it must hold the user's own
+page content and word count range and nothing of any other user's.  Afterwards the shared
+PromptsManager.PROMPT_PLACEHOLDERS must be unchanged.
+
+    python -m benchmarks.render_isolation
+    python -m benchmarks.render_isolation --users 64 --links 3
+
+The exit code is 1 when a check failed.
+"""
+import argparse
+import os
+import re
+import sys
+import tempfile
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from benchmarks.fake_openai import FakeOpenAIServer
+from benchmarks.fixture_server import FIXTURES_DIR, FixtureServer, fixture_names
+
+PROMPT_NAME = "isolation"
+PROMPT_TEXT = """Summarize the page in {{min_llm_resp_word_count}} to {{max_llm_resp_word_count}} words.
+---Web page content---
+{{web_page_content}}
+"""
+MARKER_PATTERN = re.compile(r"isolation-marker-(\d+)-(\d+)")
+SUMMARY_START_PATTERN = re.compile(r"^(?=Summarize the page in )", re.MULTILINE)
+
+
+def make_page(html: str, user: int, link: int) -> bytes:
+    marker = f"isolation-marker-{user}-{link}"
+    paragraph = f"<p>This page belongs to {marker} and to no other request, as its analysis must show.</p>"
+    return html.replace("</h1>", f"</h1>{paragraph}", 1).encode("utf-8")
+
+
+def check_summary(summary: str, user: int, link: int, word_range: tuple[int, int]) -> list[str]:
+    failures = []
+    markers = set(MARKER_PATTERN.findall(summary))
+    if markers != {(str(user), str(link))}:
+        failures.append(f"user {user} link {link}: page markers {sorted(markers)} in its prompt")
+    if f"in {word_range[0]} to {word_range[1]} words" not in summary:
+        failures.append(f"user {user} link {link}: the word count range {word_range} is missing from its prompt")
+    return failures
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=32, help="analyses started at the same time")
+    parser.add_argument("--links", type=int, default=2, help="links per user, analyzed in parallel")
+    args = parser.parse_args()
+
+    fake_openai = FakeOpenAIServer(latency=0.05, token_latency=0, echo_prompt=True).start()
+    fixture_server = FixtureServer(latency=0.02).start()
+    # the openai client reads its api base when it is imported
+    os.environ["OPENAI_API_BASE"] = fake_openai.api_base
+    os.environ.setdefault("OPENAI_LLM", "gpt-3.5-turbo")
+    os.environ["LLM_API_REQUESTS_PER_MINUTE"] = str(10 ** 6)
+    os.environ["LLM_API_TOKENS_PER_MINUTE"] = str(10 ** 9)
+
+    from page_insights.llm_adapter import LlmAdapter
+    from page_insights.prompts_manager import PromptsManager
+    from page_insights.summarizer import Summarizer
+    from page_insights.webpage_reader import WebpageReader
+
+    placeholders = dict(PromptsManager.PROMPT_PLACEHOLDERS)
+    prompts_manager = PromptsManager(Path(tempfile.mkdtemp(prefix="page-insights-isolation-")))
+    prompts_manager.add_prompt(PROMPT_NAME, PROMPT_TEXT, persist=False)
+    summarizer = Summarizer(prompts_manager, LlmAdapter("sk-isolation", webpage_reader=WebpageReader()))
+
+    fixtures = [FIXTURES_DIR.joinpath(name).read_text() for name in fixture_names()]
+    for user in range(args.users):
+        for link in range(args.links):
+            fixture_server.pages[f"/user-{user}-{link}.html"] = make_page(fixtures[(user + link) % len(fixtures)],
+                                                                          user, link)
+
+    start = threading.Barrier(args.users)
+    failures: list[str] = []
+
+    def run_user(user: int) -> list[str]:
+        word_range = (10 + user, 1000 + user)
+        links = [fixture_server.url(f"user-{user}-{link}.html") for link in range(args.links)]
+        start.wait()
+        # half of the users run a batch (links analyzed in parallel), the others one link at a time
+        if user % 2:
+            joined = summarizer.get_all_summaries(links, 0, PROMPT_NAME, f"{word_range[0]}, {word_range[1]}")[0]
+            # each echoed summary starts with the first line of the prompt
+            summaries = [summary for summary in SUMMARY_START_PATTERN.split(joined) if summary.strip()]
+        else:
+            summaries = [summarizer.analyze_link(link, 0, PROMPT_NAME, f"{word_range[0]}, {word_range[1]}")[0]["summary"]
+                         for link in links]
+        if len(summaries) != len(links):
+            return [f"user {user}: {len(summaries)} summaries for {len(links)} links"]
+        return [failure for link, summary in enumerate(summaries)
+                for failure in check_summary(summary, user, link, word_range)]
+
+    with ThreadPoolExecutor(max_workers=args.users) as executor:
+        futures = [executor.submit(run_user, user) for user in range(args.users)]
+        for future in futures:
+            try:
+                failures.extend(future.result())
+            except Exception:
+                failures.append(traceback.format_exc())
+
+    if dict(PromptsManager.PROMPT_PLACEHOLDERS) != placeholders:
+        failures.append(f"PromptsManager.PROMPT_PLACEHOLDERS changed: {dict(PromptsManager.PROMPT_PLACEHOLDERS)}")
+    fake_openai.stop()
+    fixture_server.stop()
+
+    print(f"{args.users} users x {args.links} links analyzed at the same time, "
+          f"{fake_openai.stats['requests']} llm requests")
+    for failure in failures[:20]:
+        print(f"FAILED {failure}")
+    if failures:
+        sys.exit(1)
+    print("OK, every prompt held only its own page and word count range")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+"""
+Offline benchmarks for the analysis pipeline.
+
+Every scenario runs the real WebpageReader / LlmAdapter / Summarizer code against the recorded
+pages in benchmarks/fixtures, served locally, and a local fake of the OpenAI API, so results
+only depend on the code and the machine.  Each scenario runs in its own process so peak memory
+and the metrics are measured per scenario.
+
+    python -m benchmarks.run                          # run, report and compare with the baseline
+    python -m benchmarks.run --scenario batch         # run one scenario
+    python -m benchmarks.run --save-baseline          # store the median of 5 runs as the new baseline
+
+The exit code is 1 when a result regressed beyond the tolerance compared with the baseline.  The
+CPU-bound stages (text extraction, prompt rendering) vary most with the load of the machine, they
+have their own, wider, tolerance.
+"""
+import argparse
+import json
+import logging
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any
+
+from benchmarks.fake_openai import FakeOpenAIServer
+from benchmarks.fixture_server import FixtureServer, fixture_names
+
+BASELINE_FILE_PATH = Path(__file__).parent.joinpath("baseline.json")
+SCENARIOS = ("single_link", "batch", "large_page", "fan_out", "dedup")
+REPORTED_STAGES = ("fetch", "extract", "render", "llm", "analysis")
+CPU_BOUND_STAGES = ("extract", "render")
+# the analyses of dedup are mostly duplicates waiting on another link, their median depends on
+# the scheduling of the threads, its throughput is compared instead
+UNCOMPARED_STAGES = {"dedup": ("analysis",)}
+# runs of every scenario a saved baseline is the median of
+BASELINE_RUNS = 5
+# the options passed on to the scenario processes
+SCENARIO_OPTIONS = ("single_links", "batch_links", "large_page_links", "large_page_kb", "fan_out_links",
+                    "fan_out_prompts", "dedup_links", "llm_latency", "llm_token_latency", "page_latency")
+PROMPT_NAME = "benchmark"
+PROMPT_TEXT = """You are a researcher summarizing a web page in {{min_llm_resp_word_count}} to {{max_llm_resp_word_count}} words.
+Use markdown bullet points for the main ideas.
+
+---Web page content---
+{{web_page_content}}
+"""
+# ignore latency changes smaller than this, they are noise at these scales
+MIN_LATENCY_REGRESSION_SECONDS = 0.01
+
+
+def run_scenario(name: str, args: argparse.Namespace) -> dict[str, Any]:
+    """runs the scenario in this process, only call it in a fresh process"""
+    fake_openai = FakeOpenAIServer(latency=args.llm_latency, token_latency=args.llm_token_latency).start()
+    fixture_server = FixtureServer(latency=args.page_latency, large_page_kb=args.large_page_kb).start()
+    # the openai client reads its api base when it is imported
+    os.environ["OPENAI_API_BASE"] = fake_openai.api_base
+    os.environ.setdefault("OPENAI_LLM", "gpt-3.5-turbo")
+    os.environ["LLM_API_REQUESTS_PER_MINUTE"] = str(10 ** 6)
+    os.environ["LLM_API_TOKENS_PER_MINUTE"] = str(10 ** 9)
+    # the `?n=` links of the other scenarios are copies of the same few pages, analyze each of them
+    os.environ["DEDUP_ENABLED"] = "true" if name == "dedup" else "false"
+
+    from page_insights.async_webpage_reader import AsyncWebpageReader
+    from page_insights.llm_adapter import LlmAdapter
+    from page_insights.metrics import metrics
+    from page_insights.prompts_manager import PromptsManager
+    from page_insights.summarizer import Summarizer
+    from page_insights.webpage_reader import WebpageReader
+
+    prompts_manager = PromptsManager(Path(tempfile.mkdtemp(prefix="page-insights-benchmark-")))
+    prompts_manager.add_prompt(PROMPT_NAME, PROMPT_TEXT, persist=False)
+    llm_adapter = LlmAdapter("sk-benchmark", webpage_reader=WebpageReader())
+    async_webpage_reader = AsyncWebpageReader() if name in ("batch", "dedup") else None
+    summarizer = Summarizer(prompts_manager, llm_adapter, async_webpage_reader)
+    pages = fixture_names()
+
+    start = time.perf_counter()
+    if name == "single_link":
+        links = [fixture_server.url(f"{pages[n % len(pages)]}?n={n}") for n in range(args.single_links)]
+        summaries = [summarizer.get_summary_for_url(link, 0, PROMPT_NAME, "150, 200")[0] for link in links]
+    elif name == "batch":
+        links = [fixture_server.url(f"{pages[n % len(pages)]}?n={n}") for n in range(args.batch_links)]
+        summaries = summarizer.get_all_summaries(links, 0, PROMPT_NAME, "150, 200")[0].split("\n\n")
+    elif name == "large_page":
+        links = [fixture_server.url(f"large.html?n={n}") for n in range(args.large_page_links)]
+        summaries = [summarizer.get_summary_for_url(link, 0, PROMPT_NAME, "150, 200")[0] for link in links]
+    elif name == "fan_out":
+        # every page read once and analyzed with several prompts in parallel
+        prompt_names = [f"{PROMPT_NAME}-{index}" for index in range(args.fan_out_prompts)]
+        for index, prompt_name in enumerate(prompt_names):
+            prompts_manager.add_prompt(prompt_name, f"Perspective {index}.\n{PROMPT_TEXT}", persist=False)
+        links = [fixture_server.url(f"{pages[n % len(pages)]}?n={n}") for n in range(args.fan_out_links)]
+        summaries = [analysis["summary"] or f"ERROR[{link}]" for link in links
+                     for analysis, _ in summarizer.analyze_link_with_prompts(link, 0, prompt_names, "150, 200")]
+    elif name == "dedup":
+        # a batch of the pages, their tracking parameter and AMP variants and lightly edited mirrors
+        for page in pages:
+            fixture_server.pages[f"/amp/{page}"] = fixture_server.pages[f"/{page}"]
+            fixture_server.pages[f"/mirror/{page}"] = fixture_server.pages[f"/{page}"].replace(
+                b"</p>", b" Republished with permission.</p>", 1)
+        variants = ["{page}?n={n}", "{page}?n={n}&utm_source=newsletter&utm_medium=email", "amp/{page}?n={n}",
+                    "mirror/{page}?n={n}"]
+        links = [fixture_server.url(variants[n % len(variants)].format(page=pages[n // len(variants) % len(pages)],
+                                                                      n=n // (len(variants) * len(pages))))
+                 for n in range(args.dedup_links)]
+        summaries = summarizer.get_all_summaries(links, 0, PROMPT_NAME, "150, 200")[0].split("\n\n")
+    else:
+        raise ValueError(f"Unknown scenario: {name}")
+    seconds = time.perf_counter() - start
+
+    if async_webpage_reader:
+        async_webpage_reader.close()
+    snapshot = metrics.snapshot()
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    rss_unit = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return {
+        "links": len(links),
+        "errors": sum(1 for summary in summaries if summary.startswith("ERROR[")),
+        "seconds": seconds,
+        "links_per_minute": len(links) / seconds * 60,
+        "llm_requests": fake_openai.stats["requests"],
+        "llm_tokens": snapshot["page_insights_llm_tokens_total"],
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / rss_unit,
+        # the largest of the text extraction processes
+        "peak_child_rss_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / rss_unit,
+        "stages": snapshot["page_insights_stage_seconds"],
+    }
+
+
+def run_scenario_process(name: str, argv: list[str]) -> dict[str, Any]:
+    completed = subprocess.run([sys.executable, "-m", "benchmarks.run", "--run-scenario", name] + argv,
+                               stdout=subprocess.PIPE, text=True, check=True)
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def median_results(runs: list[Any]) -> Any:
+    """the results of several runs of a scenario, with every number the median of the runs"""
+    first = runs[0]
+    if isinstance(first, dict):
+        return {key: median_results([run[key] for run in runs]) for key in first if all(key in run for run in runs)}
+    if isinstance(first, (int, float)):
+        return statistics.median(runs)
+    return first
+
+
+def compare(results: dict[str, Any], baseline: dict[str, Any], tolerance: float,
+            cpu_tolerance: float) -> list[str]:
+    """returns a description of every result that regressed compared with the baseline"""
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        if result["links_per_minute"] < base["links_per_minute"] * (1 - tolerance):
+            regressions.append(f"{name}: throughput {result['links_per_minute']:.1f} links/min, "
+                               f"baseline {base['links_per_minute']:.1f}")
+        if result["peak_rss_mb"] > base["peak_rss_mb"] * (1 + tolerance):
+            regressions.append(f"{name}: peak memory {result['peak_rss_mb']:.1f} MB, baseline {base['peak_rss_mb']:.1f}")
+        for stage, latency in result["stages"].items():
+            base_latency = base["stages"].get(stage)
+            if not base_latency or stage in UNCOMPARED_STAGES.get(name, ()):
+                continue
+            # medians, the tails of a few dozen samples are too noisy to compare between runs
+            stage_tolerance = cpu_tolerance if stage in CPU_BOUND_STAGES else tolerance
+            if latency["p50"] > base_latency["p50"] * (1 + stage_tolerance) and \
+                    latency["p50"] - base_latency["p50"] > MIN_LATENCY_REGRESSION_SECONDS:
+                regressions.append(f"{name}: {stage} p50 {latency['p50'] * 1000:.1f} ms, "
+                                   f"baseline {base_latency['p50'] * 1000:.1f}")
+    return regressions
+
+
+def print_report(results: dict[str, Any]) -> None:
+    print(f"{'scenario':<12} {'links':>5} {'errors':>6} {'seconds':>8} {'links/min':>10} {'llm reqs':>8} "
+          f"{'peak MB':>8} {'child MB':>8}")
+    for name, result in results.items():
+        print(f"{name:<12} {result['links']:>5} {result['errors']:>6} {result['seconds']:>8.2f} "
+              f"{result['links_per_minute']:>10.1f} {result['llm_requests']:>8} {result['peak_rss_mb']:>8.1f} "
+              f"{result['peak_child_rss_mb']:>8.1f}")
+    print()
+    print(f"{'scenario':<12} {'stage':<10} {'count':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for name, result in results.items():
+        for stage in REPORTED_STAGES:
+            latency = result["stages"].get(stage)
+            if latency:
+                print(f"{name:<12} {stage:<10} {latency['count']:>6} {latency['p50'] * 1000:>9.2f} "
+                      f"{latency['p95'] * 1000:>9.2f} {latency['p99'] * 1000:>9.2f}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", choices=SCENARIOS, action="append", help="scenario to run, default all")
+    parser.add_argument("--baseline", type=Path, default=BASELINE_FILE_PATH)
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="relative change flagged as a regression")
+    parser.add_argument("--cpu-tolerance", type=float, default=1.0,
+                        help="relative change of the CPU-bound stages' latency flagged as a regression")
+    parser.add_argument("--runs", type=int, help="runs of every scenario, the results are their medians, default "
+                                                 f"1, or {BASELINE_RUNS} with --save-baseline")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    parser.add_argument("--single-links", type=int, default=10)
+    parser.add_argument("--batch-links", type=int, default=30)
+    parser.add_argument("--large-page-links", type=int, default=2)
+    parser.add_argument("--large-page-kb", type=int, default=500)
+    parser.add_argument("--fan-out-links", type=int, default=5)
+    parser.add_argument("--fan-out-prompts", type=int, default=4, help="prompts applied to each page of fan_out")
+    parser.add_argument("--dedup-links", type=int, default=30, help="links of dedup, a quarter of them unique")
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="seconds before a fake llm response starts")
+    parser.add_argument("--llm-token-latency", type=float, default=0.001, help="seconds per fake completion token")
+    parser.add_argument("--page-latency", type=float, default=0.05, help="seconds before a fixture page is served")
+    parser.add_argument("--run-scenario", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_scenario:
+        logging.basicConfig(level=logging.WARNING)
+        print(json.dumps(run_scenario(args.run_scenario, args)))
+        return
+
+    scenario_argv = [f"--{option.replace('_', '-')}={getattr(args, option)}" for option in SCENARIO_OPTIONS]
+    runs = args.runs or (BASELINE_RUNS if args.save_baseline else 1)
+    results = {name: median_results([run_scenario_process(name, scenario_argv) for _ in range(runs)])
+               for name in args.scenario or SCENARIOS}
+    if args.json:
+        print(json.dumps(results, indent=4))
+    else:
+        print_report(results)
+
+    if args.save_baseline:
+        baseline = json.loads(args.baseline.read_text()) if args.baseline.exists() else {}
+        baseline.update(results)
+        args.baseline.write_text(json.dumps(baseline, indent=4) + "\n")
+        print(f"\nSaved baseline: {args.baseline}")
+        return
+    if not args.baseline.exists():
+        print(f"\nNo baseline at {args.baseline}, run with --save-baseline to create one")
+        return
+    regressions = compare(results, json.loads(args.baseline.read_text()), args.tolerance, args.cpu_tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if regressions:
+        sys.exit(1)
+    print(f"\nNo regressions compared with {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+"""
+Stress test of the ResearchManager and PromptsManager concurrency model.
+
+Several processes, each running many threads, share one assets folder.  Every thread mixes:
+- saving and archiving research
+- reading: listing pages, viewing documents and searching
+- read-modify-write updates with version checks: appending a line to one shared prompt and an
+  analysis to one shared research, retried on ConflictError
+
+Afterwards the assets folder is checked from a fresh process: every saved research must be
+there with its file and search entry, archived when it was archived, and no appended prompt line
+or analysis may be lost.
+
+    python -m benchmarks.stress_concurrency                       # sqlite research store
+    python -m benchmarks.stress_concurrency --backend json        # the JSON digest store
+    python -m benchmarks.stress_concurrency --processes 8 --threads 16 --operations 100
+
+The exit code is 1 when a check failed or an operation raised.
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from collections import Counter
+from pathlib import Path
+from typing import Any
+
+SHARED_PROMPT_NAME = "shared"
+SHARED_PROMPT_TEXT = "Summarize in {{min_llm_resp_word_count}} to {{max_llm_resp_word_count}} words.\n{{web_page_content}}"
+SHARED_RESEARCH_NAME = "shared"
+OPERATIONS = ("persist", "archive", "list", "view", "search", "append_prompt", "append_analysis")
+# reads are the most common operations, as in the app
+OPERATION_WEIGHTS = (2, 1, 4, 4, 2, 1, 1)
+
+
+def run_worker(process_index: int, args: argparse.Namespace) -> dict[str, Any]:
+    from page_insights.concurrency import ConflictError
+    from page_insights.prompts_manager import PromptsManager, prompt_version
+    from page_insights.research_manager import ResearchManager
+
+    assets_dir = Path(args.assets_dir)
+    research_manager = ResearchManager(assets_dir)
+    prompts_manager = PromptsManager(assets_dir)
+    shared_research_id = args.shared_research_id
+    lock = threading.Lock()
+    result: dict[str, Any] = {"created": [], "archived": [], "prompt_lines": [], "analysis_links": [],
+                              "conflicts": Counter(), "operations": Counter(), "errors": []}
+
+    def append_prompt_line(line: str) -> None:
+        while True:
+            text = prompts_manager.get_prompt(SHARED_PROMPT_NAME)
+            version = prompt_version(text)
+            try:
+                prompts_manager.update_prompt(SHARED_PROMPT_NAME, f"{text}\n{line}", expected_version=version)
+                return
+            except ConflictError:
+                with lock:
+                    result["conflicts"]["prompt"] += 1
+
+    def append_analysis(link: str) -> None:
+        while True:
+            research_metadata, _ = research_manager.get_research_details(shared_research_id)
+            analyses = research_metadata["analyses"] + [{"link": link, "summary": f"Summary of {link}", "error": None}]
+            try:
+                research_manager.update_research_analyses(shared_research_id, analyses,
+                                                          expected_version=research_metadata["version"])
+                return
+            except ConflictError:
+                with lock:
+                    result["conflicts"]["research"] += 1
+
+    def run_thread(thread_index: int) -> None:
+        rand = random.Random(f"{process_index}-{thread_index}")
+        created: list[str] = []
+        for operation_index in range(args.operations):
+            operation = rand.choices(OPERATIONS, OPERATION_WEIGHTS)[0]
+            tag = f"w{process_index}-{thread_index}-{operation_index}"
+            try:
+                if operation == "persist":
+                    research_id = research_manager.persist_research(f"Research {tag}\nabout stress", tag,
+                                                                    [f"https://example.com/{tag}"])
+                    created.append(research_id)
+                    with lock:
+                        result["created"].append(research_id)
+                elif operation == "archive" and created:
+                    research_id = created.pop(rand.randrange(len(created)))
+                    research_manager.delete_research(research_id)
+                    with lock:
+                        result["archived"].append(research_id)
+                elif operation == "list":
+                    research_manager.list_research(rand.randint(1, 3), 10, rand.choice(("date", "name")))
+                elif operation == "view":
+                    research_manager.get_rendered_research(rand.choice(created) if created else shared_research_id)
+                elif operation == "search":
+                    research_manager.search_research("stress")
+                elif operation == "append_prompt":
+                    append_prompt_line(tag)
+                    with lock:
+                        result["prompt_lines"].append(tag)
+                elif operation == "append_analysis":
+                    append_analysis(tag)
+                    with lock:
+                        result["analysis_links"].append(tag)
+                with lock:
+                    result["operations"][operation] += 1
+            except Exception:
+                with lock:
+                    result["errors"].append(traceback.format_exc())
+
+    threads = [threading.Thread(target=run_thread, args=(index,)) for index in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return result
+
+
+def check(assets_dir: Path, shared_research_id: str, results: list[dict[str, Any]]) -> list[str]:
+    """returns a description of every inconsistency found in the assets folder"""
+    from page_insights.prompts_manager import PromptsManager
+    from page_insights.research_manager import ResearchManager
+
+    research_manager = ResearchManager(assets_dir)
+    prompts_manager = PromptsManager(assets_dir)
+    failures = []
+    created = {research_id for result in results for research_id in result["created"]}
+    archived = {research_id for result in results for research_id in result["archived"]}
+    records = {record["id"]: record for record in research_manager.store.list_records(include_archived=True)}
+    if len(records) != len(created) + 1:
+        failures.append(f"{len(records)} research records, expected {len(created) + 1}")
+    for research_id in created:
+        record = records.get(research_id)
+        if not record:
+            failures.append(f"research {research_id} lost")
+            continue
+        if record["archived"] != (research_id in archived):
+            failures.append(f"research {research_id} archived: {record['archived']}, expected {research_id in archived}")
+        if not research_manager.perist_folder_path.joinpath(record["file_name"]).exists():
+            failures.append(f"research {research_id} file lost")
+    if research_manager.search_index.count() != len(records):
+        failures.append(f"{research_manager.search_index.count()} search index entries, expected {len(records)}")
+
+    prompt_lines = set(prompts_manager.get_prompt(SHARED_PROMPT_NAME).splitlines())
+    lost_lines = [line for result in results for line in result["prompt_lines"] if line not in prompt_lines]
+    if lost_lines:
+        failures.append(f"{len(lost_lines)} prompt updates lost, e.g. {lost_lines[0]}")
+    analysis_links = {analysis["link"] for analysis in records[shared_research_id]["analyses"]}
+    lost_links = [link for result in results for link in result["analysis_links"] if link not in analysis_links]
+    if lost_links:
+        failures.append(f"{len(lost_links)} research updates lost, e.g. {lost_links[0]}")
+    return failures
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backend", choices=("sqlite", "json"), default="sqlite", help="RESEARCH_STORAGE_BACKEND")
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=8, help="threads per process")
+    parser.add_argument("--operations", type=int, default=40, help="operations per thread")
+    parser.add_argument("--run-worker", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--assets-dir", help=argparse.SUPPRESS)
+    parser.add_argument("--shared-research-id", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    os.environ["RESEARCH_STORAGE_BACKEND"] = args.backend
+    # read your own writes: prompts changed by other processes are picked up on the next read
+    os.environ["PROMPTS_RELOAD_INTERVAL_SECONDS"] = "0"
+    if args.run_worker is not None:
+        print(json.dumps(run_worker(args.run_worker, args)))
+        return
+
+    from page_insights.prompts_manager import PromptsManager
+    from page_insights.research_manager import ResearchManager
+
+    assets_dir = Path(tempfile.mkdtemp(prefix="page-insights-stress-"))
+    PromptsManager(assets_dir).add_prompt(SHARED_PROMPT_NAME, SHARED_PROMPT_TEXT)
+    shared_research_id = ResearchManager(assets_dir).persist_research("", SHARED_RESEARCH_NAME, [], analyses=[])
+
+    start = time.perf_counter()
+    workers = [subprocess.Popen(
+        [sys.executable, "-m", "benchmarks.stress_concurrency", "--run-worker", str(index),
+         "--backend", args.backend, "--threads", str(args.threads), "--operations", str(args.operations),
+         "--assets-dir", str(assets_dir), "--shared-research-id", shared_research_id],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True) for index in range(args.processes)]
+    results = [json.loads(worker.communicate()[0].strip().splitlines()[-1]) for worker in workers]
+    seconds = time.perf_counter() - start
+
+    operations = sum((Counter(result["operations"]) for result in results), Counter())
+    conflicts = sum((Counter(result["conflicts"]) for result in results), Counter())
+    errors = [error for result in results for error in result["errors"]]
+    print(f"{args.processes} processes x {args.threads} threads, {args.backend} store, assets: {assets_dir}")
+    print(f"{sum(operations.values())} operations in {seconds:.2f}s, "
+          f"{sum(operations.values()) / seconds:.0f} per second: {dict(sorted(operations.items()))}")
+    print(f"conflicts detected and retried: {dict(conflicts)}")
+
+    failures = check(assets_dir, shared_research_id, results)
+    for error in errors[:5]:
+        print(f"ERROR {error}")
+    for failure in failures:
+        print(f"FAILED {failure}")
+    if errors or failures:
+        sys.exit(1)
+    print("OK, no lost or inconsistent updates")
+
+
+if __name__ == "__main__":
+    main()
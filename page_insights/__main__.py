@@ -0,0 +1,5 @@
+import sys
+
+from page_insights.cli import main
+
+sys.exit(main())
@@ -0,0 +1,176 @@
+"""
+Asynchronous page fetching for multi-link analysis.
+
+Pages are downloaded on an asyncio event loop running in a background thread, over one pooled
+HTTP client with global and per-host connection limits, timeouts, redirect handling and
+retries with jittered exponential backoff.  Downloads are streamed and capped, and non-HTML
+responses are dropped as soon as their headers arrive.  HTML extraction runs in a process pool so parsing
+never blocks the event loop.  `submit()` returns a concurrent future, which lets the
+Summarizer's worker threads start on the LLM call for one page while later pages are still
+downloading.
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import random
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor, wait
+from urllib.parse import urlsplit
+
+import httpx
+from trafilatura.downloads import USER_AGENT
+
+from page_insights.metrics import CACHE_REQUESTS, ERRORS, STAGE_SECONDS
+from page_insights.page_cache import PageCache
+from page_insights.webpage import Webpage
+from page_insights.webpage_reader import append_capped, check_content_type, extract_text, log_page_read, make_webpage
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncWebpageReader(object):
+
+    RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+    RETRY_BASE_DELAY_SECONDS = 0.5
+    MAX_REDIRECTS = 10
+
+    def __init__(self, page_cache: PageCache | None = None):
+        self.page_cache = page_cache
+        self.FETCH_MAX_CONNECTIONS = int(os.getenv("FETCH_MAX_CONNECTIONS", 20))
+        self.FETCH_MAX_CONNECTIONS_PER_HOST = int(os.getenv("FETCH_MAX_CONNECTIONS_PER_HOST", 4))
+        self.FETCH_TIMEOUT_SECONDS = float(os.getenv("FETCH_TIMEOUT_SECONDS", 30.0))
+        self.FETCH_MAX_RETRIES = int(os.getenv("FETCH_MAX_RETRIES", 3))
+        self.FETCH_EXTRACT_PROCESSES = int(os.getenv("FETCH_EXTRACT_PROCESSES", 0)) or os.cpu_count() or 1
+        self.PAGE_MAX_DOWNLOAD_BYTES = int(float(os.getenv("PAGE_MAX_DOWNLOAD_MB", 10)) * 1024 * 1024)
+        self.PAGE_MAX_TEXT_CHARS = int(os.getenv("PAGE_MAX_TEXT_CHARS", 0))
+        self.PAGE_OFFLOAD_MIN_CHARS = int(os.getenv("PAGE_OFFLOAD_MIN_CHARS", 0))
+
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="async-webpage-reader", daemon=True)
+        self._thread.start()
+        self._extract_pool = self._create_extract_pool()
+        # created lazily, on the event loop thread, the first time a page is read
+        self._client: httpx.AsyncClient | None = None
+        self._host_semaphores: dict[str, asyncio.Semaphore] = {}
+
+    def submit(self, url: str) -> "Future[Webpage]":
+        """schedules the page to be read, the future resolves to the Webpage (None if it could not be read)"""
+        return asyncio.run_coroutine_threadsafe(self.read(url), self._loop)
+
+    def close(self) -> None:
+        if self._client:
+            asyncio.run_coroutine_threadsafe(self._client.aclose(), self._loop).result()
+        self._extract_pool.shutdown()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+    async def read(self, url: str) -> Webpage:
+        try:
+            logger.info(f"Reading content for page: {url}")
+            text_content, truncated = await self._read_text(url)
+        except Exception as e:
+            ERRORS.inc(stage="read")
+            logger.error(f"An error occurred reading {url}: {str(e)}")
+            return None  # type: ignore
+        else:
+            # pages can wait a while for an llm worker, large ones wait on disk
+            return await asyncio.to_thread(make_webpage, text_content, url, truncated, self.PAGE_MAX_TEXT_CHARS,
+                                           self.PAGE_OFFLOAD_MIN_CHARS)
+
+    async def _read_text(self, url: str) -> tuple[str, bool]:
+        """returns the text content of the page and whether the download was truncated"""
+        cached = await asyncio.to_thread(self.page_cache.get, url) if self.page_cache else None
+        if cached and self.page_cache.is_fresh(cached):  # type: ignore
+            CACHE_REQUESTS.inc(cache="page", result="hit")
+            logger.info(f"Page cache hit: {url}")
+            return cached.text, False
+
+        with STAGE_SECONDS.time(stage="fetch") as fetch_timer:
+            response, html, truncated = await self._fetch(url, PageCache.conditional_headers(cached))
+        if cached and response.status_code == httpx.codes.NOT_MODIFIED:
+            CACHE_REQUESTS.inc(cache="page", result="revalidated")
+            logger.info(f"Page not modified since last fetch: {url}")
+            await asyncio.to_thread(self.page_cache.mark_revalidated, url,  # type: ignore
+                                    response.headers.get("etag"), response.headers.get("last-modified"))
+            return cached.text, False
+
+        # includes the wait for a free extraction process
+        with STAGE_SECONDS.time(stage="extract") as extract_timer:
+            text_content = await self._loop.run_in_executor(self._extract_pool, extract_text, html)
+        html_bytes = len(html)
+        # a truncated download is not cached, the cache would serve it as the whole page
+        if self.page_cache and not truncated:
+            CACHE_REQUESTS.inc(cache="page", result="miss")
+            await asyncio.to_thread(self.page_cache.put, url, html, text_content,
+                                    response.headers.get("etag"), response.headers.get("last-modified"))
+        del html
+        log_page_read(url, fetch_timer.seconds, extract_timer.seconds, html_bytes, len(text_content))
+        return text_content, truncated
+
+    async def _fetch(self, url: str, headers: dict[str, str]) -> tuple[httpx.Response, bytes, bool]:
+        """streams the page, returns the response, its body and whether the body was cut at PAGE_MAX_DOWNLOAD_BYTES"""
+        async with self._host_semaphore(url):
+            attempt = 0
+            while True:
+                try:
+                    async with self._get_client().stream("GET", url, headers=headers) as response:
+                        if response.status_code not in self.RETRY_STATUS_CODES:
+                            if response.status_code == httpx.codes.NOT_MODIFIED:
+                                return response, b"", False
+                            response.raise_for_status()
+                            check_content_type(url, response.headers)
+                            html, truncated = await self._read_capped(url, response)
+                            return response, html, truncated
+                    error: Exception = httpx.HTTPStatusError(
+                        f"Server responded {response.status_code}", request=response.request, response=response)
+                except httpx.TransportError as e:
+                    error = e
+                ERRORS.inc(stage="fetch")
+                if attempt == self.FETCH_MAX_RETRIES:
+                    raise error
+                delay = self.RETRY_BASE_DELAY_SECONDS * 2 ** attempt + random.uniform(0, self.RETRY_BASE_DELAY_SECONDS)
+                logger.warning(f"Fetching {url} failed ({str(error)}), retrying in {delay:.2f} seconds")
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    async def _read_capped(self, url: str, response: httpx.Response) -> tuple[bytes, bool]:
+        buffer = bytearray()
+        async for chunk in response.aiter_bytes():
+            if append_capped(buffer, chunk, self.PAGE_MAX_DOWNLOAD_BYTES):
+                logger.warning(f"Page larger than {self.PAGE_MAX_DOWNLOAD_BYTES} bytes, "
+                               f"reading only the start of it: {url}")
+                return bytes(buffer), True
+        return bytes(buffer), False
+
+    def _host_semaphore(self, url: str) -> asyncio.Semaphore:
+        host = urlsplit(url).netloc.lower()
+        if host not in self._host_semaphores:
+            self._host_semaphores[host] = asyncio.Semaphore(self.FETCH_MAX_CONNECTIONS_PER_HOST)
+        return self._host_semaphores[host]
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                follow_redirects=True,
+                max_redirects=self.MAX_REDIRECTS,
+                timeout=self.FETCH_TIMEOUT_SECONDS,
+                limits=httpx.Limits(max_connections=self.FETCH_MAX_CONNECTIONS,
+                                    max_keepalive_connections=self.FETCH_MAX_CONNECTIONS),
+                headers={"User-Agent": USER_AGENT},
+            )
+        return self._client
+
+    def _create_extract_pool(self) -> ProcessPoolExecutor:
+        # never forked from this process, its threads may hold locks (logging, caches) a fork
+        # would copy locked.  The workers start from a fresh interpreter and import extract_text
+        if "forkserver" in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context("forkserver")
+            # the fork server is single threaded, workers fork from it with the extraction
+            # libraries already imported
+            context.set_forkserver_preload(["page_insights.webpage_reader"])
+        else:
+            context = multiprocessing.get_context("spawn")
+        extract_pool = ProcessPoolExecutor(max_workers=self.FETCH_EXTRACT_PROCESSES, mp_context=context)
+        # starting the workers takes a moment of CPU, take it now rather than while the first pages download
+        wait([extract_pool.submit(int) for _ in range(self.FETCH_EXTRACT_PROCESSES)])
+        return extract_pool
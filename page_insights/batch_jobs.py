@@ -0,0 +1,223 @@
+"""
+Background batch analysis jobs.
+
+A job applies one prompt to a list of links on a shared worker pool, independent of the
+request that submitted it.  Every finished link is checkpointed to the job's JSON file, so a
+job interrupted by a restart resumes with only the links that have no result yet.  A process
+claims a job (an flock on the job's lock file) before running it, so of several processes
+sharing the assets folder only one resumes it.  When all links are done the combined analysis
+is saved as research.
+"""
+import json
+import logging
+import os
+import string
+import random
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any
+
+from page_insights.concurrency import FileClaim
+from page_insights.file_utils import atomic_write_text
+from page_insights.dedup import DedupSession
+from page_insights.research_manager import ResearchManager
+from page_insights.summarizer import Summarizer
+from page_insights.webpage import Webpage
+
+logger = logging.getLogger(__name__)
+
+
+class BatchJobManager(object):
+    JOBS_FOLDER = "jobs"
+    JOB_FILE_EXT = "json"
+    JOB_LOCK_FILE_EXT = "lock"
+    QUEUED, RUNNING, COMPLETED, FAILED = "queued", "running", "completed", "failed"
+
+    def __init__(self, assets_dir: Path, summarizer: Summarizer, research_manager: ResearchManager):
+        self.summarizer = summarizer
+        self.research_manager = research_manager
+        self.jobs_folder_path = assets_dir.joinpath(self.JOBS_FOLDER)
+        self.jobs_folder_path.mkdir(parents=True, exist_ok=True)
+        self.BATCH_JOB_WORKERS = int(os.getenv("BATCH_JOB_WORKERS", 4))
+        self._executor = ThreadPoolExecutor(max_workers=self.BATCH_JOB_WORKERS, thread_name_prefix="batch-job")
+        self._lock = threading.Lock()
+        self._jobs: dict[str, dict[str, Any]] = {}
+        # the jobs this process runs
+        self._claims: dict[str, FileClaim] = {}
+        self._load_jobs()
+
+    def submit(self, links: list[str], prompt_name: str, temprature: float, summary_words_max_range: str,
+               research_name: str) -> str:
+        """queues the analysis of the links and returns the job id"""
+        if not links:
+            raise ValueError("A batch job needs at least one link")
+        # fail fast on a bad or invalid prompt rather than in the workers
+        self.summarizer.prompts_manager.get_prompt_template(prompt_name)
+        job_id = self._generate_job_id()
+        now = self._now()
+        job = {
+            "id": job_id,
+            "status": self.QUEUED,
+            "research_name": research_name,
+            "prompt_name": prompt_name,
+            "temprature": temprature,
+            "summary_words_max_range": summary_words_max_range,
+            "links": links,
+            "results": {},
+            "research_id": None,
+            "error": None,
+            "created_date": now,
+            "updated_date": now,
+        }
+        with self._lock:
+            self._jobs[job_id] = job
+            # claimed before its file exists, so no other process resumes it
+            self._claim(job)
+            self._checkpoint(job)
+        logger.info(f"Submitted batch job {job_id} with {len(links)} links")
+        self._start(job)
+        return job_id
+
+    def get_job_ids(self) -> list[str]:
+        with self._lock:
+            return list(self._jobs.keys())
+
+    def get_job_progress(self, job_id: str) -> dict[str, Any]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if not job:
+                return {}
+            if job["status"] in (self.QUEUED, self.RUNNING) and job_id not in self._claims:
+                # run by another process, its checkpoints are the progress
+                job.update(self._read_job(job_id))
+            results = list(job["results"].values())
+            return {
+                "id": job["id"],
+                "status": job["status"],
+                "research_name": job["research_name"],
+                "prompt_name": job["prompt_name"],
+                "total": len(job["links"]),
+                "completed": sum(1 for result in results if not result["error"]),
+                "failed": sum(1 for result in results if result["error"]),
+                # links that reused the analysis of a duplicate page
+                "deduplicated": sum(1 for result in results if result.get("duplicate_of")),
+                "research_id": job["research_id"],
+                "error": job.get("error"),
+                "created_date": job["created_date"],
+                "updated_date": job["updated_date"],
+            }
+
+    def _load_jobs(self) -> None:
+        # jobs interrupted by a restart resume with the links that have no result yet
+        for job_file in sorted(self.jobs_folder_path.glob(f"*.{self.JOB_FILE_EXT}")):
+            job = self._read_job(job_file.stem)
+            self._jobs[job["id"]] = job
+        unfinished = [job for job in self._jobs.values() if job["status"] in (self.QUEUED, self.RUNNING)]
+        logger.info(f"Loaded {len(self._jobs)} batch jobs, resuming {len(unfinished)}")
+        for job in unfinished:
+            self._start(job)
+
+    def _start(self, job: dict[str, Any]) -> None:
+        with self._lock:
+            if not self._claim(job):
+                logger.info(f"Batch job {job['id']} is run by another process")
+                return
+            # another process may have run the job since it was loaded
+            job.update(self._read_job(job["id"]))
+            if job["status"] not in (self.QUEUED, self.RUNNING):
+                self._claims.pop(job["id"]).release()
+                return
+            pending = [index for index in range(len(job["links"])) if str(index) not in job["results"]]
+            job["status"] = self.RUNNING
+            self._checkpoint(job)
+        if not pending:
+            self._executor.submit(self._finish, job)
+        # the links are submitted in order, so the first of a group of duplicates starts before the others
+        pending_links = [job["links"][index] for index in pending]
+        dedup_session = self.summarizer.new_dedup_session(pending_links)
+        page_futures = self.summarizer.prefetch_pages(pending_links, dedup_session)
+        for index, page_future in zip(pending, page_futures):
+            self._executor.submit(self._run_link, job, index, dedup_session, page_future)
+
+    def _run_link(self, job: dict[str, Any], index: int, dedup_session: DedupSession | None = None,
+                  page_future: "Future[Webpage] | None" = None) -> None:
+        link = job["links"][index]
+        try:
+            result, _ = self.summarizer.analyze_link(
+                link, job["temprature"], job["prompt_name"], job["summary_words_max_range"],
+                dedup_session=dedup_session, page_future=page_future)
+        except Exception as e:
+            logger.error(f"Batch job {job['id']} failed for link: {link}:  Error: {str(e)}")
+            result = self.summarizer.make_failed_analysis(link, str(e), job["prompt_name"], job["temprature"],
+                                                          job["summary_words_max_range"])
+        result["completed_date"] = self._now()
+        with self._lock:
+            job["results"][str(index)] = result
+            self._checkpoint(job)
+            done = len(job["results"]) == len(job["links"])
+        if done:
+            self._finish(job)
+
+    def _finish(self, job: dict[str, Any]) -> None:
+        try:
+            self._save_research(job)
+        except Exception as e:
+            # a job left running would be resumed, and fail again, by every restart
+            logger.error(f"Batch job {job['id']} failed to save its research:  Error: {str(e)}")
+            with self._lock:
+                job["status"] = self.FAILED
+                job["error"] = str(e)
+                try:
+                    self._checkpoint(job)
+                except Exception as e:
+                    logger.error(f"Batch job {job['id']} failed to checkpoint:  Error: {str(e)}")
+        finally:
+            with self._lock:
+                self._claims.pop(job["id"]).release()
+
+    def _save_research(self, job: dict[str, Any]) -> None:
+        results = [job["results"][str(index)] for index in range(len(job["links"]))]
+        research_id = None
+        if all(result["error"] for result in results):
+            status = self.FAILED
+        else:
+            research_text = "\n\n".join(result["summary"] or f"ERROR[{result['link']}]: {result['error']}"
+                                        for result in results)
+            # results of jobs checkpointed before analysis records existed can't be refreshed
+            analyses = [{key: value for key, value in result.items() if key != "completed_date"}
+                        for result in results] if all("prompt_name" in result for result in results) else None
+            research_id = self.research_manager.persist_research(research_text, job["research_name"], job["links"],
+                                                                 analyses=analyses)
+            status = self.COMPLETED
+        with self._lock:
+            job["status"] = status
+            job["research_id"] = research_id
+            self._checkpoint(job)
+        logger.info(f"Batch job {job['id']} {status}")
+
+    def _claim(self, job: dict[str, Any]) -> bool:
+        """True when this process runs the job"""
+        if job["id"] not in self._claims:
+            claim = FileClaim(self.jobs_folder_path.joinpath(f"{job['id']}.{self.JOB_LOCK_FILE_EXT}"))
+            if not claim.claim():
+                return False
+            self._claims[job["id"]] = claim
+        return True
+
+    def _read_job(self, job_id: str) -> dict[str, Any]:
+        return json.loads(self.jobs_folder_path.joinpath(f"{job_id}.{self.JOB_FILE_EXT}").read_text())
+
+    def _checkpoint(self, job: dict[str, Any]) -> None:
+        job["updated_date"] = self._now()
+        atomic_write_text(self.jobs_folder_path.joinpath(f"{job['id']}.{self.JOB_FILE_EXT}"),
+                          json.dumps(job, indent=4))
+
+    def _now(self) -> str:
+        return datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S %z")
+
+    def _generate_job_id(self) -> str:
+        characters = string.ascii_letters + string.digits
+        return f"job-{datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S')}-" + \
+            ''.join(random.choice(characters) for _ in range(4))
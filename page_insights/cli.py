@@ -0,0 +1,179 @@
+"""
+Command line entry point: runs analyses without the Gradio UI, e.g. for scheduled batch runs.
+
+    page-insights analyze links.txt --prompt default-prompt              # JSONL to stdout
+    cat links.txt | page-insights analyze --prompt default-prompt --save "Weekly reading"
+    page-insights crawl https://example.com/docs/ --prompt default-prompt --include "/docs/*"
+    page-insights prompts                                                # the available prompts
+
+Links are read one per line, blank lines and lines starting with # are skipped.  Each analysis is
+written to stdout as a JSON line as soon as it and the ones before it are done, or for a crawl
+as soon as it is done; logs go to stderr.  The pipeline is only imported once the arguments are parsed, so `--help` and usage
+errors return immediately.  Exits with 1 when an analysis failed.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from pathlib import Path
+from typing import IO, TYPE_CHECKING, Any, Iterable, Iterator
+
+if TYPE_CHECKING:
+    from page_insights.pipeline import AnalysisPipeline
+
+logger = logging.getLogger(__name__)
+
+
+def read_links(links_file: IO[str]) -> Iterator[str]:
+    for line in links_file:
+        line = line.strip()
+        if line and not line.startswith("#"):
+            yield line
+
+
+def analyze(args: argparse.Namespace) -> int:
+    links_file = sys.stdin if args.links_file == "-" else open(args.links_file, encoding="utf-8")
+    with links_file:
+        links = list(read_links(links_file))
+    if not links:
+        logger.error("No links to analyze")
+        return 1
+    from page_insights.pipeline import AnalysisPipeline
+
+    pipeline = AnalysisPipeline(args.assets_dir, os.getenv("OPENAI_API_KEY"), args.concurrency)  # type: ignore
+    dedup_session = pipeline.summarizer.new_dedup_session(links)
+    try:
+        results = pipeline.analyze_links(links, args.prompt, args.temperature, args.word_range, dedup_session)
+    except KeyError:
+        logger.error(f"Prompt not found: {args.prompt}")
+        return 1
+    except ValueError as e:
+        logger.error(f"Invalid prompt {args.prompt}: {str(e)}")
+        return 1
+    analyses = write_analyses(results, args.quiet)
+    pipeline.close()
+    failed = sum(1 for analysis in analyses if analysis["error"])
+    print(f"Analyzed {len(analyses) - failed} of {len(analyses)} links", file=sys.stderr)
+    if dedup_session:
+        report = dedup_session.report()
+        print(f"Reused the analysis of a duplicate page for {report['reused_analyses']} of {report['links']} links "
+              f"(hit rate {report['hit_rate']:.0%})", file=sys.stderr)
+    return save_research(pipeline, args.save, analyses) or (1 if failed else 0)
+
+
+def crawl(args: argparse.Namespace) -> int:
+    from page_insights.pipeline import AnalysisPipeline
+    from page_insights.site_crawler import SiteCrawler
+
+    pipeline = AnalysisPipeline(args.assets_dir, os.getenv("OPENAI_API_KEY"), args.concurrency)  # type: ignore
+    crawler = SiteCrawler(pipeline.llm_adapter.webpage_reader, args.max_pages, args.max_depth, args.include,
+                          args.exclude, args.delay)
+    start = time.perf_counter()
+    try:
+        results = pipeline.crawl_and_analyze(args.seed, args.prompt, args.temperature, args.word_range, crawler)
+    except KeyError:
+        logger.error(f"Prompt not found: {args.prompt}")
+        return 1
+    except ValueError as e:
+        logger.error(f"Invalid prompt {args.prompt}: {str(e)}")
+        return 1
+    analyses = write_analyses(results, args.quiet)
+    pipeline.close()
+    seconds = time.perf_counter() - start
+    failed = sum(1 for analysis in analyses if analysis["error"])
+    report = crawler.report()
+    print(f"Crawled {report['pages_read']} pages in {report['seconds']:.1f}s ({report['pages_per_minute']:.1f} "
+          f"pages/min), {report['pages_failed']} could not be read", file=sys.stderr)
+    print(f"Analyzed {len(analyses) - failed} of {len(analyses)} pages in {seconds:.1f}s "
+          f"({len(analyses) / seconds * 60 if seconds else 0.0:.1f} pages/min)", file=sys.stderr)
+    if not analyses:
+        logger.error(f"No pages found from {args.seed}")
+        return 1
+    return save_research(pipeline, args.save, analyses) or (1 if failed else 0)
+
+
+def write_analyses(results: Iterable[dict[str, Any]], quiet: bool) -> list[dict[str, Any]]:
+    analyses = []
+    for analysis in results:
+        analyses.append(analysis)
+        if not quiet:
+            print(json.dumps(analysis), flush=True)
+    return analyses
+
+
+def save_research(pipeline: "AnalysisPipeline", research_name: str | None, analyses: list[dict[str, Any]]) -> int:
+    """saves the analyses when a research name was given, returns 1 when that failed"""
+    if not research_name:
+        return 0
+    research_id = pipeline.save_research(research_name, analyses)
+    if not research_id:
+        return 1
+    print(f"Saved research: {research_id}", file=sys.stderr)
+    return 0
+
+
+def list_prompts(args: argparse.Namespace) -> int:
+    from page_insights.prompts_manager import PromptsManager
+
+    for prompt_name in PromptsManager(args.assets_dir).get_prompt_names():
+        print(prompt_name)
+    return 0
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(prog="page-insights", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--assets-dir", type=Path, help="default: ASSETS_FOLDER_PATH")
+    parser.add_argument("-v", "--verbose", action="store_true", help="log the progress of every link")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    analyze_parser = commands.add_parser("analyze", help="analyze links with a prompt")
+    analyze_parser.add_argument("links_file", nargs="?", default="-", help="file with a link per line, default: stdin")
+    analyze_parser.add_argument("-p", "--prompt", required=True, help="name of the prompt to analyze the links with")
+    analyze_parser.add_argument("-t", "--temperature", type=float, default=0.0)
+    analyze_parser.add_argument("-w", "--word-range", default="150, 200", help="min, max words of each analysis")
+    analyze_parser.add_argument("-c", "--concurrency", type=int,
+                                help="links analyzed in parallel, default: LLM_API_MAX_CONCURRENT_REQUESTS")
+    analyze_parser.add_argument("-s", "--save", metavar="RESEARCH_NAME", help="save the analyses as research")
+    analyze_parser.add_argument("-q", "--quiet", action="store_true", help="don't write the analyses to stdout")
+    analyze_parser.set_defaults(run=analyze)
+    crawl_parser = commands.add_parser("crawl", help="crawl a site and analyze its pages with a prompt")
+    crawl_parser.add_argument("seed", help="url of the first page, or of the site's sitemap.xml")
+    crawl_parser.add_argument("-p", "--prompt", required=True, help="name of the prompt to analyze the pages with")
+    crawl_parser.add_argument("-t", "--temperature", type=float, default=0.0)
+    crawl_parser.add_argument("-w", "--word-range", default="150, 200", help="min, max words of each analysis")
+    crawl_parser.add_argument("-c", "--concurrency", type=int,
+                              help="pages analyzed in parallel, default: LLM_API_MAX_CONCURRENT_REQUESTS")
+    crawl_parser.add_argument("--max-pages", type=int, help="default: CRAWL_MAX_PAGES")
+    crawl_parser.add_argument("--max-depth", type=int, help="links away from the seed, default: CRAWL_MAX_DEPTH")
+    crawl_parser.add_argument("--include", action="append", default=[], metavar="PATTERN",
+                              help='only follow links with a path matching the glob pattern, e.g. "/docs/*"')
+    crawl_parser.add_argument("--exclude", action="append", default=[], metavar="PATTERN",
+                              help="never follow links with a path matching the glob pattern")
+    crawl_parser.add_argument("--delay", type=float, help="seconds between requests to the site, "
+                                                          "default: CRAWL_DELAY_SECONDS")
+    crawl_parser.add_argument("-s", "--save", metavar="RESEARCH_NAME", help="save the analyses as research")
+    crawl_parser.add_argument("-q", "--quiet", action="store_true", help="don't write the analyses to stdout")
+    crawl_parser.set_defaults(run=crawl)
+    prompts_parser = commands.add_parser("prompts", help="list the prompts")
+    prompts_parser.set_defaults(run=list_prompts)
+    args = parser.parse_args(argv)
+
+    import dotenv
+    dotenv.load_dotenv()
+    log_handler = logging.StreamHandler(sys.stderr)
+    if os.getenv("LOG_FORMAT", "text").lower() == "json":
+        from page_insights.json_log_formatter import JsonLogFormatter
+        log_handler.setFormatter(JsonLogFormatter())
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, handlers=[log_handler])
+    if args.assets_dir is None:
+        if not os.getenv("ASSETS_FOLDER_PATH"):
+            parser.error("--assets-dir or ASSETS_FOLDER_PATH is required")
+        args.assets_dir = Path(os.getenv("ASSETS_FOLDER_PATH"))  # type: ignore
+    return args.run(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
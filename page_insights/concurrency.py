@@ -0,0 +1,168 @@
+"""
+Locking for the state shared by the app's worker threads, and by processes sharing the assets
+folder (e.g. several replicas on one volume).
+
+- RWLock lets any number of readers in at once, or one writer.
+- FileLock adds an flock on a lock file to an RWLock, so it also excludes other processes.
+- FileClaim is an flock held across calls, until released, so one process owns a piece of
+  long-running work such as a batch job.
+- SqliteConnections gives each thread its own SQLite connection, so reads run in parallel and
+  SQLite's own locking orders the writes, across threads and processes.
+- ConflictError is raised by the optimistic version checks of updates: a record or prompt
+  changed since the caller read it, and the update was not applied.
+"""
+import logging
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator
+
+try:
+    import fcntl
+except ImportError:  # Windows, only the in-process locking applies
+    fcntl = None  # type: ignore
+
+logger = logging.getLogger(__name__)
+
+
+class ConflictError(Exception):
+    """the target changed since the version the caller read, the change was not applied"""
+
+
+class RWLock(object):
+    """many readers or a single writer.  A waiting writer holds back new readers, so a steady
+    stream of reads can't starve writes"""
+
+    def __init__(self):
+        self._condition = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+
+    @contextmanager
+    def read_lock(self) -> Iterator[None]:
+        with self._condition:
+            while self._writer or self._waiting_writers:
+                self._condition.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._readers -= 1
+                if not self._readers:
+                    self._condition.notify_all()
+
+    @contextmanager
+    def write_lock(self) -> Iterator[None]:
+        with self._condition:
+            self._waiting_writers += 1
+            try:
+                while self._writer or self._readers:
+                    self._condition.wait()
+            finally:
+                self._waiting_writers -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._writer = False
+                self._condition.notify_all()
+
+
+class FileLock(object):
+    """a reader/writer lock across the threads of this process and across processes.  Locks
+    are not reentrant"""
+
+    def __init__(self, lock_file_path: Path):
+        self.lock_file_path = lock_file_path
+        self._rw_lock = RWLock()
+
+    @contextmanager
+    def shared(self) -> Iterator[None]:
+        with self._rw_lock.read_lock(), self._flock(fcntl.LOCK_SH if fcntl else 0):
+            yield
+
+    @contextmanager
+    def exclusive(self) -> Iterator[None]:
+        with self._rw_lock.write_lock(), self._flock(fcntl.LOCK_EX if fcntl else 0):
+            yield
+
+    @contextmanager
+    def _flock(self, operation: int) -> Iterator[None]:
+        if fcntl is None:
+            yield
+            return
+        # a descriptor per acquisition: flock locks belong to the open file, so threads sharing
+        # one descriptor would share (and convert) each other's locks
+        fd = os.open(self.lock_file_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, operation)
+            yield
+        finally:
+            # closing the descriptor releases the lock
+            os.close(fd)
+
+
+class FileClaim(object):
+    """an exclusive, non-blocking claim on a lock file across processes, held from claim() until
+    release() or the end of the process"""
+
+    def __init__(self, lock_file_path: Path):
+        self.lock_file_path = lock_file_path
+        self._fd: int | None = None
+
+    def claim(self) -> bool:
+        """True when this claim now holds the lock file, False when another process holds it"""
+        if self._fd is not None or fcntl is None:
+            return True
+        fd = os.open(self.lock_file_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self._fd = fd
+        return True
+
+    def release(self) -> None:
+        if self._fd is not None:
+            # closing the descriptor releases the lock
+            os.close(self._fd)
+            self._fd = None
+
+
+class SqliteConnections(object):
+    """a connection per thread to one SQLite database"""
+
+    def __init__(self, db_file_path: Path, timeout_seconds: float = 30.0, pragmas: tuple[str, ...] = ()):
+        self.db_file_path = db_file_path
+        # how long a write waits for another connection's write to finish
+        self.timeout_seconds = timeout_seconds
+        self.pragmas = pragmas
+        self._local = threading.local()
+
+    def get(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.db_file_path, timeout=self.timeout_seconds)
+            for pragma in self.pragmas:
+                connection.execute(f"PRAGMA {pragma}")
+            self._local.connection = connection
+        return connection
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """a write transaction holding the database's write lock from the start, so what it reads
+        can't change before it writes"""
+        connection = self.get()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.rollback()
+            raise
+        connection.commit()
@@ -0,0 +1,244 @@
+"""
+Near-duplicate page detection, so mirrors, syndicated copies, AMP / print variants and links that
+only differ by tracking parameters are analyzed once.
+
+- canonical_url() strips tracking parameters from a link.  AMP, print and mobile variants can differ from the page
+  in content, they are left to the content fingerprint.
+- simhash() fingerprints the extracted text of a page: pages whose fingerprints differ in only a
+  few of their 64 bits have nearly the same text.
+- FingerprintIndex keeps the fingerprints and summaries of the saved research, next to the
+  research metadata, so a page that duplicates an already analyzed page reuses its summary.
+- DedupSession coordinates one batch of links analyzed in parallel: the first link of a group of
+  duplicates (the leader) is analyzed, the others wait for it and reuse its analysis.
+"""
+import hashlib
+import json
+import logging
+import re
+import threading
+from collections import Counter
+from concurrent.futures import Future
+from pathlib import Path
+from typing import Any
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from page_insights.concurrency import SqliteConnections
+from page_insights.page_cache import PageCache
+
+logger = logging.getLogger(__name__)
+
+# click and campaign ids added to links by ad platforms, mailers and analytics, they never change the page
+TRACKING_PARAMETERS = {"fbclid", "gclid", "dclid", "msclkid", "yclid", "igshid", "mc_cid", "mc_eid", "_ga", "_gl"}
+TRACKING_PARAMETER_PREFIXES = ("utm_", "pk_", "hsa_", "oly_", "__hs", "vero_")
+WORD_PATTERN = re.compile(r"\w+", re.UNICODE)
+SIMHASH_BITS = 64
+SHINGLE_WORDS = 3
+# texts shorter than this (error pages, consent walls, ...) look alike without being duplicates
+MIN_WORDS = 50
+
+
+def canonical_url(url: str) -> str:
+    """the url without tracking parameters or a www. prefix, normalized as the page cache does"""
+    parts = urlsplit(PageCache.normalize_url(url))
+    host = parts.netloc.removeprefix("www.")
+    path = parts.path or "/"
+    query = urlencode([(name, value) for name, value in parse_qsl(parts.query, keep_blank_values=True)
+                       if name.lower() not in TRACKING_PARAMETERS
+                       and not name.lower().startswith(TRACKING_PARAMETER_PREFIXES)])
+    return urlunsplit(("https" if parts.scheme == "http" else parts.scheme, host, path, query, ""))
+
+
+def simhash(text: str) -> int | None:
+    """64 bit SimHash of the word shingles of the text, None for texts too short to compare"""
+    words = WORD_PATTERN.findall(text.lower())
+    if len(words) < MIN_WORDS:
+        return None
+    digests = b"".join(hashlib.blake2b(" ".join(words[index:index + SHINGLE_WORDS]).encode("utf-8"),
+                                       digest_size=SIMHASH_BITS // 8).digest()
+                       for index in range(len(words) - SHINGLE_WORDS + 1))
+    shingles = len(digests) // 8
+    # count the set bits per position a byte at a time: Counter runs over each byte column in C,
+    # instead of a python loop over every bit of every shingle
+    bit_counts = [0] * SIMHASH_BITS
+    for byte_index in range(8):
+        for value, count in Counter(digests[byte_index::8]).items():
+            for bit in range(8):
+                if value & (0x80 >> bit):
+                    bit_counts[byte_index * 8 + bit] += count
+    fingerprint = 0
+    for bit_count in bit_counts:
+        fingerprint = (fingerprint << 1) | (bit_count * 2 > shingles)
+    return fingerprint
+
+
+def word_range(summary_words_max_range: str) -> list[str]:
+    return [count.strip() for count in summary_words_max_range.split(",")]
+
+
+def hamming_distance(fingerprint: int, other_fingerprint: int) -> int:
+    return (fingerprint ^ other_fingerprint).bit_count()
+
+
+class FingerprintIndex(object):
+    """
+    The fingerprints of the analyzed pages of the saved research, with their summaries.
+
+    A fingerprint is split into 8 bands of 8 bits.  Two fingerprints at most 7 bits apart share
+    at least one band, so near duplicates are found with an indexed lookup of the bands instead
+    of comparing every fingerprint.
+    """
+    BANDS = 8
+    # the largest distance the band lookup is guaranteed to find
+    MAX_DISTANCE = BANDS - 1
+
+    def __init__(self, db_file_path: Path):
+        self.db_file_path = db_file_path
+        self._connections = SqliteConnections(db_file_path)
+        db = self._connections.get()
+        db.execute("PRAGMA journal_mode=WAL")
+        db.executescript(f"""
+            CREATE TABLE IF NOT EXISTS fingerprints (
+                research_id TEXT NOT NULL,
+                link TEXT NOT NULL,
+                simhash TEXT NOT NULL,
+                {", ".join(f"band{band} INTEGER NOT NULL" for band in range(self.BANDS))},
+                prompt_version TEXT NOT NULL,
+                analysis TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS fingerprints_research_id ON fingerprints (research_id);
+        """)
+        for band in range(self.BANDS):
+            db.execute(f"CREATE INDEX IF NOT EXISTS fingerprints_band{band} ON fingerprints (band{band})")
+
+    def count(self) -> int:
+        return self._connections.get().execute("SELECT COUNT(DISTINCT research_id) FROM fingerprints").fetchone()[0]
+
+    def index(self, research_id: str, analyses: list[dict[str, Any]]) -> None:
+        """replaces the fingerprints of the research with those of its successful analyses"""
+        rows = []
+        for analysis in analyses:
+            if analysis.get("error") or not analysis.get("content_simhash") or not analysis.get("summary"):
+                continue
+            fingerprint = int(analysis["content_simhash"], 16)
+            rows.append((research_id, analysis["link"], analysis["content_simhash"], *self._bands(fingerprint),
+                         analysis["prompt_version"], json.dumps(analysis)))
+        with self._connections.transaction() as db:
+            db.execute("DELETE FROM fingerprints WHERE research_id = ?", (research_id,))
+            db.executemany(f"INSERT INTO fingerprints VALUES ({', '.join('?' * (self.BANDS + 5))})", rows)
+
+    def remove(self, research_id: str) -> None:
+        with self._connections.transaction() as db:
+            db.execute("DELETE FROM fingerprints WHERE research_id = ?", (research_id,))
+
+    def find(self, fingerprint: int, prompt_version: str, temprature: float, summary_words_max_range: str,
+             max_distance: int) -> tuple[str, dict[str, Any], int] | None:
+        """the closest saved analysis, made with the same prompt version and settings, of a page at most
+        `max_distance` bits from the fingerprint, as `(research_id, analysis, distance)`"""
+        bands = self._bands(fingerprint)
+        rows = self._connections.get().execute(
+            "SELECT research_id, simhash, analysis FROM fingerprints WHERE prompt_version = ? AND (" +
+            " OR ".join(f"band{band} = ?" for band in range(self.BANDS)) + ")", (prompt_version, *bands)).fetchall()
+        best = None
+        for research_id, other_simhash, analysis_json in rows:
+            distance = hamming_distance(fingerprint, int(other_simhash, 16))
+            if distance > max_distance or (best and distance >= best[2]):
+                continue
+            analysis = json.loads(analysis_json)
+            if analysis["temprature"] == temprature and \
+                    word_range(analysis["summary_words_max_range"]) == word_range(summary_words_max_range):
+                best = (research_id, analysis, distance)
+        return best
+
+    def _bands(self, fingerprint: int) -> list[int]:
+        band_bits = SIMHASH_BITS // self.BANDS
+        return [(fingerprint >> (band * band_bits)) & ((1 << band_bits) - 1) for band in range(self.BANDS)]
+
+
+class DedupSession(object):
+    """
+    Duplicate detection for one batch of links analyzed in parallel with the same prompt and
+    settings.  The first link with a canonical url leads, later links with the same canonical url
+    wait for its analysis without being read.  Once read, a page nearly duplicating the text of a
+    leader of the batch waits for that leader, and one nearly duplicating saved research reuses
+    its analysis.
+
+    Leaders never wait on other links.  Links must be analyzed in the order they were passed in,
+    on a FIFO pool, so a url leader is always started before the links waiting on it.
+    """
+    URL_DUPLICATE, NEAR_DUPLICATE, SAVED_DUPLICATE, UNIQUE = "url_duplicate", "near_duplicate", "saved_duplicate", "unique"
+
+    def __init__(self, links: list[str], fingerprint_index: FingerprintIndex | None = None, max_distance: int = 4):
+        self.fingerprint_index = fingerprint_index
+        self.max_distance = max_distance
+        self._lock = threading.Lock()
+        # canonical url -> (the leading link, its analysis, None if it failed)
+        self._url_leaders: dict[str, tuple[str, "Future[dict[str, Any] | None]"]] = {}
+        for link in links:
+            self._url_leaders.setdefault(canonical_url(link), (link, Future()))
+        self._claimed_urls: set[str] = set()
+        # (fingerprint, link, analysis) of the leaders by content
+        self._fingerprints: list[tuple[int, str, "Future[dict[str, Any] | None]"]] = []
+        self._decisions: list[dict[str, Any]] = []
+
+    def is_url_leader(self, link: str) -> bool:
+        return self._url_leaders[canonical_url(link)][0] == link
+
+    def claim_url(self, link: str) -> tuple["Future[dict[str, Any] | None]", str | None]:
+        """returns `(future, None)` when the link leads, the caller must resolve the future with the
+        analysis of the link (None if it failed).  Otherwise `(future, leader link)`, the future
+        resolves to the leader's analysis"""
+        url = canonical_url(link)
+        with self._lock:
+            leader_link, future = self._url_leaders.setdefault(url, (link, Future()))
+            if leader_link == link and url not in self._claimed_urls:
+                self._claimed_urls.add(url)
+                return future, None
+        return future, leader_link
+
+    def claim_content(self, link: str, fingerprint: int | None, prompt_version: str, temprature: float,
+                      summary_words_max_range: str, future: "Future[dict[str, Any] | None]"
+                      ) -> tuple[str, "Future[dict[str, Any] | None] | dict[str, Any]", str, int] | None:
+        """for a page nearly duplicating a leader of the batch returns `(NEAR_DUPLICATE, the leader's
+        analysis future, leader link, distance)`, for one nearly duplicating saved research
+        `(SAVED_DUPLICATE, the saved analysis, saved link, distance)`.  Otherwise the link becomes a
+        leader, the caller resolves the future with its analysis"""
+        if fingerprint is None:
+            return None
+        with self._lock:
+            best = None
+            for other_fingerprint, other_link, other_future in self._fingerprints:
+                distance = hamming_distance(fingerprint, other_fingerprint)
+                if distance <= self.max_distance and (best is None or distance < best[3]):
+                    best = (self.NEAR_DUPLICATE, other_future, other_link, distance)
+            if best:
+                return best
+            saved = self.fingerprint_index.find(fingerprint, prompt_version, temprature, summary_words_max_range,
+                                                self.max_distance) if self.fingerprint_index else None
+            if saved:
+                research_id, analysis, distance = saved
+                return self.SAVED_DUPLICATE, analysis, f"{analysis['link']} ({research_id})", distance
+            self._fingerprints.append((fingerprint, link, future))
+        return None
+
+    def record(self, link: str, decision: str, duplicate_of: str | None = None,
+               distance: int | None = None) -> dict[str, Any]:
+        entry = {"link": link, "decision": decision, "duplicate_of": duplicate_of, "distance": distance}
+        with self._lock:
+            self._decisions.append(entry)
+        if duplicate_of:
+            logger.info(f"Reusing the analysis of {duplicate_of} for {decision} {link}")
+        return entry
+
+    def report(self) -> dict[str, Any]:
+        """the decision per link and the share of the links that reused an analysis"""
+        with self._lock:
+            decisions = list(self._decisions)
+        counts = Counter(entry["decision"] for entry in decisions)
+        reused = len(decisions) - counts[self.UNIQUE]
+        return {
+            "links": len(decisions),
+            "reused_analyses": reused,
+            "hit_rate": round(reused / len(decisions), 3) if decisions else 0.0,
+            "decisions": dict(counts),
+            "duplicates": [entry for entry in decisions if entry["decision"] != self.UNIQUE],
+        }
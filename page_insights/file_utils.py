@@ -0,0 +1,18 @@
+import os
+import tempfile
+from pathlib import Path
+
+
+def atomic_write_text(file_path: Path, text: str) -> None:
+    """writes the file via a temp file in the same folder and a rename, so readers
+    never see a partially written file"""
+    fd, temp_path = tempfile.mkstemp(dir=file_path.parent, prefix=f".{file_path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, file_path)
+    except BaseException:
+        Path(temp_path).unlink(missing_ok=True)
+        raise
@@ -0,0 +1,25 @@
+"""
+Formats log records as one JSON object per line, for log pipelines that index fields.
+
+Values passed as `extra={"metrics": {...}}` are merged into the object, which is how the
+pipeline logs the timings, tokens and cost of each page and llm call.
+"""
+import json
+import logging
+from datetime import datetime, timezone
+
+
+class JsonLogFormatter(logging.Formatter):
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        entry.update(getattr(record, "metrics", {}))
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
@@ -1,50 +1,375 @@
+import itertools
 import json
 import logging
 import os
-import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Iterator, Mapping
 import openai
+from page_insights.llm_endpoint import RETRYABLE_ERRORS, CircuitBreaker, LlmEndpoint
+from page_insights.metrics import CACHE_REQUESTS, ERRORS, LLM_COST, LLM_TOKENS, STAGE_SECONDS, get_llm_cost
+from page_insights.prompts_manager import PromptTemplate, render_context
+from page_insights.response_cache import ResponseCache
+from page_insights.token_budget import TokenBudget
+from page_insights.webpage import Webpage
 from page_insights.webpage_reader import WebpageReader
 
 logger = logging.getLogger(__name__)
 
 class LlmAdapter(object):
-    
-    def __init__(self, openai_api_key: str, resp_max_tokens: int = 1024):
-        openai.api_key = openai_api_key
+
+    # map step instruction for pages too long for the context window, each chunk is condensed
+    # to notes which are then analyzed with the user's prompt in place of the full page content
+    MAP_CHUNK_PROMPT = """You are a researcher reading part {chunk_number} of {chunk_count} of a long web page.
+Extract the facts, claims, figures and main points made in this part as concise markdown bullet points.
+Keep the original terminology and do not add anything that is not in the text.
+
+---Web page content part---
+"""
+    MAX_MAP_REDUCE_ROUNDS = 3
+    MIN_CONTENT_TOKENS = 256
+
+    def __init__(self, openai_api_key: str, resp_max_tokens: int = 1024,
+                 webpage_reader: WebpageReader | None = None, response_cache: ResponseCache | None = None):
         self.resp_max_tokens = resp_max_tokens
+        self.webpage_reader = webpage_reader or WebpageReader()
+        self.response_cache = response_cache
         self.OPENAI_LLM = os.getenv("OPENAI_LLM", None)
         if not self.OPENAI_LLM:
             raise Exception("OPENAI_LLM not set in environment")
         logger.info(f"using llm model: {self.OPENAI_LLM}")
+        self.LLM_API_MAX_RETRIES = int(os.getenv("LLM_API_MAX_RETRIES", 5))
+        # retries on an endpoint before failing over to the next one
+        self.LLM_API_FAILOVER_RETRIES = int(os.getenv("LLM_API_FAILOVER_RETRIES", 1))
+        # an endpoint that is throttled for longer than this is skipped when there is another endpoint
+        self.LLM_API_FAILOVER_MAX_WAIT_SECONDS = float(os.getenv("LLM_API_FAILOVER_MAX_WAIT_SECONDS", 5))
+        self.endpoints = self._create_endpoints(openai_api_key)
+        # pages are fitted to the primary model's context window
+        self.token_budget = TokenBudget(self.OPENAI_LLM)
+        self.LLM_MAP_CHUNK_TOKENS = int(os.getenv("LLM_MAP_CHUNK_TOKENS", 3000))
+        self.LLM_MAP_MAX_CONCURRENT_REQUESTS = int(os.getenv("LLM_MAP_MAX_CONCURRENT_REQUESTS", 4))
+
+
+    def get_llm_response(self, url: str, temprature: float, prompt_template: PromptTemplate,
+                         prompt_replacements: Mapping[str, str]) -> tuple[str, str]:
+        return self.get_llm_response_for_page(self.read_webpage(url), temprature, prompt_template, prompt_replacements)
 
 
-    def get_llm_response(self, url: str, temprature: float, system_prompt: str, 
-                         prompt_replacements: dict[str, str]) -> tuple[str, str]:
-        webpage = WebpageReader.read(url)
-        prompt_replacements["web_page_content"] = webpage.content
-
-        system_prompt = self._make_prompt_string_replacements(system_prompt, prompt_replacements)
-        response = openai.ChatCompletion.create(
-            model=self.OPENAI_LLM,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": f"Link: {url}"},
-            ],
-            temperature=temprature,
-            stream=False,
-            max_tokens=self.resp_max_tokens,
-        )
-        debug = json.dumps(response, indent=4)
-        query_reponse = response.choices[0]  # type: ignore
+    def get_llm_response_for_page(self, webpage: Webpage, temprature: float, prompt_template: PromptTemplate,
+                                  prompt_replacements: Mapping[str, str]) -> tuple[str, str]:
+        """get_llm_response for a page that has already been read"""
+        messages, token_budget = self._make_messages(webpage, prompt_template, prompt_replacements)
+        response, cache_hit = self._get_chat_completion(messages, temprature)
+        debug = json.dumps(dict(response, cache_hit=cache_hit, token_budget=token_budget), indent=4)
+        query_reponse = response["choices"][0]
 
         return query_reponse["message"]["content"], debug
 
 
-    def _make_prompt_string_replacements(self, templated_prompt: str, replacement_values: dict[str, str]) -> str:
-        for key, value in replacement_values.items():
-            templated_prompt = templated_prompt.replace(f"{{{{{key}}}}}", value)
-        # assert there is no more replacemnt pattern ({{\w}}) substrings in tempalted_prompt
-        if re.search('{{[a-zA-Z0-9-_\\s]+}}', templated_prompt):
-            raise ValueError(f"Found more replacement patterns in templated_prompt: {templated_prompt}")
+    def stream_llm_response(self, url: str, temprature: float, prompt_template: PromptTemplate,
+                            prompt_replacements: Mapping[str, str]) -> Iterator[tuple[str, str]]:
+        """streaming variant of get_llm_response
+
+        Yields `(delta, debug)` tuples; `debug` is empty until the final item, which carries
+        the debug JSON assembled from the whole stream and an empty delta.
+        """
+        yield from self.stream_llm_response_for_page(self.read_webpage(url), temprature, prompt_template,
+                                                     prompt_replacements)
+
+
+    def stream_llm_response_for_page(self, webpage: Webpage, temprature: float, prompt_template: PromptTemplate,
+                                     prompt_replacements: Mapping[str, str]) -> Iterator[tuple[str, str]]:
+        """stream_llm_response for a page that has already been read"""
+        messages, token_budget = self._make_messages(webpage, prompt_template, prompt_replacements)
+        cache_key = None
+        if self.response_cache and ResponseCache.is_cacheable(temprature):
+            cache_key = ResponseCache.make_key(self.OPENAI_LLM, messages, temprature, self.resp_max_tokens)  # type: ignore
+            cached_response = self.response_cache.get(cache_key)
+            CACHE_REQUESTS.inc(cache="llm_response", result="hit" if cached_response else "miss")
+            if cached_response:
+                logger.info(f"llm response cache hit: {cache_key}")
+                yield cached_response["choices"][0]["message"]["content"], ""
+                yield "", json.dumps(dict(cached_response, cache_hit=True, token_budget=token_budget), indent=4)
+                return
+
+        estimated_tokens = self._estimate_tokens(messages)
+        start = time.perf_counter()
+        chunks, endpoint = self._create_chat_completion(messages, temprature, stream=True)
+        content_parts: list[str] = []
+        response: dict[str, Any] = {}
+        finish_reason = None
+        try:
+            for chunk in chunks:
+                response = response or {key: chunk[key] for key in ("id", "created", "model")}
+                choice = chunk["choices"][0]
+                delta = choice["delta"].get("content")
+                finish_reason = choice.get("finish_reason") or finish_reason
+                if delta:
+                    if not content_parts:
+                        STAGE_SECONDS.observe(time.perf_counter() - start, stage="llm_first_token")
+                    content_parts.append(delta)
+                    yield delta, ""
+        except RETRYABLE_ERRORS as e:
+            # the part of the response already yielded can't be taken back, so the stream is not retried
+            endpoint.circuit_breaker.record_failure()
+            ERRORS.inc(stage="llm")
+            logger.error(f"llm endpoint {endpoint.name} response stream failed: {str(e)}")
+            raise RuntimeError(f"The llm response stream was interrupted: {str(e)}") from e
+
+        content = "".join(content_parts)
+        llm_seconds = time.perf_counter() - start
+        STAGE_SECONDS.observe(llm_seconds, stage="llm")
+        # streamed responses carry no usage, count the tokens ourselves
+        self._record_usage(endpoint, sum(self.token_budget.count_tokens(message["content"]) for message in messages),
+                           self.token_budget.count_tokens(content), llm_seconds, stream=True)
+        response.update({
+            "object": "chat.completion",
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content},
+                         "finish_reason": finish_reason}],
+            "stream_chunks": len(content_parts),
+        })
+        endpoint.rate_limiter.reconcile(estimated_tokens, estimated_tokens - self.resp_max_tokens + len(content) // 4)
+        # responses of a fallback endpoint are not cached as the primary model's
+        if cache_key and endpoint is self.endpoints[0]:
+            self.response_cache.put(cache_key, response)  # type: ignore
+        yield "", json.dumps(dict(response, cache_hit=False, token_budget=token_budget), indent=4)
+
+
+    def read_webpage(self, url: str) -> Webpage:
+        webpage = self.webpage_reader.read(url)
+        if not webpage:
+            raise ValueError(f"Could not read the content of page: {url}")
+        return webpage
+
+
+    def _make_messages(self, webpage: Webpage, prompt_template: PromptTemplate,
+                       prompt_replacements: Mapping[str, str]) -> tuple[list[dict[str, str]], dict[str, Any]]:
+        """renders the request messages for the page, returns them with the token budget details"""
+        user_message = f"Link: {webpage.link}"
+        page_content, token_budget = self._fit_page_content(webpage.link, webpage.content, prompt_template,
+                                                            prompt_replacements, user_message)
+        if webpage.truncated:
+            token_budget["page_truncated"] = True
+        # a context of its own layered over the request's values, so the pages analyzed in parallel
+        # with the same replacements never see each other's content
+        with STAGE_SECONDS.time(stage="render"):
+            system_prompt = prompt_template.render(render_context(prompt_replacements, web_page_content=page_content))
+        return [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_message},
+        ], token_budget
+
+
+    def _fit_page_content(self, url: str, page_content: str, prompt_template: PromptTemplate,
+                          prompt_replacements: Mapping[str, str], user_message: str) -> tuple[str, dict[str, Any]]:
+        """returns page content that fits the context window next to the prompt and the response,
+        condensing oversized pages with a map-reduce over chunks of the content"""
+        empty_prompt = prompt_template.render(render_context(prompt_replacements, web_page_content=""))
+        prompt_overhead = self.token_budget.count_tokens(empty_prompt) + self.token_budget.count_tokens(user_message)
+        available_tokens = self.token_budget.available_tokens(prompt_overhead, self.resp_max_tokens)
+        content_tokens = self.token_budget.count_tokens(page_content)
+        token_budget: dict[str, Any] = {"context_window": self.token_budget.context_window,
+                                        "available_tokens": available_tokens, "content_tokens": content_tokens}
+        if content_tokens <= available_tokens:
+            return page_content, token_budget
+        if available_tokens < self.MIN_CONTENT_TOKENS:
+            raise ValueError(f"The prompt and max response tokens leave only {available_tokens} tokens "
+                             f"for the page content in the {self.token_budget.context_window} token context window")
+
+        logger.info(f"Page content of {content_tokens} tokens exceeds the {available_tokens} available, "
+                    f"condensing with map-reduce: {url}")
+        map_overhead = self.token_budget.count_tokens(self.MAP_CHUNK_PROMPT) + self.token_budget.count_tokens(user_message)
+        chunk_tokens = min(self.LLM_MAP_CHUNK_TOKENS,
+                           self.token_budget.available_tokens(map_overhead, self.resp_max_tokens))
+        chunk_counts = []
+        for _ in range(self.MAX_MAP_REDUCE_ROUNDS):
+            chunks = self.token_budget.split_into_chunks(page_content, chunk_tokens)
+            chunk_counts.append(len(chunks))
+            with ThreadPoolExecutor(max_workers=self.LLM_MAP_MAX_CONCURRENT_REQUESTS) as executor:
+                notes = list(executor.map(
+                    lambda numbered_chunk: self._map_chunk(user_message, *numbered_chunk, len(chunks)),
+                    enumerate(chunks, start=1),
+                ))
+            page_content = "\n\n".join(notes)
+            if self.token_budget.count_tokens(page_content) <= available_tokens:
+                break
+        else:
+            logger.warning(f"Condensed page content still exceeds the token budget, truncating: {url}")
+            page_content = self.token_budget.truncate(page_content, available_tokens)
+        token_budget["map_reduce_chunks"] = chunk_counts
+        return page_content, token_budget
+
+
+    def _map_chunk(self, user_message: str, chunk_number: int, chunk: str, chunk_count: int) -> str:
+        map_prompt = self.MAP_CHUNK_PROMPT.format(chunk_number=chunk_number, chunk_count=chunk_count)
+        messages = [
+            {"role": "system", "content": map_prompt + chunk},
+            {"role": "user", "content": user_message},
+        ]
+        response, _ = self._get_chat_completion(messages, temprature=0)
+        return response["choices"][0]["message"]["content"]
+
+
+    def _get_chat_completion(self, messages: list[dict[str, str]], temprature: float) -> tuple[dict[str, Any], bool]:
+        """returns the completion for the messages and whether it was served from the response cache"""
+        if not self.response_cache or not ResponseCache.is_cacheable(temprature):
+            return self._create_chat_completion(messages, temprature)[0], False
+
+        cache_key = ResponseCache.make_key(self.OPENAI_LLM, messages, temprature, self.resp_max_tokens)  # type: ignore
+        cached_response = self.response_cache.get(cache_key)
+        CACHE_REQUESTS.inc(cache="llm_response", result="hit" if cached_response else "miss")
+        if cached_response:
+            logger.info(f"llm response cache hit: {cache_key}")
+            return cached_response, True
+        response, endpoint = self._create_chat_completion(messages, temprature)
+        # responses of a fallback endpoint are not cached as the primary model's
+        if endpoint is self.endpoints[0]:
+            self.response_cache.put(cache_key, response)
+        return response, False
+
+
+    def _estimate_tokens(self, messages: list[dict[str, str]]) -> int:
+        # rough estimate (~4 chars per token) of what a request will count against the TPM quota
+        return sum(len(message["content"]) for message in messages) // 4 + self.resp_max_tokens
+
+
+    def _create_chat_completion(self, messages: list[dict[str, str]], temprature: float,
+                                stream: bool = False) -> tuple[Any, LlmEndpoint]:
+        """sends the request to the first endpoint that is available, failing over to the next
+        endpoint when one keeps failing or its circuit breaker is open
+
+        Returns the completion, or the iterator of completion chunks when `stream` is set, and the
+        endpoint that served it.
+        """
+        estimated_tokens = self._estimate_tokens(messages)
+        last_error: Exception | None = None
+        for index, endpoint in enumerate(self.endpoints):
+            # the last endpoint gets all the retries and waits as long as it takes, the others fail over quickly
+            is_last = index == len(self.endpoints) - 1
+            max_retries = self.LLM_API_MAX_RETRIES if is_last else self.LLM_API_FAILOVER_RETRIES
+            max_wait_seconds = None if is_last else self.LLM_API_FAILOVER_MAX_WAIT_SECONDS
+            # checked before the circuit breaker, which lets a trial request through once it is asked
+            if max_wait_seconds is not None and \
+                    endpoint.rate_limiter.seconds_until_available(estimated_tokens) > max_wait_seconds:
+                logger.warning(f"llm endpoint {endpoint.name} is throttled, skipping it")
+                continue
+            if not endpoint.circuit_breaker.allow_request():
+                logger.warning(f"llm endpoint {endpoint.name} circuit breaker is open, skipping it")
+                continue
+            is_trial = endpoint.circuit_breaker.state == CircuitBreaker.HALF_OPEN
+            try:
+                return self._create_with_retries(endpoint, messages, temprature, stream, estimated_tokens,
+                                                 max_retries, max_wait_seconds), endpoint
+            except RETRYABLE_ERRORS as e:
+                last_error = e
+                if not is_last:
+                    logger.warning(f"llm endpoint {endpoint.name} failed, failing over: {str(e)}")
+            except BaseException:
+                # errors that say nothing about the endpoint record no outcome, the trial must not stay in flight
+                if is_trial:
+                    endpoint.circuit_breaker.release()
+                raise
+        if last_error:
+            raise last_error
+        raise RuntimeError("No llm endpoint available, the circuit breakers of all endpoints are open")
+
+
+    def _create_with_retries(self, endpoint: LlmEndpoint, messages: list[dict[str, str]], temprature: float,
+                             stream: bool, estimated_tokens: int, max_retries: int,
+                             max_wait_seconds: float | None = None) -> Any:
+        """sends the request to the endpoint within its rate limits, retrying transient errors with backoff
+
+        Gives up early when the circuit breaker opens or the backoff would exceed `max_wait_seconds`.
+        """
+        attempt = 0
+        while True:
+            with STAGE_SECONDS.time(stage="rate_limit_wait"):
+                endpoint.rate_limiter.acquire(estimated_tokens)
+            try:
+                # for streams this only covers the wait for the response to start
+                with STAGE_SECONDS.time(stage="llm_request" if stream else "llm") as llm_timer:
+                    response = endpoint.create_chat_completion(messages, temprature, self.resp_max_tokens, stream)
+                    if stream:
+                        # errors before the first chunk are retried like errors of the request
+                        response = self._start_stream(response)
+            except RETRYABLE_ERRORS as e:
+                endpoint.circuit_breaker.record_failure()
+                ERRORS.inc(stage="llm_rate_limit" if isinstance(e, openai.error.RateLimitError) else "llm")
+                if attempt == max_retries or endpoint.circuit_breaker.state == CircuitBreaker.OPEN:
+                    raise
+                delay = endpoint.rate_limiter.backoff(e.headers, attempt)
+                if max_wait_seconds is not None and delay > max_wait_seconds:
+                    raise
+                logger.warning(f"llm endpoint {endpoint.name} request failed, retrying in {delay:.1f} seconds: {str(e)}")
+                attempt += 1
+                continue
+            except openai.error.OpenAIError:
+                # the endpoint is up, the request itself is bad
+                endpoint.circuit_breaker.record_success()
+                ERRORS.inc(stage="llm")
+                raise
+            endpoint.circuit_breaker.record_success()
+            if not stream:
+                usage = response["usage"]  # type: ignore
+                endpoint.rate_limiter.reconcile(estimated_tokens, usage["total_tokens"])
+                self._record_usage(endpoint, usage["prompt_tokens"], usage["completion_tokens"], llm_timer.seconds,
+                                   stream=False)
+            return response
+
+
+    @staticmethod
+    def _start_stream(chunks: Iterator[Any]) -> Iterator[Any]:
+        """waits for the first chunk of the stream, returns the stream with that chunk put back"""
+        chunks = iter(chunks)
+        first_chunk = next(chunks, None)
+        return chunks if first_chunk is None else itertools.chain([first_chunk], chunks)
+
+
+    def _create_endpoints(self, openai_api_key: str) -> list[LlmEndpoint]:
+        timeout_seconds = float(os.getenv("LLM_API_TIMEOUT_SECONDS", 60))
+        failure_threshold = int(os.getenv("LLM_CIRCUIT_BREAKER_FAILURES", 5))
+        reset_timeout_seconds = float(os.getenv("LLM_CIRCUIT_BREAKER_RESET_SECONDS", 30))
+        endpoints = [LlmEndpoint(
+            "primary", self.OPENAI_LLM, openai_api_key, os.getenv("OPENAI_API_BASE"),  # type: ignore
+            timeout_seconds=timeout_seconds,
+            requests_per_minute=float(os.getenv("LLM_API_REQUESTS_PER_MINUTE", 200)),
+            tokens_per_minute=float(os.getenv("LLM_API_TOKENS_PER_MINUTE", 10000)),
+            circuit_breaker=CircuitBreaker(failure_threshold, reset_timeout_seconds),
+            cost_per_1k_tokens=self._parse_cost(os.getenv("OPENAI_LLM_COST_PER_1K_TOKENS")),
+        )]
+        fallback_model = os.getenv("LLM_FALLBACK_MODEL")
+        if fallback_model:
+            fallback_api_base = os.getenv("LLM_FALLBACK_API_BASE")
+            # local servers don't check the key, but the openai client needs one
+            fallback_api_key = os.getenv("LLM_FALLBACK_API_KEY", "no-key" if fallback_api_base else openai_api_key)
+            endpoints.append(LlmEndpoint(
+                "fallback", fallback_model, fallback_api_key, fallback_api_base,
+                timeout_seconds=timeout_seconds,
+                requests_per_minute=float(os.getenv("LLM_FALLBACK_REQUESTS_PER_MINUTE", 200)),
+                tokens_per_minute=float(os.getenv("LLM_FALLBACK_TOKENS_PER_MINUTE", 10000)),
+                circuit_breaker=CircuitBreaker(failure_threshold, reset_timeout_seconds),
+                cost_per_1k_tokens=self._parse_cost(os.getenv("LLM_FALLBACK_COST_PER_1K_TOKENS")),
+            ))
+        return endpoints
+
+
+    def _parse_cost(self, cost_per_1k_tokens: str | None) -> tuple[float, float] | None:
+        # "prompt,completion" USD per 1K tokens, for models without built in pricing
+        if not cost_per_1k_tokens:
+            return None
+        prompt_cost, completion_cost = (float(cost) for cost in cost_per_1k_tokens.split(","))
+        return prompt_cost, completion_cost
+
 
-        return templated_prompt
+    def _record_usage(self, endpoint: LlmEndpoint, prompt_tokens: int, completion_tokens: int, llm_seconds: float,
+                      stream: bool) -> None:
+        cost = get_llm_cost(endpoint.model, prompt_tokens, completion_tokens, endpoint.cost_per_1k_tokens)
+        LLM_TOKENS.inc(prompt_tokens, model=endpoint.model, kind="prompt")
+        LLM_TOKENS.inc(completion_tokens, model=endpoint.model, kind="completion")
+        LLM_COST.inc(cost, model=endpoint.model)
+        logger.info(f"llm completion of {prompt_tokens} prompt and {completion_tokens} completion tokens "
+                    f"in {llm_seconds:.2f}s, ${cost:.4f}", extra={
+                        "metrics": {"event": "llm_completion", "endpoint": endpoint.name, "model": endpoint.model,
+                                    "stream": stream,
+                                    "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                                    "cost_dollars": cost, "llm_seconds": llm_seconds}})
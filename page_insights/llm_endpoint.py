@@ -0,0 +1,115 @@
+"""
+The chat completion endpoints the LlmAdapter sends requests to.
+
+An endpoint is a model on an OpenAI compatible API: the OpenAI API itself, or a local server
+like llama.cpp's.  Each endpoint has its own credentials, timeout, client side rate limits and
+a circuit breaker, so when one endpoint is failing the adapter stops sending it requests and
+fails over to the next one instead of waiting on it.
+"""
+import logging
+import threading
+import time
+from typing import Any
+
+import openai
+
+from page_insights.rate_limiter import RateLimiter
+
+logger = logging.getLogger(__name__)
+
+# errors worth retrying or failing over on, other errors (invalid request, authentication) are not
+# going to succeed on a retry
+RETRYABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+    openai.error.APIError,
+    openai.error.Timeout,
+    openai.error.TryAgain,
+    openai.error.APIConnectionError,
+)
+
+
+class CircuitBreaker(object):
+    """
+    Opens after `failure_threshold` consecutive failures, rejecting requests until
+    `reset_timeout_seconds` have passed.  Then a single trial request is let through (half open):
+    its success closes the circuit, its failure opens it again.  A trial that ends without an
+    outcome is released, so the next request is the trial.
+    """
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, failure_threshold: int, reset_timeout_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout_seconds = reset_timeout_seconds
+        self.state = self.CLOSED
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = 0.0
+
+    def allow_request(self) -> bool:
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout_seconds:
+                self.state = self.HALF_OPEN
+                return True
+            # open, or half open with the trial request in flight
+            return False
+
+    def release(self) -> None:
+        """ends a request that was let through without recording an outcome, e.g. it raised an
+        error that says nothing about the endpoint"""
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.state = self.CLOSED
+            self._failures = 0
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+
+
+class LlmEndpoint(object):
+
+    def __init__(self, name: str, model: str, api_key: str, api_base: str | None = None,
+                 timeout_seconds: float = 60.0, requests_per_minute: float = 200,
+                 tokens_per_minute: float = 10000, circuit_breaker: CircuitBreaker | None = None,
+                 cost_per_1k_tokens: tuple[float, float] | None = None):
+        self.name = name
+        self.model = model
+        self.api_key = api_key
+        # None uses the openai client's default, OPENAI_API_BASE or the OpenAI API
+        self.api_base = api_base
+        self.timeout_seconds = timeout_seconds
+        self.rate_limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+        self.circuit_breaker = circuit_breaker or CircuitBreaker(5, 30.0)
+        # "prompt,completion" USD per 1K tokens, None to use the built in pricing of the model
+        self.cost_per_1k_tokens = cost_per_1k_tokens
+        logger.info(f"llm endpoint {name}: {model} at {api_base or openai.api_base}")
+
+    def create_chat_completion(self, messages: list[dict[str, str]], temprature: float, max_tokens: int,
+                               stream: bool = False) -> Any:
+        """a single request, the caller handles rate limits, retries and failover
+
+        The openai client keeps a pooled HTTP session per thread, connections to the endpoint
+        are reused by the later requests of the same thread, e.g. the Summarizer's worker threads.
+        """
+        request: dict[str, Any] = dict(
+            model=self.model,
+            messages=messages,
+            temperature=temprature,
+            stream=stream,
+            max_tokens=max_tokens,
+            api_key=self.api_key,
+            request_timeout=self.timeout_seconds,
+        )
+        if self.api_base:
+            request["api_base"] = self.api_base
+        return openai.ChatCompletion.create(**request)
@@ -0,0 +1,235 @@
+"""
+In-process metrics for the analysis pipeline.
+
+The readers, the LlmAdapter and the Summarizer record per-stage latencies, token usage, cost,
+cache hits and errors in the process wide `metrics` registry.  Latencies are kept as summaries
+over a sliding window of recent observations, which gives the p50/p95/p99 used to tune
+concurrency and token budgets.  The registry can be scraped in the Prometheus text format from
+a small HTTP endpoint started with `metrics.start_http_server()`.
+"""
+import logging
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any
+
+logger = logging.getLogger(__name__)
+
+LabelValues = tuple[str, ...]
+
+
+class Counter(object):
+
+    TYPE = "counter"
+
+    def __init__(self, name: str, help: str, label_names: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self._lock = threading.Lock()
+        self._values: dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = _label_values(self.label_names, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels: str) -> float:
+        with self._lock:
+            return self._values.get(_label_values(self.label_names, labels), 0.0)
+
+    def snapshot(self) -> dict[str, float]:
+        with self._lock:
+            return {",".join(key): value for key, value in self._values.items()}
+
+    def _render(self) -> list[str]:
+        with self._lock:
+            return [f"{self.name}{_format_labels(self.label_names, key)} {value}"
+                    for key, value in sorted(self._values.items())]
+
+
+class LatencySummary(object):
+    """latencies in seconds, with quantiles computed over the most recent WINDOW_SIZE observations"""
+
+    TYPE = "summary"
+    QUANTILES = (0.5, 0.95, 0.99)
+    WINDOW_SIZE = 1024
+
+    def __init__(self, name: str, help: str, label_names: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self._lock = threading.Lock()
+        self._windows: dict[LabelValues, deque[float]] = {}
+        self._counts: dict[LabelValues, int] = {}
+        self._sums: dict[LabelValues, float] = {}
+
+    def observe(self, seconds: float, **labels: str) -> None:
+        key = _label_values(self.label_names, labels)
+        with self._lock:
+            if key not in self._windows:
+                self._windows[key] = deque(maxlen=self.WINDOW_SIZE)
+                self._counts[key] = 0
+                self._sums[key] = 0.0
+            self._windows[key].append(seconds)
+            self._counts[key] += 1
+            self._sums[key] += seconds
+
+    def time(self, **labels: str) -> "Timer":
+        """context manager observing the duration of the block, also when it raises"""
+        return Timer(self, labels)
+
+    def quantiles(self, **labels: str) -> dict[float, float]:
+        with self._lock:
+            window = self._windows.get(_label_values(self.label_names, labels))
+            return self._quantiles(window) if window else {}
+
+    def snapshot(self) -> dict[str, dict[str, float]]:
+        with self._lock:
+            return {
+                ",".join(key): dict(
+                    {f"p{int(quantile * 100)}": value for quantile, value in self._quantiles(window).items()},
+                    count=self._counts[key], sum=self._sums[key])
+                for key, window in self._windows.items()
+            }
+
+    def _quantiles(self, window: deque[float]) -> dict[float, float]:
+        # nearest-rank quantiles
+        ordered = sorted(window)
+        return {quantile: ordered[min(len(ordered) - 1, int(quantile * len(ordered)))] for quantile in self.QUANTILES}
+
+    def _render(self) -> list[str]:
+        lines = []
+        with self._lock:
+            for key, window in sorted(self._windows.items()):
+                for quantile, value in self._quantiles(window).items():
+                    labels = _format_labels(self.label_names + ("quantile",), key + (str(quantile),))
+                    lines.append(f"{self.name}{labels} {value}")
+                labels = _format_labels(self.label_names, key)
+                lines.append(f"{self.name}_sum{labels} {self._sums[key]}")
+                lines.append(f"{self.name}_count{labels} {self._counts[key]}")
+        return lines
+
+
+class Timer(object):
+
+    def __init__(self, summary: LatencySummary, labels: dict[str, str]):
+        self.summary = summary
+        self.labels = labels
+        self.seconds = 0.0
+
+    def __enter__(self) -> "Timer":
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.seconds = time.perf_counter() - self._start
+        self.summary.observe(self.seconds, **self.labels)
+
+
+class MetricsRegistry(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics: dict[str, Counter | LatencySummary] = {}
+        self._server: ThreadingHTTPServer | None = None
+
+    def counter(self, name: str, help: str, label_names: tuple[str, ...] = ()) -> Counter:
+        return self._register(Counter(name, help, label_names))  # type: ignore
+
+    def summary(self, name: str, help: str, label_names: tuple[str, ...] = ()) -> LatencySummary:
+        return self._register(LatencySummary(name, help, label_names))  # type: ignore
+
+    def snapshot(self) -> dict[str, Any]:
+        """the current values of all metrics, keyed by metric name and then by the comma joined label values"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {metric.name: metric.snapshot() for metric in metrics}
+
+    def render_prometheus(self) -> str:
+        """all metrics in the Prometheus text exposition format"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.TYPE}")
+            lines.extend(metric._render())
+        return "\n".join(lines) + "\n"
+
+    def start_http_server(self, port: int, host: str = "127.0.0.1") -> None:
+        """serves the metrics at http://host:port/metrics from a background thread"""
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # scrapes are frequent, keep them out of the application log
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=self._server.serve_forever, name="metrics-server", daemon=True).start()
+        logger.info(f"Serving metrics on http://{host}:{self._server.server_port}/metrics")
+
+    def _register(self, metric: Counter | LatencySummary) -> Counter | LatencySummary:
+        # registering an existing name returns the existing metric, so modules can declare what they use
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+
+def _label_values(label_names: tuple[str, ...], labels: dict[str, str]) -> LabelValues:
+    if labels.keys() != set(label_names):
+        raise ValueError(f"Expected labels {label_names}, got {tuple(labels.keys())}")
+    return tuple(str(labels[name]) for name in label_names)
+
+
+def _format_labels(label_names: tuple[str, ...], label_values: LabelValues) -> str:
+    if not label_names:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for value in label_values)
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(label_names, escaped)) + "}"
+
+
+# USD per 1K prompt and completion tokens, looked up by longest model name prefix
+MODEL_COST_PER_1K_TOKENS: dict[str, tuple[float, float]] = {
+    "gpt-3.5-turbo": (0.0015, 0.002),
+    "gpt-3.5-turbo-16k": (0.003, 0.004),
+    "gpt-4": (0.03, 0.06),
+    "gpt-4-32k": (0.06, 0.12),
+}
+
+
+def get_llm_cost(model: str, prompt_tokens: int, completion_tokens: int,
+                 cost_per_1k_tokens: tuple[float, float] | None = None) -> float:
+    """cost in USD of a completion, 0 for models without known pricing"""
+    if cost_per_1k_tokens is None:
+        prefixes = [prefix for prefix in MODEL_COST_PER_1K_TOKENS if model.startswith(prefix)]
+        if not prefixes:
+            return 0.0
+        cost_per_1k_tokens = MODEL_COST_PER_1K_TOKENS[max(prefixes, key=len)]
+    return (prompt_tokens * cost_per_1k_tokens[0] + completion_tokens * cost_per_1k_tokens[1]) / 1000
+
+
+metrics = MetricsRegistry()
+
+STAGE_SECONDS = metrics.summary(
+    "page_insights_stage_seconds", "Latency of each stage of the analysis pipeline", ("stage",))
+LLM_TOKENS = metrics.counter(
+    "page_insights_llm_tokens_total", "Tokens sent to and received from the llm", ("model", "kind"))
+LLM_COST = metrics.counter(
+    "page_insights_llm_cost_dollars_total", "Estimated llm cost in USD", ("model",))
+CACHE_REQUESTS = metrics.counter(
+    "page_insights_cache_requests_total", "Page and llm response cache lookups by result", ("cache", "result"))
+ERRORS = metrics.counter(
+    "page_insights_errors_total", "Errors by pipeline stage", ("stage",))
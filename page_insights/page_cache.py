@@ -0,0 +1,211 @@
+"""
+Persistent cache of fetched web pages.
+
+Pages are indexed by their normalized URL and the raw HTML / extracted text are stored
+content-addressed (by sha256 of the HTML), so mirrors of the same document share one copy.
+A small in-memory LRU tier holds the hot entries, the on-disk tier is a SQLite database in
+the assets folder which is evicted least-recently-used once it grows past its size bound.
+Access times of cache hits are kept in memory and written in batches, so hits don't write
+to the database.
+"""
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from pathlib import Path
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+logger = logging.getLogger(__name__)
+
+
+class CachedPage(object):
+
+    def __init__(self, url: str, html: bytes, text: str, etag: str | None, last_modified: str | None,
+                 fetched_at: float):
+        self.url = url
+        self.html = html
+        self.text = text
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched_at = fetched_at
+
+
+class PageCache(object):
+    PAGE_CACHE_FOLDER = "page_cache"
+    PAGE_CACHE_DB_FILE_NAME = "page_cache.sqlite3"
+    DEFAULT_PORTS = {"http": 80, "https": 443}
+    # max seconds access times of cache hits wait in memory before they are written
+    ACCESS_FLUSH_SECONDS = 30
+
+    def __init__(self, assets_dir: Path):
+        self.PAGE_CACHE_TTL_SECONDS = float(os.getenv("PAGE_CACHE_TTL_SECONDS", 3600))
+        self.PAGE_CACHE_MAX_BYTES = int(float(os.getenv("PAGE_CACHE_MAX_MB", 256)) * 1024 * 1024)
+        self.PAGE_CACHE_MEMORY_ENTRIES = int(os.getenv("PAGE_CACHE_MEMORY_ENTRIES", 64))
+        self.cache_folder_path = assets_dir.joinpath(self.PAGE_CACHE_FOLDER)
+        self.cache_folder_path.mkdir(parents=True, exist_ok=True)
+        self.db_file_path = self.cache_folder_path.joinpath(self.PAGE_CACHE_DB_FILE_NAME)
+        logger.info(f"Page cache path: {self.db_file_path}, ttl: {self.PAGE_CACHE_TTL_SECONDS}s")
+
+        self._lock = threading.Lock()
+        self._memory: OrderedDict[str, CachedPage] = OrderedDict()
+        self._pending_access: dict[str, float] = {}
+        self._access_flushed_at = time.monotonic()
+        self.stats: dict[str, int] = {"memory_hits": 0, "disk_hits": 0, "misses": 0,
+                                      "revalidations": 0, "evictions": 0}
+        self._db = sqlite3.connect(self.db_file_path, check_same_thread=False)
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS pages (
+                url_key TEXT PRIMARY KEY,
+                url TEXT NOT NULL,
+                content_hash TEXT NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                fetched_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS pages_last_access ON pages (last_access);
+            CREATE INDEX IF NOT EXISTS pages_content_hash ON pages (content_hash);
+            CREATE TABLE IF NOT EXISTS contents (
+                content_hash TEXT PRIMARY KEY,
+                html BLOB NOT NULL,
+                text TEXT NOT NULL,
+                size INTEGER NOT NULL
+            );
+        """)
+
+    @classmethod
+    def normalize_url(cls, url: str) -> str:
+        """canonical form of a url: lower-cased scheme/host, no default port, fragment or
+        trailing slash, and sorted query parameters"""
+        parts = urlsplit(url.strip())
+        scheme = parts.scheme.lower()
+        host = (parts.hostname or "").lower()
+        if parts.port and parts.port != cls.DEFAULT_PORTS.get(scheme):
+            host = f"{host}:{parts.port}"
+        path = parts.path.rstrip("/") or "/"
+        query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+        return urlunsplit((scheme, host, path, query, ""))
+
+    def get(self, url: str) -> CachedPage | None:
+        url_key = self._url_key(url)
+        with self._lock:
+            page = self._memory.get(url_key)
+            if page:
+                self._memory.move_to_end(url_key)
+                self.stats["memory_hits"] += 1
+            else:
+                page = self._load(url_key)
+                if not page:
+                    self.stats["misses"] += 1
+                    return None
+                self.stats["disk_hits"] += 1
+                self._remember(url_key, page)
+            self._pending_access[url_key] = time.time()
+            if time.monotonic() - self._access_flushed_at >= self.ACCESS_FLUSH_SECONDS:
+                self._flush_access()
+                self._db.commit()
+            return page
+
+    def is_fresh(self, page: CachedPage) -> bool:
+        return time.time() - page.fetched_at < self.PAGE_CACHE_TTL_SECONDS
+
+    @staticmethod
+    def conditional_headers(page: CachedPage | None) -> dict[str, str]:
+        """request headers to revalidate a cached page with the site"""
+        headers = {}
+        if page and page.etag:
+            headers["If-None-Match"] = page.etag
+        if page and page.last_modified:
+            headers["If-Modified-Since"] = page.last_modified
+        return headers
+
+    def put(self, url: str, html: bytes, text: str, etag: str | None = None,
+            last_modified: str | None = None) -> CachedPage:
+        url_key = self._url_key(url)
+        content_hash = hashlib.sha256(html).hexdigest()
+        page = CachedPage(url, html, text, etag, last_modified, time.time())
+        compressed_html = zlib.compress(html)
+        with self._lock:
+            self._db.execute(
+                "INSERT OR IGNORE INTO contents (content_hash, html, text, size) VALUES (?, ?, ?, ?)",
+                (content_hash, compressed_html, text, len(compressed_html) + len(text.encode())),
+            )
+            self._db.execute(
+                "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (url_key, url, content_hash, etag, last_modified, page.fetched_at, page.fetched_at),
+            )
+            self._pending_access.pop(url_key, None)
+            self._flush_access()
+            self._evict()
+            self._db.commit()
+            self._remember(url_key, page)
+        return page
+
+    def mark_revalidated(self, url: str, etag: str | None = None, last_modified: str | None = None) -> None:
+        """restarts the TTL of a cached page after the server answered `304 Not Modified`"""
+        url_key = self._url_key(url)
+        now = time.time()
+        with self._lock:
+            self.stats["revalidations"] += 1
+            self._db.execute(
+                "UPDATE pages SET fetched_at = ?, etag = COALESCE(?, etag), "
+                "last_modified = COALESCE(?, last_modified) WHERE url_key = ?",
+                (now, etag, last_modified, url_key),
+            )
+            self._db.commit()
+            page = self._memory.get(url_key)
+            if page:
+                page.fetched_at = now
+                page.etag = etag or page.etag
+                page.last_modified = last_modified or page.last_modified
+
+    def _url_key(self, url: str) -> str:
+        return hashlib.sha256(self.normalize_url(url).encode()).hexdigest()
+
+    def _load(self, url_key: str) -> CachedPage | None:
+        row = self._db.execute(
+            "SELECT pages.url, contents.html, contents.text, pages.etag, pages.last_modified, pages.fetched_at "
+            "FROM pages JOIN contents ON pages.content_hash = contents.content_hash WHERE pages.url_key = ?",
+            (url_key,),
+        ).fetchone()
+        if not row:
+            return None
+        url, compressed_html, text, etag, last_modified, fetched_at = row
+        return CachedPage(url, zlib.decompress(compressed_html), text, etag, last_modified, fetched_at)
+
+    def _remember(self, url_key: str, page: CachedPage) -> None:
+        self._memory[url_key] = page
+        self._memory.move_to_end(url_key)
+        while len(self._memory) > self.PAGE_CACHE_MEMORY_ENTRIES:
+            self._memory.popitem(last=False)
+
+    def _flush_access(self) -> None:
+        # eviction picks pages by last access, write the pending access times before it runs
+        if self._pending_access:
+            self._db.executemany("UPDATE pages SET last_access = ? WHERE url_key = ?",
+                                 [(last_access, url_key) for url_key, last_access in self._pending_access.items()])
+            self._pending_access.clear()
+        self._access_flushed_at = time.monotonic()
+
+    def _evict(self) -> None:
+        # drop the least recently used pages until the stored content fits in the size bound
+        total_size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM contents").fetchone()[0]
+        while total_size > self.PAGE_CACHE_MAX_BYTES:
+            row = self._db.execute("SELECT url_key, content_hash FROM pages ORDER BY last_access LIMIT 1").fetchone()
+            if not row:
+                break
+            url_key, content_hash = row
+            self._db.execute("DELETE FROM pages WHERE url_key = ?", (url_key,))
+            self._memory.pop(url_key, None)
+            self.stats["evictions"] += 1
+            still_referenced = self._db.execute(
+                "SELECT 1 FROM pages WHERE content_hash = ? LIMIT 1", (content_hash,)).fetchone()
+            if not still_referenced:
+                size = self._db.execute(
+                    "SELECT size FROM contents WHERE content_hash = ?", (content_hash,)).fetchone()[0]
+                self._db.execute("DELETE FROM contents WHERE content_hash = ?", (content_hash,))
+                total_size -= size
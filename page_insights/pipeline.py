@@ -0,0 +1,149 @@
+"""
+The analysis pipeline without the UI, for scripts and scheduled batch runs.
+
+    pipeline = AnalysisPipeline(Path("assets"), os.getenv("OPENAI_API_KEY"))
+    analyses = list(pipeline.analyze_links(links, "default-prompt"))
+    research_id = pipeline.save_research("Weekly reading", analyses)
+    analyses = list(pipeline.crawl_and_analyze("https://example.com/docs/", "default-prompt"))
+    pipeline.close()
+
+Uses the same prompts, caches and saved research in the assets folder as the app, and the same
+settings from the environment.
+"""
+import logging
+import os
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Iterable, Iterator
+
+from page_insights.async_webpage_reader import AsyncWebpageReader
+from page_insights.dedup import DedupSession
+from page_insights.llm_adapter import LlmAdapter
+from page_insights.page_cache import PageCache
+from page_insights.prompts_manager import PromptsManager
+from page_insights.research_manager import ResearchManager
+from page_insights.response_cache import ResponseCache
+from page_insights.site_crawler import SiteCrawler
+from page_insights.summarizer import Summarizer
+from page_insights.webpage import Webpage
+from page_insights.webpage_reader import WebpageReader
+
+logger = logging.getLogger(__name__)
+
+
+class AnalysisPipeline(object):
+
+    def __init__(self, assets_dir: Path, openai_key: str, max_concurrent_requests: int | None = None):
+        self.assets_dir = assets_dir
+        self.prompts_manager = PromptsManager(assets_dir)
+        page_cache = PageCache(assets_dir)
+        response_cache_enabled = os.getenv("LLM_RESPONSE_CACHE_ENABLED", "false").lower() == "true"
+        self.llm_adapter = LlmAdapter(openai_key, resp_max_tokens=1024, webpage_reader=WebpageReader(page_cache),
+                                      response_cache=ResponseCache(assets_dir) if response_cache_enabled else None)
+        # near duplicates of the pages of saved research reuse their analyses
+        self.research_manager = ResearchManager(assets_dir)
+        # pages of a list of links are all downloaded up front, while the first ones are analyzed
+        self.async_webpage_reader = AsyncWebpageReader(page_cache)
+        self.summarizer = Summarizer(self.prompts_manager, self.llm_adapter, self.async_webpage_reader,
+                                     fingerprint_index=self.research_manager.fingerprint_index)
+        # defaults to the summarizer's LLM_API_MAX_CONCURRENT_REQUESTS
+        self.max_concurrent_requests = max_concurrent_requests or self.summarizer.LLM_API_MAX_CONCURRENT_REQUESTS
+
+    def analyze_links(self, links: Iterable[str], prompt_name: str, temprature: float = 0.0,
+                      summary_words_max_range: str = "150, 200",
+                      dedup_session: DedupSession | None = None) -> Iterator[dict[str, Any]]:
+        """analyzes the links in parallel, yields an analysis record per link (see Summarizer.analyze_link)
+        in the order of the links.  Failed links yield a record with the `error` set
+
+        :param dedup_session: the duplicate detection for the links, see Summarizer.new_dedup_session.
+            By default one is made for the links, pass one to read its report afterwards
+        """
+        # fail fast on a bad or invalid prompt rather than for every link
+        self.prompts_manager.get_prompt_template(prompt_name)
+        links = list(links)
+        dedup_session = dedup_session or self.summarizer.new_dedup_session(links)
+        return self._analyze_links(links, prompt_name, temprature, summary_words_max_range, dedup_session)
+
+    def crawl_and_analyze(self, seed: str, prompt_name: str, temprature: float = 0.0,
+                          summary_words_max_range: str = "150, 200",
+                          crawler: SiteCrawler | None = None) -> Iterator[dict[str, Any]]:
+        """crawls the site of the seed (see SiteCrawler) and analyzes every page as soon as it is read,
+        while the crawl goes on.  Yields an analysis record per page, in the order the analyses finish
+
+        :param crawler: the crawler with its limits and path filters, by default one with the settings
+            from the environment
+        """
+        self.prompts_manager.get_prompt_template(prompt_name)
+        crawler = crawler or SiteCrawler(self.llm_adapter.webpage_reader)
+        return self._crawl_and_analyze(seed, prompt_name, temprature, summary_words_max_range, crawler)
+
+    def save_research(self, research_name: str, analyses: list[dict[str, Any]]) -> str | None:
+        """saves the analyses as research, returns its id, or None when every analysis failed"""
+        if all(analysis["error"] for analysis in analyses):
+            logger.warning(f"All analyses failed, research {research_name} not saved")
+            return None
+        return self.research_manager.persist_analyses(research_name, analyses)
+
+    def close(self) -> None:
+        """closes the connections and extraction processes of the webpage reader"""
+        self.async_webpage_reader.close()
+
+    def _analyze_links(self, links: list[str], prompt_name: str, temprature: float, summary_words_max_range: str,
+                       dedup_session: DedupSession | None) -> Iterator[dict[str, Any]]:
+        page_futures = self.summarizer.prefetch_pages(links, dedup_session)
+        with ThreadPoolExecutor(max_workers=self.max_concurrent_requests, thread_name_prefix="pipeline") as executor:
+            yield from executor.map(lambda link, page_future: self._analyze_link(
+                link, prompt_name, temprature, summary_words_max_range, dedup_session, page_future=page_future),
+                links, page_futures)
+
+    def _crawl_and_analyze(self, seed: str, prompt_name: str, temprature: float, summary_words_max_range: str,
+                           crawler: SiteCrawler) -> Iterator[dict[str, Any]]:
+        # the crawler skips links it has seen, the session catches pages with the same text
+        dedup_session = self.summarizer.new_dedup_session([])
+        # finished analyses, and the number of pages crawled once the crawl is over
+        finished: "queue.Queue[Future[dict[str, Any]] | int]" = queue.Queue()
+        stop = threading.Event()
+        with ThreadPoolExecutor(max_workers=self.max_concurrent_requests, thread_name_prefix="pipeline") as executor:
+
+            def crawl() -> None:
+                pages = 0
+                try:
+                    for webpage in crawler.crawl(seed):
+                        if stop.is_set():
+                            break
+                        future = executor.submit(self._analyze_link, webpage.link, prompt_name, temprature,
+                                                 summary_words_max_range, dedup_session, webpage)
+                        future.add_done_callback(finished.put)
+                        pages += 1
+                except Exception as e:
+                    logger.error(f"The crawl of {seed} failed:  Error: {str(e)}")
+                finally:
+                    finished.put(pages)
+
+            threading.Thread(target=crawl, name="site-crawler", daemon=True).start()
+            pages, analyzed = None, 0
+            try:
+                while pages is None or analyzed < pages:
+                    item = finished.get()
+                    if isinstance(item, int):
+                        pages = item
+                        continue
+                    analyzed += 1
+                    yield item.result()
+            finally:
+                stop.set()
+
+    def _analyze_link(self, link: str, prompt_name: str, temprature: float, summary_words_max_range: str,
+                      dedup_session: DedupSession | None, webpage: Webpage | None = None,
+                      page_future: "Future[Webpage] | None" = None) -> dict[str, Any]:
+        try:
+            analysis, _ = self.summarizer.analyze_link(link, temprature, prompt_name, summary_words_max_range,
+                                                       webpage=webpage, dedup_session=dedup_session,
+                                                       page_future=page_future)
+        except Exception as e:
+            logger.error(f"An error occurred in the analysis of link: {link}:  Error: {str(e)}")
+            return self.summarizer.make_failed_analysis(link, str(e), prompt_name, temprature,
+                                                        summary_words_max_range)
+        return analysis
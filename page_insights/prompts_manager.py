@@ -2,49 +2,156 @@
 This class managed access to prompt files.  Each file contains one prompt
 The name of the file is the used as the name identiier for the prompt
 """
+import hashlib
 import logging
 import os
+import re
+import threading
+import time
+from collections import ChainMap, OrderedDict
 from pathlib import Path
+from types import MappingProxyType
+from typing import Mapping
+
+from page_insights.concurrency import ConflictError, FileLock
+from page_insights.file_utils import atomic_write_text
 
 logger = logging.getLogger(__name__)
 
+
+def prompt_version(prompt_text: str) -> str:
+    """identifies the prompt text, so analyses made with an edited prompt can be told apart and
+    concurrent edits of a prompt detected"""
+    return hashlib.sha256(prompt_text.strip().encode("utf-8")).hexdigest()[:12]
+
+
+def render_context(base: Mapping[str, str], **values: str) -> Mapping[str, str]:
+    """the placeholder values of a single request: `values` layered over `base`.  Neither is
+    copied, the page content is only referenced, and the result is read-only, so it can be
+    passed between threads and layered on again (e.g. with the page content) without any request
+    seeing another's values"""
+    return MappingProxyType(ChainMap(values, base))
+
+
+class PromptTemplate(object):
+    """
+    A prompt parsed once into its literal text and placeholders.  Rendering joins the pieces in a
+    single pass, so the (possibly very large) values are copied once and never re-scanned for
+    placeholders.
+    """
+
+    PLACEHOLDER_PATTERN = re.compile(r"{{([a-zA-Z0-9-_\s]+)}}")
+
+    def __init__(self, text: str, known_placeholders: set[str], required_placeholders: set[str]):
+        self.text = text
+        self.version = prompt_version(text)
+        # literals and placeholder names alternate: literal, name, literal, ..., literal
+        self._parts: list[str] = self.PLACEHOLDER_PATTERN.split(text)
+        self.placeholders: frozenset[str] = frozenset(self._parts[1::2])
+        unknown = self.placeholders - known_placeholders
+        if unknown:
+            raise ValueError(f"Unknown placeholders in prompt: {', '.join(f'{{{{{name}}}}}' for name in sorted(unknown))}")
+        missing = required_placeholders - self.placeholders
+        if missing:
+            raise ValueError(f"The prompt must contain the placeholder {{{{{min(missing)}}}}}")
+
+    def render(self, values: Mapping[str, str]) -> str:
+        missing = self.placeholders - values.keys()
+        if missing:
+            raise ValueError(f"No values supplied for placeholders: {', '.join(sorted(missing))}")
+        parts = self._parts[:]
+        parts[1::2] = [values[name] for name in self._parts[1::2]]
+        return "".join(parts)
+
+
 class PromptsManager:
-    
+    """
+    Prompts are loaded lazily: the catalog only holds the name, mtime and size of each prompt file,
+    and prompt bodies are read on first use into a bounded LRU cache.  The prompts folder is
+    re-scanned at most every PROMPTS_RELOAD_INTERVAL_SECONDS, so prompts added, edited or deleted
+    on disk (e.g. by another replica sharing the assets volume) are picked up without a restart.
+
+    Reads never wait on each other: the in-memory lock is only held to look up and update the
+    catalog and cache, never while reading files.  Saves hold an exclusive lock on the prompts
+    folder, shared with other processes, and can be made conditional on the version of the
+    prompt the caller loaded.
+    """
     PROMPTS_FOLDER = "prompts"
     PROMPTS_FILE_EXT = "txt"
     MIN_RESP_WORD_COUNT_FIELD = "min_llm_resp_word_count"
     MAX_RESP_WORD_COUNT_FIELD = "max_llm_resp_word_count"
     WEB_PAGE_CONTENT_FIELD = "web_page_content"
+    LOCK_FILE_NAME = ".prompts.lock"
 
-    PROMPT_PLACEHOLDERS: dict[str, str] = {MIN_RESP_WORD_COUNT_FIELD: "", MAX_RESP_WORD_COUNT_FIELD: "", 
-                                           WEB_PAGE_CONTENT_FIELD: ""}
+    # the placeholders every prompt must contain, read-only: a request's values go in a
+    # render_context layered over it
+    PROMPT_PLACEHOLDERS: Mapping[str, str] = MappingProxyType({MIN_RESP_WORD_COUNT_FIELD: "", MAX_RESP_WORD_COUNT_FIELD: "",
+                                                               WEB_PAGE_CONTENT_FIELD: ""})
 
     def __init__(self, assets_dir: Path):
-        self._prompts: dict[str, str] = {}
+        self.PROMPTS_RELOAD_INTERVAL_SECONDS = float(os.getenv("PROMPTS_RELOAD_INTERVAL_SECONDS", 2.0))
+        self.PROMPTS_CACHE_MAX_ENTRIES = int(os.getenv("PROMPTS_CACHE_MAX_ENTRIES", 128))
+        # guards the catalog and caches below, never held during file IO
+        self._lock = threading.Lock()
+        # prompt name -> (mtime_ns, size) of its file, the key that identifies a version of the prompt
+        self._catalog: dict[str, tuple[int, int]] = {}
+        # prompt name -> (version, text, compiled template or None until first needed)
+        self._cache: OrderedDict[str, tuple[tuple[int, int], str, PromptTemplate | None]] = OrderedDict()
+        # prompts added with persist=False only live in memory
+        self._unsaved: dict[str, PromptTemplate] = {}
+        self._last_scan = 0.0
         self._prompts_storage_path: Path = assets_dir.joinpath(self.PROMPTS_FOLDER)
         self._prompts_storage_path.mkdir(parents=True, exist_ok=True)
+        self._file_lock = FileLock(self._prompts_storage_path.joinpath(self.LOCK_FILE_NAME))
         logger.info(f"Prompt storage path: {self._prompts_storage_path}")
         self._init()
 
-    def add_prompt(self, promt_name: str, prompt_text, persist: bool = True) -> None:
+    def add_prompt(self, promt_name: str, prompt_text, persist: bool = True) -> str:
+        """saves the prompt, returns its version"""
         for placeholder in self.PROMPT_PLACEHOLDERS.keys():
             if placeholder not in prompt_text:
                 raise ValueError(f"The prompt must contain the placeholder {{{{{placeholder}}}}}")
-        self._prompts[promt_name] = prompt_text
-        if persist:
-            self._save_prompt(promt_name, prompt_text)
+        return self._set_prompt(promt_name, prompt_text, persist)
+
+    def update_prompt(self, promt_name, prompt_text, persist: bool = True, expected_version: str | None = None) -> str:
+        """saves the prompt, returns its new version
+
+        :param expected_version: the version of the prompt the edit was made from (see get_prompt_version),
+            when set ConflictError is raised if the saved prompt changed since
+        """
+        return self._set_prompt(promt_name, prompt_text, persist, expected_version)
 
-    def update_prompt(self, promt_name, prompt_text, persist: bool = True) -> None:
-        self._prompts[promt_name] = prompt_text
-        if persist:
-            self._save_prompt(promt_name, prompt_text)
     def get_prompt_names(self) -> list[str]:
         # return list of prompt names
-        return list(self._prompts.keys())
+        self._scan()
+        with self._lock:
+            return sorted(self._catalog.keys() | self._unsaved.keys())
     
     def get_prompt(self, prompt_name) -> str:
         logger.info(f"Getting prompt: {prompt_name}")
-        return self._prompts[prompt_name]
+        with self._lock:
+            if prompt_name in self._unsaved:
+                return self._unsaved[prompt_name].text
+        return self._get_cached(prompt_name)[1]
+
+    def get_prompt_version(self, prompt_name) -> str:
+        """the version of the prompt as it is now.  To edit a prompt use the version of the text that was
+        read, prompt_version(text): the prompt can change between two reads"""
+        return prompt_version(self.get_prompt(prompt_name))
+
+    def get_prompt_template(self, prompt_name) -> PromptTemplate:
+        with self._lock:
+            if prompt_name in self._unsaved:
+                return self._unsaved[prompt_name]
+        version, text, template = self._get_cached(prompt_name)
+        if template is None:
+            # prompts that fail validation raise their error here
+            template = self._compile(text)
+            with self._lock:
+                cached = self._cache.get(prompt_name)
+                if cached and cached[0] == version:
+                    self._cache[prompt_name] = (version, text, template)
+        return template
     
 
     def _init(self):
@@ -53,19 +160,101 @@ class PromptsManager:
             logger.info(f"Creating prompts folder: {self._prompts_storage_path}")
             os.mkdir(self._prompts_storage_path)
         
-        self._load_prompts()
-
-    def _load_prompts(self) -> None:
-        # For each file in the prompts folder, load content of the file into 
-        # a prompt str in self._prompts
-        for prompt_file in self._prompts_storage_path.glob(f"*.{self.PROMPTS_FILE_EXT}"):
-            with open(prompt_file, "r") as f:
-                # use the file base name as the prompt name
-                self._prompts[prompt_file.stem] = f.read().strip()
-        logger.info(f"Loaded {len(self._prompts)} prompts")
-        
-        
+        self._scan(force=True)
+        logger.info(f"Found {len(self._catalog)} prompts")
+
+    def _scan(self, force: bool = False) -> None:
+        # refreshes the catalog from the prompt files' metadata, bodies are not read here
+        now = time.monotonic()
+        with self._lock:
+            if not force and now - self._last_scan < self.PROMPTS_RELOAD_INTERVAL_SECONDS:
+                return
+            # claimed before scanning, so concurrent callers don't all scan
+            self._last_scan = now
+        catalog: dict[str, tuple[int, int]] = {}
+        with os.scandir(self._prompts_storage_path) as entries:
+            for entry in entries:
+                prompt_name, ext = os.path.splitext(entry.name)
+                if ext != f".{self.PROMPTS_FILE_EXT}" or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                catalog[prompt_name] = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            if catalog != self._catalog and self._catalog:
+                added = catalog.keys() - self._catalog.keys()
+                deleted = self._catalog.keys() - catalog.keys()
+                changed = [name for name in catalog.keys() & self._catalog.keys()
+                           if catalog[name] != self._catalog[name]]
+                logger.info(f"Prompts changed on disk, added: {sorted(added)}, deleted: {sorted(deleted)}, "
+                            f"modified: {sorted(changed)}")
+            self._catalog = catalog
+            for prompt_name in self._cache.keys() - catalog.keys():
+                del self._cache[prompt_name]
+
+    def _get_cached(self, prompt_name: str) -> tuple[tuple[int, int], str, PromptTemplate | None]:
+        self._scan()
+        with self._lock:
+            if prompt_name not in self._catalog:
+                raise KeyError(prompt_name)
+            cached = self._cache.get(prompt_name)
+            if cached and cached[0] == self._catalog[prompt_name]:
+                self._cache.move_to_end(prompt_name)
+                return cached
+        try:
+            version, text = self._read_prompt(prompt_name)
+        except FileNotFoundError:
+            # deleted since the last scan
+            raise KeyError(prompt_name)
+        cached = (version, text, None)
+        with self._lock:
+            self._catalog[prompt_name] = version
+            self._cache_prompt(prompt_name, cached)
+        return cached
+
+    def _read_prompt(self, prompt_name: str) -> tuple[tuple[int, int], str]:
+        # takes the version from the open file, so an edit made while reading is seen as a
+        # change on the next scan
+        with open(self._prompt_file_path(prompt_name), "r") as f:
+            stat = os.fstat(f.fileno())
+            text = f.read().strip()
+        return (stat.st_mtime_ns, stat.st_size), text
+
+    def _cache_prompt(self, prompt_name: str, cached: tuple[tuple[int, int], str, PromptTemplate | None]) -> None:
+        self._cache[prompt_name] = cached
+        self._cache.move_to_end(prompt_name)
+        while len(self._cache) > self.PROMPTS_CACHE_MAX_ENTRIES:
+            self._cache.popitem(last=False)
+
+    def _set_prompt(self, promt_name: str, prompt_text: str, persist: bool, expected_version: str | None = None) -> str:
+        template = self._compile(prompt_text)
+        if not persist:
+            with self._lock:
+                self._unsaved[promt_name] = template
+            return template.version
+        with self._file_lock.exclusive():
+            if expected_version is not None:
+                try:
+                    current_version = prompt_version(self._read_prompt(promt_name)[1])
+                except FileNotFoundError:
+                    current_version = None
+                if current_version != expected_version:
+                    raise ConflictError(f"The prompt {promt_name} was changed by someone else since it was loaded, "
+                                        "reload it and apply your changes again")
+            self._save_prompt(promt_name, prompt_text)
+            stat = self._prompt_file_path(promt_name).stat()
+        version = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            self._unsaved.pop(promt_name, None)
+            self._catalog[promt_name] = version
+            self._cache_prompt(promt_name, (version, template.text, template))
+        return template.version
+
+    def _compile(self, prompt_text: str) -> PromptTemplate:
+        return PromptTemplate(prompt_text, set(self.PROMPT_PLACEHOLDERS.keys()), {self.WEB_PAGE_CONTENT_FIELD})
+
+    def _prompt_file_path(self, promt_name: str) -> Path:
+        return self._prompts_storage_path.joinpath(f"{promt_name}.{self.PROMPTS_FILE_EXT}")
 
     def _save_prompt(self, promt_name, prompt_text) -> None:
-        with open(self._prompts_storage_path.joinpath(f"{promt_name}.{self.PROMPTS_FILE_EXT}"), "w") as f:
-            f.write(prompt_text)
+        # written to a temp file and renamed, so readers never see a half written prompt
+        atomic_write_text(self._prompt_file_path(promt_name), prompt_text)
@@ -0,0 +1,133 @@
+"""
+Client side rate limiting for the LLM API.
+
+OpenAI enforces both a requests-per-minute (RPM) and a tokens-per-minute (TPM) quota.
+Each quota is modelled as a token bucket that refills continuously; a request may only
+be sent once both buckets can cover it.  The limiter is shared by every thread making
+LLM calls, so concurrent analyses stay within the account quota.
+"""
+import logging
+import random
+import re
+import threading
+import time
+from typing import Mapping
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket(object):
+
+    def __init__(self, per_minute_limit: float):
+        self.capacity = float(per_minute_limit)
+        self.refill_per_second = self.capacity / 60.0
+        self.available = self.capacity
+        self._last_refill = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        self.available = min(self.capacity, self.available + elapsed * self.refill_per_second)
+
+    def seconds_until_available(self, amount: float) -> float:
+        if self.available >= amount:
+            return 0.0
+        return (amount - self.available) / self.refill_per_second
+
+
+class RateLimiter(object):
+
+    # OpenAI reports reset durations like "6ms", "20s" or "1m30s"
+    DURATION_PART_PATTERN = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+    DURATION_UNIT_SECONDS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float):
+        self._lock = threading.Lock()
+        self._requests = TokenBucket(requests_per_minute)
+        self._tokens = TokenBucket(tokens_per_minute)
+        self._blocked_until = 0.0
+        logger.info(f"rate limiter: {requests_per_minute} requests/min, {tokens_per_minute} tokens/min")
+
+    def acquire(self, estimated_tokens: int) -> None:
+        """blocks until a request costing `estimated_tokens` fits in both the RPM and TPM budgets
+
+        :param estimated_tokens: estimate of prompt plus completion tokens for the request
+        """
+        # a single request larger than the whole TPM budget would otherwise wait forever
+        tokens = min(float(estimated_tokens), self._tokens.capacity)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._requests.refill(now)
+                self._tokens.refill(now)
+                wait = max(
+                    self._blocked_until - now,
+                    self._requests.seconds_until_available(1),
+                    self._tokens.seconds_until_available(tokens),
+                )
+                if wait <= 0:
+                    self._requests.available -= 1
+                    self._tokens.available -= tokens
+                    return
+            logger.debug(f"rate limiter waiting {wait:.2f} seconds")
+            time.sleep(wait)
+
+    def seconds_until_available(self, estimated_tokens: int) -> float:
+        """how long acquire() would currently block for a request costing `estimated_tokens`"""
+        tokens = min(float(estimated_tokens), self._tokens.capacity)
+        with self._lock:
+            now = time.monotonic()
+            self._requests.refill(now)
+            self._tokens.refill(now)
+            return max(0.0, self._blocked_until - now, self._requests.seconds_until_available(1),
+                       self._tokens.seconds_until_available(tokens))
+
+    def reconcile(self, estimated_tokens: int, actual_tokens: int) -> None:
+        """corrects the TPM bucket once the real token usage of a request is known"""
+        with self._lock:
+            self._tokens.available = min(self._tokens.capacity,
+                                         self._tokens.available + estimated_tokens - actual_tokens)
+
+    def update_from_headers(self, headers: Mapping[str, str]) -> None:
+        """syncs the buckets with the `x-ratelimit-*` headers returned by the API"""
+        with self._lock:
+            now = time.monotonic()
+            for bucket, name in ((self._requests, "requests"), (self._tokens, "tokens")):
+                remaining = headers.get(f"x-ratelimit-remaining-{name}")
+                if remaining is not None:
+                    bucket.refill(now)
+                    bucket.available = min(bucket.available, float(remaining))
+
+    def backoff(self, headers: Mapping[str, str] | None, attempt: int) -> float:
+        """pauses all callers after a rate limit error, returns the number of seconds paused
+
+        The delay is taken from the `retry-after` / `x-ratelimit-reset-*` headers when present,
+        falling back to exponential backoff with jitter.
+        """
+        headers = headers or {}
+        self.update_from_headers(headers)
+        delay = self._delay_from_headers(headers)
+        if delay is None:
+            delay = min(60.0, 2.0 ** attempt)
+        delay += random.uniform(0, 0.5)
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + delay)
+        return delay
+
+    def _delay_from_headers(self, headers: Mapping[str, str]) -> float | None:
+        retry_after = headers.get("retry-after")
+        if retry_after is not None:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        delays = [self._parse_duration(headers[name])
+                  for name in ("x-ratelimit-reset-requests", "x-ratelimit-reset-tokens") if name in headers]
+        delays = [delay for delay in delays if delay is not None]
+        return max(delays) if delays else None
+
+    def _parse_duration(self, duration: str) -> float | None:
+        parts = self.DURATION_PART_PATTERN.findall(duration)
+        if not parts:
+            return None
+        return sum(float(value) * self.DURATION_UNIT_SECONDS[unit] for value, unit in parts)
@@ -1,14 +1,29 @@
-"""Manage the aspects of the Research"""
+"""Manage the aspects of the Research
 
-import json
+Safe to share between threads and between processes using the same assets folder: changes
+that touch the research file, the metadata store and the search index together hold an
+exclusive lock on the research folder, reads take no lock.  Files are replaced atomically, so
+readers see either the old or the new version of a document.
+"""
+
+import os
 import string
 import random
 import logging
 import re
+import threading
+from collections import OrderedDict
 from pathlib import Path
 from typing import Any
 from datetime import datetime, timezone
 
+from page_insights.concurrency import FileLock
+from page_insights.dedup import FingerprintIndex
+from page_insights.file_utils import atomic_write_text
+from page_insights.research_store import (SORT_KEYS, JsonResearchStore, ResearchStore, SqliteResearchStore,
+                                          check_version)
+from page_insights.search_index import SearchIndex
+
 logger = logging.getLogger(__name__)
 
 
@@ -16,6 +31,10 @@ class ResearchManager(object):
     RESEARCH_FOLDER = "research"
     RESEARCH_FILE_EXT = "md"
     RESEARCH_DIGEST_FILE_NAME = "research_digest.json"
+    RESEARCH_DB_FILE_NAME = "research.sqlite3"
+    SEARCH_INDEX_FILE_NAME = "search_index.sqlite3"
+    FINGERPRINT_INDEX_FILE_NAME = "fingerprints.sqlite3"
+    LOCK_FILE_NAME = ".research.lock"
 
     def __init__(self, assets_dir: Path):
         self.assets_dir = assets_dir
@@ -24,37 +43,96 @@ class ResearchManager(object):
         self.digest_file_path = self.perist_folder_path.joinpath(
             self.RESEARCH_DIGEST_FILE_NAME
         )
-        self.saved_research: list[dict[str, Any]] = []
-        if not self.digest_file_path.exists():
-            self.digest_file_path.touch()
-            self.digest_file_path.write_text("[]")
-        self._load_saved_research_metadata()
+        self._lock = FileLock(self.perist_folder_path.joinpath(self.LOCK_FILE_NAME))
+        self.store = self._create_store(os.getenv("RESEARCH_STORAGE_BACKEND", "sqlite"))
+        self.search_index = SearchIndex(self.perist_folder_path.joinpath(self.SEARCH_INDEX_FILE_NAME))
+        # the content fingerprints of the analyzed pages of the active research, see Summarizer dedup
+        self.fingerprint_index = FingerprintIndex(self.perist_folder_path.joinpath(self.FINGERPRINT_INDEX_FILE_NAME))
+        with self._lock.exclusive():
+            self._build_search_index()
+        self.RESEARCH_RENDER_CACHE_MAX_ENTRIES = int(os.getenv("RESEARCH_RENDER_CACHE_MAX_ENTRIES", 64))
+        self._render_lock = threading.Lock()
+        # research id -> ((mtime_ns, size) of its file, rendered markdown)
+        self._render_cache: OrderedDict[str, tuple[tuple[int, int], str]] = OrderedDict()
 
     def persist_research(self, research_text: str, research_name: str, research_links: list[str], 
-                         add_title_header: bool = True) -> str:
+                         add_title_header: bool = True, analyses: list[dict[str, Any]] | None = None) -> str:
+        """saves the research
+
+        :param analyses: the analysis records the research was made from (see Summarizer.analyze_link),
+            research saved with them can be refreshed
+        """
         if add_title_header:
             research_text = f"# {research_name}\n{research_text}"
-        # ensure research_name is safe for a file name
-        research_name = re.sub(r"[^a-zA-Z0-9-_\.]", "_", research_name)
-        research_name = research_name.strip('.')
-        research_name = re.sub(r"_+", "_", research_name)
+        research_name = self._safe_research_name(research_name)
         logger.info(f"Persisting research: {research_name}")
-        return self._persist_digest_record(research_text, research_name, research_links)
+        with self._lock.exclusive():
+            return self._persist_digest_record(research_text, research_name, research_links, analyses or [])
+
+    def persist_linked_analyses(self, research_name: str, analyses: list[dict[str, Any]]) -> list[str]:
+        """saves a research per analysis record, e.g. of a page analyzed with several prompts (see
+        Summarizer.analyze_link_with_prompts).  Each is named after its prompt and lists the others
+        in `linked_research`
+
+        :return: the research ids, in the order of the analyses
+        """
+        titles = [f"{research_name}: {analysis['prompt_name']}" for analysis in analyses]
+        logger.info(f"Persisting {len(analyses)} linked research: {research_name}")
+        with self._lock.exclusive():
+            research_ids = [self._generate_research_id(self._safe_research_name(title)) for title in titles]
+            for research_id, title, analysis in zip(research_ids, titles, analyses):
+                self._persist_digest_record(
+                    f"# {title}\n{self._analyses_text([analysis])}", self._safe_research_name(title),
+                    [analysis["link"]], [analysis], research_id=research_id,
+                    linked_research=[linked_id for linked_id in research_ids if linked_id != research_id])
+        return research_ids
+
+    def persist_analyses(self, research_name: str, analyses: list[dict[str, Any]]) -> str:
+        """saves research made of the analysis records (see Summarizer.analyze_link), in their order"""
+        return self.persist_research(self._analyses_text(analyses), research_name,
+                                     [analysis["link"] for analysis in analyses], analyses=analyses)
+
+    def update_research_analyses(self, research_id: str, analyses: list[dict[str, Any]],
+                                 expected_version: int | None = None) -> dict[str, Any]:
+        """replaces the analysis records of the research and rewrites its content from their summaries
+
+        :param expected_version: the version of the research the analyses were made from, when set
+            ConflictError is raised if the research changed since
+        """
+        with self._lock.exclusive():
+            research_metadata = self.store.get(research_id)
+            if not research_metadata:
+                raise ValueError(f"Research not found: {research_id}")
+            check_version(research_id, research_metadata, expected_version)
+            file_path = self.perist_folder_path.joinpath(research_metadata["file_name"])
+            # keep the title header the research was saved with
+            first_line = file_path.read_text().split("\n", 1)[0] if file_path.exists() else ""
+            header = first_line if first_line.startswith("# ") else f"# {research_metadata['name']}"
+            research_text = header + "\n" + self._analyses_text(analyses)
+            atomic_write_text(file_path, research_text)
+            research_metadata = self.store.update(research_id, {"analyses": analyses})  # type: ignore
+            self.search_index.index(research_id, research_metadata["name"], research_metadata["links"],
+                                    research_text, research_metadata["archived"])
+            if not research_metadata["archived"]:
+                self.fingerprint_index.index(research_id, analyses)
+        logger.info(f"Updated the analyses of research: {research_id}")
+        return research_metadata
     
     def delete_research(self, research_id: str, permanent_delete: bool = False):
         action = "deleted" if permanent_delete else "archived"
-        # find the record in self.saved_research which matches the research_id
-        for i, research in enumerate(self.saved_research):
-            if research["id"] == research_id:
-                if permanent_delete:
-                    logger.info(f"Deleting research record: {research_id}")
-                    del self.saved_research[i]
-                else:
-                    self.saved_research[i]['archived'] = True
-                self.digest_file_path.write_text(json.dumps(self.saved_research, indent=4))
-                break
-        if permanent_delete:
-            self._delete_research_file(research_id)
+        with self._lock.exclusive():
+            if permanent_delete:
+                logger.info(f"Deleting research record: {research_id}")
+                self.store.delete(research_id)
+                self.search_index.remove(research_id)
+                self.fingerprint_index.remove(research_id)
+                with self._render_lock:
+                    self._render_cache.pop(research_id, None)
+                self._delete_research_file(research_id)
+            else:
+                self.store.update(research_id, {"archived": True})
+                self.search_index.set_archived(research_id)
+                self.fingerprint_index.remove(research_id)
         logger.info(f"Research {research_id} {action}")
 
     def _delete_research_file(self, research_id: str):
@@ -64,21 +142,41 @@ class ResearchManager(object):
             research_filepath.unlink()
 
     def get_research_ids(self, include_archived: bool = False) -> list[str]:
-        if include_archived:
-            return [research["id"] for research in self.saved_research]
-        else:
-            return [research["id"] for research in self.saved_research if not research["archived"]]
+        return [research["id"] for research in self.store.list_records(include_archived)]
+
+    def list_research(self, page: int = 1, page_size: int = 20, sort_by: str = "date", descending: bool = True,
+                      archived: bool | None = False) -> dict[str, Any]:
+        """one page of research records, without reading any research file
+
+        :param page: 1 based page number, pages past the last one are empty
+        :param sort_by: "date" or "name"
+        :param archived: False for active research only, True for archived research only, None for both
+        :return: dict with the records of the page, the page, page_size, total number of records and pages
+        """
+        if sort_by not in SORT_KEYS:
+            raise ValueError(f"Unknown sort order: {sort_by}, expected one of {', '.join(SORT_KEYS)}")
+        if page < 1 or page_size < 1:
+            raise ValueError("page and page_size must be at least 1")
+        records, total = self.store.list_page((page - 1) * page_size, page_size, sort_by, descending, archived)
+        return {"records": records, "page": page, "page_size": page_size, "total": total,
+                "pages": max(1, -(-total // page_size))}
+
+    def get_research_for_link(self, link: str, include_archived: bool = False) -> list[dict[str, Any]]:
+        return self.store.find_by_link(link, include_archived)
+
+    def search_research(self, query: str, limit: int = 20, archived: bool | None = False) -> list[dict[str, Any]]:
+        """full-text search over the research names, links and content, best matches first.  `archived`
+        filters the research searched like list_research does"""
+        results = []
+        for research_id, score, snippet in self.search_index.search(query, limit, archived):
+            results.append({"id": research_id, "score": score, "snippet": snippet})
+        return results
 
     def get_research_details(self, research_id: str, include_archived: bool = False) -> tuple[dict[str, Any], str]:
         logger.info(f"Getting research details for id: {research_id}")
-        research_metadata = None
-        for research in self.saved_research:
-            if research["id"] == research_id:
-                logger.info(f"Found research with id: {research_id}: {research}")
-                research_metadata = research
-                if not include_archived and research["archived"]:
-                    research_metadata = None
-                break
+        research_metadata = self.store.get(research_id)
+        if research_metadata and not include_archived and research_metadata["archived"]:
+            research_metadata = None
         if not research_metadata:
             return {}, ""
         # read the file content of the research
@@ -89,36 +187,93 @@ class ResearchManager(object):
         research_content = file_path.read_text()
         return research_metadata, research_content
 
+    def get_rendered_research(self, research_id: str, include_archived: bool = False) -> tuple[dict[str, Any], str]:
+        """like get_research_details, with the content rendered for display.  The rendering is cached
+        per revision of the research file, so repeat views only cost a stat of the file"""
+        research_metadata = self.store.get(research_id)
+        if research_metadata and not include_archived and research_metadata["archived"]:
+            research_metadata = None
+        if not research_metadata:
+            return {}, ""
+        file_path = self.perist_folder_path.joinpath(research_metadata["file_name"])
+        try:
+            stat = file_path.stat()
+        except FileNotFoundError:
+            logger.error(f"Research file does not exist: {file_path}")
+            return research_metadata, ""
+        revision = (stat.st_mtime_ns, stat.st_size)
+        with self._render_lock:
+            cached = self._render_cache.get(research_id)
+            if cached and cached[0] == revision:
+                self._render_cache.move_to_end(research_id)
+                return research_metadata, cached[1]
+        # each line its own paragraph, so line breaks survive the markdown rendering
+        rendered = file_path.read_text().replace("\n", "\n\n")
+        with self._render_lock:
+            self._render_cache[research_id] = (revision, rendered)
+            self._render_cache.move_to_end(research_id)
+            while len(self._render_cache) > self.RESEARCH_RENDER_CACHE_MAX_ENTRIES:
+                self._render_cache.popitem(last=False)
+        return research_metadata, rendered
+
     def _persist_digest_record(
-        self, research_text: str, research_name: str, research_links: list[str]
+        self, research_text: str, research_name: str, research_links: list[str], analyses: list[dict[str, Any]],
+        research_id: str | None = None, linked_research: list[str] | None = None
     ) -> str:
-        research_id = self._generate_research_id(research_name)
+        research_id = research_id or self._generate_research_id(research_name)
 
         research_filepath = self.perist_folder_path.joinpath(f"{research_id}.{self.RESEARCH_FILE_EXT}")
-        research_filepath.write_text(research_text)
+        atomic_write_text(research_filepath, research_text)
 
-        self.saved_research.append(
-            self._generate_research_record(research_id, research_name, research_filepath, research_links)
+        self.store.add(
+            self._generate_research_record(research_id, research_name, research_filepath, research_links, analyses,
+                                           linked_research or [])
         )
-        # save the digest
-        self.digest_file_path.write_text(json.dumps(self.saved_research, indent=4))
+        self.search_index.index(research_id, research_name, research_links, research_text)
+        self.fingerprint_index.index(research_id, analyses)
         return research_id
-        
 
-    def _load_saved_research_metadata(self) -> None:
-        if self.digest_file_path.exists():
-            with open(self.digest_file_path, "r") as file:
-                self.saved_research = json.load(file)
-                logger.info(
-                    f"Loaded metadata for {len(self.saved_research)} research"
-                )
+    def _analyses_text(self, analyses: list[dict[str, Any]]) -> str:
+        return "\n\n".join(analysis["summary"] or f"ERROR[{analysis['link']}]: {analysis['error']}"
+                           for analysis in analyses)
+
+    def _build_search_index(self) -> None:
+        # one-time build for research saved before the search index existed, after that the
+        # index is maintained incrementally as research is persisted and deleted
+        if self.search_index.count():
+            return
+        records = self.store.list_records(include_archived=True)
+        for record in records:
+            file_path = self.perist_folder_path.joinpath(record["file_name"])
+            body = file_path.read_text() if file_path.exists() else ""
+            self.search_index.index(record["id"], record["name"], record["links"], body, record["archived"])
+        if records:
+            logger.info(f"Built search index for {len(records)} research")
+
+
+    def _create_store(self, backend: str) -> ResearchStore:
+        if backend == "json":
+            return JsonResearchStore(self.digest_file_path)
+        if backend == "sqlite":
+            store = SqliteResearchStore(self.perist_folder_path.joinpath(self.RESEARCH_DB_FILE_NAME))
+            # existing JSON digests are imported the first time the SQLite store is used
+            store.migrate_from_json(self.digest_file_path)
+            return store
+        raise ValueError(f"Unknown RESEARCH_STORAGE_BACKEND: {backend}, expected 'sqlite' or 'json'")
+
+    def _safe_research_name(self, research_name: str) -> str:
+        # ensure research_name is safe for a file name
+        research_name = re.sub(r"[^a-zA-Z0-9-_\.]", "_", research_name)
+        research_name = research_name.strip('.')
+        return re.sub(r"_+", "_", research_name)
 
     def _generate_research_id(self, research_name: str) -> str:
         return f"{research_name}-{self._generate_random_string(4)}"
     
 
     def _generate_research_record(
-        self, research_id: str, research_name: str, file_path: Path, research_links: list[str]
+        self, research_id: str, research_name: str, file_path: Path, research_links: list[str],
+        analyses: list[dict[str, Any]], linked_research: list[str]
     ) -> dict[str, Any]:
         return {
             "id": research_id,
@@ -126,7 +281,11 @@ class ResearchManager(object):
             "name": research_name,
             "file_name": str(file_path.name),
             "links": research_links,
-            "archived": False
+            "archived": False,
+            "analyses": analyses,
+            # ids of the research saved together with this one, e.g. the same page analyzed with other prompts
+            "linked_research": linked_research,
+            "version": 1,
         }
     
     def _generate_random_string(self, length: int) -> str:
@@ -0,0 +1,64 @@
+"""
+Refreshes saved research by re-analyzing only the pages that changed.
+
+Each analysis record of a research holds a fingerprint of the page text and the version of the
+prompt it was made with.  A refresh reads every page again (the page cache revalidates it with
+a conditional request) and compares.  Only pages whose text or prompt changed, or whose analysis
+failed, are sent to the llm again; the others keep their summary and get a new `verified_date`.
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Any
+
+from page_insights.research_manager import ResearchManager
+from page_insights.summarizer import Summarizer
+
+logger = logging.getLogger(__name__)
+
+
+class ResearchRefresher(object):
+    UNCHANGED, REANALYZED, FAILED = "unchanged", "reanalyzed", "failed"
+
+    def __init__(self, summarizer: Summarizer, research_manager: ResearchManager):
+        self.summarizer = summarizer
+        self.research_manager = research_manager
+
+    def refresh(self, research_id: str) -> dict[str, Any]:
+        """refreshes the research, returns the status of each link and the number of links per status"""
+        research_metadata, _ = self.research_manager.get_research_details(research_id)
+        if not research_metadata:
+            raise ValueError(f"Research not found: {research_id}")
+        analyses = research_metadata.get("analyses")
+        if not analyses:
+            raise ValueError(f"Research {research_id} was saved without the details needed to refresh it")
+
+        with ThreadPoolExecutor(max_workers=self.summarizer.LLM_API_MAX_CONCURRENT_REQUESTS) as executor:
+            refreshed = list(executor.map(self._refresh_analysis, analyses))
+        # not applied if the research was changed (e.g. refreshed by someone else) while the pages were read
+        self.research_manager.update_research_analyses(research_id, [analysis for analysis, _ in refreshed],
+                                                       expected_version=research_metadata.get("version", 1))
+
+        links = [{"link": analysis["link"], "status": status} for analysis, status in refreshed]
+        counts = {status: sum(1 for link in links if link["status"] == status)
+                  for status in (self.UNCHANGED, self.REANALYZED, self.FAILED)}
+        logger.info(f"Refreshed research {research_id}: {counts}")
+        return dict(counts, id=research_id, links=links)
+
+    def _refresh_analysis(self, analysis: dict[str, Any]) -> tuple[dict[str, Any], str]:
+        link = analysis["link"]
+        try:
+            webpage = self.summarizer.llm_adapter.read_webpage(link)
+            prompt_template = self.summarizer.prompts_manager.get_prompt_template(analysis["prompt_name"])
+            if not analysis["error"] and webpage.fingerprint() == analysis["content_fingerprint"] \
+                    and prompt_template.version == analysis["prompt_version"]:
+                verified_date = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S %z")
+                return dict(analysis, verified_date=verified_date), self.UNCHANGED
+            logger.info(f"Page or prompt changed since the last analysis, re-analyzing: {link}")
+            refreshed_analysis, _ = self.summarizer.analyze_link(
+                link, analysis["temprature"], analysis["prompt_name"], analysis["summary_words_max_range"], webpage)
+            return refreshed_analysis, self.REANALYZED
+        except Exception as e:
+            # keep the previous analysis, the next refresh tries again
+            logger.error(f"Refreshing the analysis failed for link: {link}:  Error: {str(e)}")
+            return analysis, self.FAILED
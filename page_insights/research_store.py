@@ -0,0 +1,295 @@
+"""
+Storage backends for the research metadata records managed by ResearchManager.
+
+A record is a dict with at least the keys: id, created_date, name, file_name, links, archived.
+Research that can be refreshed also has `analyses`, the per link analysis records it was made from.
+Records carry a `version`, incremented by every update, so updates can be made conditional on
+the version the caller read (optimistic concurrency).  Both stores are safe to share between
+threads and between processes using the same assets folder.
+"""
+import json
+import logging
+import os
+import sqlite3
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Any
+
+from page_insights.concurrency import ConflictError, FileLock, SqliteConnections
+from page_insights.file_utils import atomic_write_text
+
+logger = logging.getLogger(__name__)
+
+# the orders records can be listed in, created dates are all UTC so they sort as text
+SORT_KEYS = {
+    "date": lambda record: record["created_date"],
+    "name": lambda record: record["name"].lower(),
+}
+SQL_ORDER_BY = {
+    "date": "created_date {direction}",
+    "name": "name COLLATE NOCASE {direction}",
+}
+
+
+class ResearchStore(ABC):
+
+    @abstractmethod
+    def add(self, record: dict[str, Any]) -> None:
+        pass
+
+    @abstractmethod
+    def get(self, research_id: str) -> dict[str, Any] | None:
+        pass
+
+    @abstractmethod
+    def update(self, research_id: str, fields: dict[str, Any], expected_version: int | None = None
+               ) -> dict[str, Any] | None:
+        """merges `fields` into the record, returns the updated record or None if not found
+
+        :param expected_version: when set, the update is only applied if the record is still at this
+            version, otherwise ConflictError is raised
+        """
+
+    @abstractmethod
+    def delete(self, research_id: str) -> bool:
+        pass
+
+    @abstractmethod
+    def list_records(self, include_archived: bool = False) -> list[dict[str, Any]]:
+        """records in the order they were added"""
+
+    @abstractmethod
+    def list_page(self, offset: int, limit: int, sort_by: str = "date", descending: bool = True,
+                  archived: bool | None = False) -> tuple[list[dict[str, Any]], int]:
+        """one page of records and the total number of records matching the filter
+
+        :param sort_by: "date" (created date) or "name"
+        :param archived: False for active records only, True for archived records only, None for both
+        """
+
+    @abstractmethod
+    def find_by_link(self, link: str, include_archived: bool = False) -> list[dict[str, Any]]:
+        pass
+
+
+def check_version(research_id: str, record: dict[str, Any], expected_version: int | None) -> None:
+    # records saved before versioning are at version 1
+    version = record.get("version", 1)
+    if expected_version is not None and version != expected_version:
+        raise ConflictError(f"Research {research_id} was changed by someone else "
+                            f"(version {version}, expected {expected_version}), reload it and try again")
+
+
+class JsonResearchStore(ResearchStore):
+    """The original flat file store: every record lives in one JSON digest which is rewritten on each change.
+
+    Changes hold an exclusive lock on the digest and re-read it first when another process has
+    rewritten it, so no process overwrites the records another one added.  Reads share the lock.
+    """
+
+    def __init__(self, digest_file_path: Path):
+        self.digest_file_path = digest_file_path
+        self._file_lock = FileLock(digest_file_path.with_name(f".{digest_file_path.name}.lock"))
+        self._records: dict[str, dict[str, Any]] = {}
+        # (mtime_ns, size, inode) of the digest the records were loaded from
+        self._loaded_revision: tuple[int, int, int] | None = None
+        with self._file_lock.exclusive():
+            if not self.digest_file_path.exists():
+                atomic_write_text(self.digest_file_path, "[]")
+            self._reload_if_changed()
+        logger.info(f"Loaded metadata for {len(self._records)} research")
+
+    def add(self, record: dict[str, Any]) -> None:
+        with self._file_lock.exclusive():
+            self._reload_if_changed()
+            self._records[record["id"]] = record
+            self._save()
+
+    def get(self, research_id: str) -> dict[str, Any] | None:
+        with self._file_lock.shared():
+            self._reload_if_changed()
+            return self._records.get(research_id)
+
+    def update(self, research_id: str, fields: dict[str, Any], expected_version: int | None = None
+               ) -> dict[str, Any] | None:
+        with self._file_lock.exclusive():
+            self._reload_if_changed()
+            record = self._records.get(research_id)
+            if record is None:
+                return None
+            check_version(research_id, record, expected_version)
+            # replaced rather than changed in place, records handed out to readers never change
+            record = {**record, **fields, "version": record.get("version", 1) + 1}
+            self._records[research_id] = record
+            self._save()
+            return record
+
+    def delete(self, research_id: str) -> bool:
+        with self._file_lock.exclusive():
+            self._reload_if_changed()
+            if self._records.pop(research_id, None) is None:
+                return False
+            self._save()
+            return True
+
+    def list_records(self, include_archived: bool = False) -> list[dict[str, Any]]:
+        with self._file_lock.shared():
+            self._reload_if_changed()
+            return [record for record in self._records.values() if include_archived or not record["archived"]]
+
+    def list_page(self, offset: int, limit: int, sort_by: str = "date", descending: bool = True,
+                  archived: bool | None = False) -> tuple[list[dict[str, Any]], int]:
+        sort_key = SORT_KEYS[sort_by]
+        with self._file_lock.shared():
+            self._reload_if_changed()
+            records = [record for record in self._records.values()
+                       if archived is None or record["archived"] == archived]
+        # sorted() is stable, ties stay in the order they were added (most recent first when descending)
+        if descending:
+            records.reverse()
+        records = sorted(records, key=sort_key, reverse=descending)
+        return records[offset:offset + limit], len(records)
+
+    def find_by_link(self, link: str, include_archived: bool = False) -> list[dict[str, Any]]:
+        return [record for record in self.list_records(include_archived) if link in record["links"]]
+
+    def _reload_if_changed(self) -> None:
+        # the digest is replaced by a rename on every save, so a new inode, size or mtime means new content
+        stat = os.stat(self.digest_file_path)
+        revision = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        if revision == self._loaded_revision:
+            return
+        with open(self.digest_file_path, "r") as file:
+            # swapped in whole, readers holding the shared lock at the same time see either version
+            self._records = {record["id"]: record for record in json.load(file)}
+        self._loaded_revision = revision
+
+    def _save(self) -> None:
+        atomic_write_text(self.digest_file_path, json.dumps(list(self._records.values()), indent=4))
+        stat = os.stat(self.digest_file_path)
+        self._loaded_revision = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+
+class SqliteResearchStore(ResearchStore):
+    """Records stored in SQLite, indexed by id, name, created date and link.  Every change is
+    a single transaction, so only the changed record is written.  Each thread has its own
+    connection: in WAL mode reads never wait, and writes are ordered by SQLite's locking"""
+
+    def __init__(self, db_file_path: Path):
+        self.db_file_path = db_file_path
+        self._connections = SqliteConnections(db_file_path, pragmas=("foreign_keys=ON",))
+        db = self._connections.get()
+        db.execute("PRAGMA journal_mode=WAL")
+        db.executescript("""
+            CREATE TABLE IF NOT EXISTS research (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                id TEXT NOT NULL UNIQUE,
+                name TEXT NOT NULL,
+                created_date TEXT NOT NULL,
+                archived INTEGER NOT NULL DEFAULT 0,
+                record TEXT NOT NULL
+            );
+            -- the orders of list_page, unfiltered and filtered by archived (index entries end with
+            -- the seq rowid, the tie breaker of both orders)
+            CREATE INDEX IF NOT EXISTS research_name_nocase ON research (name COLLATE NOCASE);
+            CREATE INDEX IF NOT EXISTS research_created_date ON research (created_date);
+            CREATE INDEX IF NOT EXISTS research_archived_name_nocase ON research (archived, name COLLATE NOCASE);
+            CREATE INDEX IF NOT EXISTS research_archived_created_date ON research (archived, created_date);
+            CREATE TABLE IF NOT EXISTS research_links (
+                research_id TEXT NOT NULL REFERENCES research (id) ON DELETE CASCADE,
+                link TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS research_links_link ON research_links (link);
+            CREATE INDEX IF NOT EXISTS research_links_research_id ON research_links (research_id);
+            CREATE TABLE IF NOT EXISTS store_metadata (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+        """)
+        logger.info(f"Research store: {db_file_path}")
+
+    def migrate_from_json(self, digest_file_path: Path) -> None:
+        """one-shot import of the records of a JSON digest, subsequent calls are no-ops"""
+        with self._connections.transaction() as db:
+            migrated = db.execute(
+                "SELECT value FROM store_metadata WHERE key = 'migrated_from_json'").fetchone()
+            if migrated or not digest_file_path.exists():
+                return
+            records = json.loads(digest_file_path.read_text() or "[]")
+            for record in records:
+                self._insert(db, record)
+            db.execute("INSERT INTO store_metadata VALUES ('migrated_from_json', ?)", (str(digest_file_path),))
+        logger.info(f"Migrated {len(records)} research records from {digest_file_path}")
+
+    def add(self, record: dict[str, Any]) -> None:
+        with self._connections.transaction() as db:
+            self._insert(db, record)
+
+    def get(self, research_id: str) -> dict[str, Any] | None:
+        return self._select(self._connections.get(), research_id)
+
+    def update(self, research_id: str, fields: dict[str, Any], expected_version: int | None = None
+               ) -> dict[str, Any] | None:
+        with self._connections.transaction() as db:
+            record = self._select(db, research_id)
+            if record is None:
+                return None
+            check_version(research_id, record, expected_version)
+            record.update(fields, version=record.get("version", 1) + 1)
+            db.execute(
+                "UPDATE research SET name = ?, created_date = ?, archived = ?, record = ? WHERE id = ?",
+                (record["name"], record["created_date"], int(record["archived"]), json.dumps(record), research_id),
+            )
+            if "links" in fields:
+                db.execute("DELETE FROM research_links WHERE research_id = ?", (research_id,))
+                self._insert_links(db, record)
+            return record
+
+    def delete(self, research_id: str) -> bool:
+        with self._connections.transaction() as db:
+            return db.execute("DELETE FROM research WHERE id = ?", (research_id,)).rowcount > 0
+
+    def list_records(self, include_archived: bool = False) -> list[dict[str, Any]]:
+        rows = self._connections.get().execute(
+            "SELECT record FROM research WHERE archived = 0 OR ? ORDER BY seq", (include_archived,)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def list_page(self, offset: int, limit: int, sort_by: str = "date", descending: bool = True,
+                  archived: bool | None = False) -> tuple[list[dict[str, Any]], int]:
+        direction = "DESC" if descending else "ASC"
+        order_by = SQL_ORDER_BY[sort_by].format(direction=direction)
+        # no filter rather than an always true one, so the query can walk an index in the sort order
+        where, parameters = ("WHERE archived = ?", (archived,)) if archived is not None else ("", ())
+        db = self._connections.get()
+        # one read transaction, so the page and the total agree
+        with db:
+            db.execute("BEGIN")
+            rows = db.execute(
+                f"SELECT record FROM research {where} ORDER BY {order_by}, seq {direction} LIMIT ? OFFSET ?",
+                (*parameters, limit, offset)).fetchall()
+            total = db.execute(f"SELECT COUNT(*) FROM research {where}", parameters).fetchone()[0]
+        return [json.loads(row[0]) for row in rows], total
+
+    def find_by_link(self, link: str, include_archived: bool = False) -> list[dict[str, Any]]:
+        rows = self._connections.get().execute(
+            "SELECT DISTINCT research.record, research.seq FROM research_links "
+            "JOIN research ON research.id = research_links.research_id "
+            "WHERE research_links.link = ? AND (research.archived = 0 OR ?) ORDER BY research.seq",
+            (link, include_archived),
+        ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def _select(self, db: sqlite3.Connection, research_id: str) -> dict[str, Any] | None:
+        row = db.execute("SELECT record FROM research WHERE id = ?", (research_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _insert(self, db: sqlite3.Connection, record: dict[str, Any]) -> None:
+        db.execute(
+            "INSERT INTO research (id, name, created_date, archived, record) VALUES (?, ?, ?, ?, ?)",
+            (record["id"], record["name"], record["created_date"], int(record["archived"]), json.dumps(record)),
+        )
+        self._insert_links(db, record)
+
+    def _insert_links(self, db: sqlite3.Connection, record: dict[str, Any]) -> None:
+        db.executemany("INSERT INTO research_links VALUES (?, ?)",
+                       [(record["id"], link) for link in record["links"]])
@@ -0,0 +1,114 @@
+"""
+Memoization of LLM responses.
+
+Only deterministic requests (temperature 0) are cached.  The key is a hash of everything
+that determines the completion: model, rendered messages, temperature and max tokens.
+Responses are stored zlib-compressed in a SQLite database in the assets folder, entries
+older than the max age are dropped and the least recently used entries are evicted once
+the store grows past its size bound.  Access times of cache hits are kept in memory and
+written in batches, so hits don't write to the database.
+"""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from pathlib import Path
+from typing import Any
+
+logger = logging.getLogger(__name__)
+
+
+class ResponseCache(object):
+    RESPONSE_CACHE_FOLDER = "llm_cache"
+    RESPONSE_CACHE_DB_FILE_NAME = "llm_responses.sqlite3"
+    # max seconds access times of cache hits wait in memory before they are written
+    ACCESS_FLUSH_SECONDS = 30
+
+    def __init__(self, assets_dir: Path):
+        self.LLM_RESPONSE_CACHE_MAX_BYTES = int(float(os.getenv("LLM_RESPONSE_CACHE_MAX_MB", 64)) * 1024 * 1024)
+        self.LLM_RESPONSE_CACHE_MAX_AGE_SECONDS = float(os.getenv("LLM_RESPONSE_CACHE_MAX_AGE_DAYS", 7)) * 86400
+        cache_folder_path = assets_dir.joinpath(self.RESPONSE_CACHE_FOLDER)
+        cache_folder_path.mkdir(parents=True, exist_ok=True)
+        self.db_file_path = cache_folder_path.joinpath(self.RESPONSE_CACHE_DB_FILE_NAME)
+        logger.info(f"LLM response cache path: {self.db_file_path}")
+
+        self._lock = threading.Lock()
+        self._pending_access: dict[str, float] = {}
+        self._access_flushed_at = time.monotonic()
+        self._db = sqlite3.connect(self.db_file_path, check_same_thread=False)
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                response BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS responses_created_at ON responses (created_at);
+            CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access);
+        """)
+
+    @staticmethod
+    def is_cacheable(temprature: float) -> bool:
+        return temprature == 0
+
+    @staticmethod
+    def make_key(model: str, messages: list[dict[str, str]], temprature: float, max_tokens: int) -> str:
+        key_material = json.dumps([model, messages, temprature, max_tokens], separators=(",", ":"))
+        return hashlib.sha256(key_material.encode()).hexdigest()
+
+    def get(self, key: str) -> dict[str, Any] | None:
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT response FROM responses WHERE key = ? AND created_at > ?",
+                (key, now - self.LLM_RESPONSE_CACHE_MAX_AGE_SECONDS),
+            ).fetchone()
+            if not row:
+                return None
+            self._pending_access[key] = now
+            if time.monotonic() - self._access_flushed_at >= self.ACCESS_FLUSH_SECONDS:
+                self._flush_access()
+                self._db.commit()
+        return json.loads(zlib.decompress(row[0]))
+
+    def put(self, key: str, response: dict[str, Any]) -> None:
+        compressed = zlib.compress(json.dumps(response, separators=(",", ":")).encode())
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                (key, compressed, len(compressed), now, now),
+            )
+            self._pending_access.pop(key, None)
+            self._flush_access()
+            self._evict(now)
+            self._db.commit()
+
+    def _flush_access(self) -> None:
+        # eviction picks entries by last access, write the pending access times before it runs
+        if self._pending_access:
+            self._db.executemany("UPDATE responses SET last_access = ? WHERE key = ?",
+                                 [(last_access, key) for key, last_access in self._pending_access.items()])
+            self._pending_access.clear()
+        self._access_flushed_at = time.monotonic()
+
+    def _evict(self, now: float) -> None:
+        self._db.execute("DELETE FROM responses WHERE created_at <= ?",
+                         (now - self.LLM_RESPONSE_CACHE_MAX_AGE_SECONDS,))
+        total_size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total_size <= self.LLM_RESPONSE_CACHE_MAX_BYTES:
+            return
+        # walk the entries from most to least recently used, dropping everything past the size bound
+        kept_size = 0
+        evict_keys = []
+        for key, size in self._db.execute("SELECT key, size FROM responses ORDER BY last_access DESC"):
+            kept_size += size
+            if kept_size > self.LLM_RESPONSE_CACHE_MAX_BYTES:
+                evict_keys.append((key,))
+        self._db.executemany("DELETE FROM responses WHERE key = ?", evict_keys)
+        logger.info(f"Evicted {len(evict_keys)} cached llm responses")
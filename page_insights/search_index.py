@@ -0,0 +1,90 @@
+"""
+Full-text search over the saved research.
+
+Uses an SQLite FTS5 inverted index with BM25 ranking.  The index is persisted next to the
+research files and kept up to date as research is saved or deleted, so startup never
+re-reads the markdown documents.  Each thread searches over its own connection, so searches
+run in parallel with each other and with index updates.
+"""
+import logging
+import re
+import sqlite3
+from pathlib import Path
+
+from page_insights.concurrency import SqliteConnections
+
+logger = logging.getLogger(__name__)
+
+
+class SearchIndex(object):
+
+    # BM25 column weights: research_id and archived (not indexed), name, links, body
+    BM25_WEIGHTS = (0.0, 0.0, 5.0, 2.0, 1.0)
+    QUERY_TERM_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+    def __init__(self, db_file_path: Path):
+        self.db_file_path = db_file_path
+        self._connections = SqliteConnections(db_file_path)
+        db = self._connections.get()
+        db.execute("PRAGMA journal_mode=WAL")
+        db.executescript("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS research_fts USING fts5(
+                research_id UNINDEXED, archived UNINDEXED, name, links, body,
+                tokenize='porter unicode61', prefix='2 3 4'
+            );
+            -- maps research ids to index rowids, so updates and deletes don't scan the index
+            CREATE TABLE IF NOT EXISTS research_fts_ids (
+                fts_rowid INTEGER PRIMARY KEY AUTOINCREMENT,
+                research_id TEXT NOT NULL UNIQUE
+            );
+        """)
+
+    def count(self) -> int:
+        return self._connections.get().execute("SELECT COUNT(*) FROM research_fts").fetchone()[0]
+
+    def index(self, research_id: str, name: str, links: list[str], body: str, archived: bool = False) -> None:
+        with self._connections.transaction() as db:
+            self._delete(db, research_id)
+            fts_rowid = db.execute("INSERT INTO research_fts_ids (research_id) VALUES (?)",
+                                   (research_id,)).lastrowid
+            db.execute("INSERT INTO research_fts (rowid, research_id, archived, name, links, body) "
+                       "VALUES (?, ?, ?, ?, ?, ?)",
+                       (fts_rowid, research_id, int(archived), name, " ".join(links), body))
+
+    def set_archived(self, research_id: str, archived: bool = True) -> None:
+        with self._connections.transaction() as db:
+            db.execute(
+                "UPDATE research_fts SET archived = ? WHERE rowid = "
+                "(SELECT fts_rowid FROM research_fts_ids WHERE research_id = ?)",
+                (int(archived), research_id),
+            )
+
+    def remove(self, research_id: str) -> None:
+        with self._connections.transaction() as db:
+            self._delete(db, research_id)
+
+    def search(self, query: str, limit: int = 20, archived: bool | None = False) -> list[tuple[str, float, str]]:
+        """returns `(research_id, score, snippet)` for the best matches, best first
+
+        All query terms must match, the last one as a prefix so partially typed words match.  Only
+        active research is searched by default, `archived=True` searches the archived and None both.
+        """
+        terms = self.QUERY_TERM_PATTERN.findall(query)
+        if not terms:
+            return []
+        fts_query = " ".join(f'"{term}"' for term in terms) + "*"
+        weights = ", ".join(str(weight) for weight in self.BM25_WEIGHTS)
+        rows = self._connections.get().execute(
+            f"SELECT research_id, bm25(research_fts, {weights}) AS score, "
+            "snippet(research_fts, 4, '**', '**', '...', 16) "
+            "FROM research_fts WHERE research_fts MATCH ? AND (? IS NULL OR archived = ?) ORDER BY score LIMIT ?",
+            (fts_query, archived, archived, limit),
+        ).fetchall()
+        # sqlite's bm25() is negative, lower is better
+        return [(research_id, -score, snippet) for research_id, score, snippet in rows]
+
+    def _delete(self, db: sqlite3.Connection, research_id: str) -> None:
+        row = db.execute("SELECT fts_rowid FROM research_fts_ids WHERE research_id = ?", (research_id,)).fetchone()
+        if row:
+            db.execute("DELETE FROM research_fts WHERE rowid = ?", row)
+            db.execute("DELETE FROM research_fts_ids WHERE fts_rowid = ?", row)
@@ -0,0 +1,296 @@
+"""
+Site crawl mode: finds the pages of a site, so a whole docs site can be analyzed without
+collecting its links by hand.
+
+A crawl starts from a page or a sitemap.xml (sitemap indexes and gzipped sitemaps included) and
+follows the links of every page read to other pages of the same site.  Links wait in a bounded
+frontier, the shallowest (and, from a sitemap, highest priority) first, and are read one at a
+time with a delay between requests to a host, the longer of CRAWL_DELAY_SECONDS and the host's
+robots.txt Crawl-delay.  Links disallowed by robots.txt, marked rel="nofollow", outside the path
+filters or deeper than the max depth are not followed.
+
+    crawler = SiteCrawler(WebpageReader(page_cache), max_pages=50, include_paths=["/docs/*"])
+    for webpage in crawler.crawl("https://example.com/docs/"):
+        ...
+
+crawl() yields every page as soon as it is read, so the caller can analyze it while the crawl
+goes on, see AnalysisPipeline.crawl_and_analyze.
+"""
+import bisect
+import gzip
+import itertools
+import logging
+import os
+import time
+from fnmatch import fnmatchcase
+from html.parser import HTMLParser
+from typing import Any, Iterable, Iterator
+from urllib.parse import urljoin, urlsplit
+from urllib.robotparser import RobotFileParser
+from xml.etree import ElementTree
+
+import httpx
+from trafilatura.downloads import USER_AGENT
+
+from page_insights.dedup import canonical_url
+from page_insights.webpage import Webpage
+from page_insights.webpage_reader import WebpageReader
+
+logger = logging.getLogger(__name__)
+
+# links to these are never pages
+SKIPPED_EXTENSIONS = (".pdf", ".zip", ".gz", ".tar", ".tgz", ".png", ".jpg", ".jpeg", ".gif", ".svg", ".webp", ".ico",
+                      ".css", ".js", ".json", ".xml", ".mp3", ".mp4", ".mov", ".avi", ".woff", ".woff2", ".ttf",
+                      ".exe", ".dmg", ".doc", ".docx", ".xls", ".xlsx", ".ppt", ".pptx")
+
+
+class LinkParser(HTMLParser):
+    """collects the href of the <a> elements of a page, except rel="nofollow" ones, and the <base href>"""
+
+    def __init__(self):
+        super().__init__()
+        self.links: list[str] = []
+        self.base_href: str | None = None
+        self.nofollow = False
+
+    def handle_starttag(self, tag: str, attrs: list[tuple[str, str | None]]) -> None:
+        attributes = dict(attrs)
+        if tag == "a" and attributes.get("href") and "nofollow" not in (attributes.get("rel") or "").lower():
+            self.links.append(attributes["href"])  # type: ignore
+        elif tag == "base" and attributes.get("href") and self.base_href is None:
+            self.base_href = attributes["href"]
+        elif tag == "meta" and (attributes.get("name") or "").lower() == "robots" and \
+                "nofollow" in (attributes.get("content") or "").lower():
+            self.nofollow = True
+
+
+def extract_links(html: bytes, base_url: str) -> list[str]:
+    """the absolute http(s) links of the page, without fragments, in the order they appear"""
+    parser = LinkParser()
+    try:
+        parser.feed(html.decode("utf-8", errors="replace"))
+        parser.close()
+    except Exception as e:
+        logger.warning(f"Could not parse the links of page: {base_url}:  Error: {str(e)}")
+    if parser.nofollow:
+        return []
+    base_url = urljoin(base_url, parser.base_href) if parser.base_href else base_url
+    links = []
+    for href in parser.links:
+        link = urljoin(base_url, href.strip()).split("#", 1)[0]
+        if urlsplit(link).scheme in ("http", "https"):
+            links.append(link)
+    return links
+
+
+def parse_sitemap(content: bytes) -> tuple[list[tuple[str, float]], list[str]]:
+    """the `(page url, priority)` entries of a sitemap, and the urls of the sitemaps listed by a sitemap index"""
+    if content[:2] == b"\x1f\x8b":
+        content = gzip.decompress(content)
+    root = ElementTree.fromstring(content)
+    pages, sitemaps = [], []
+    for entry in root:
+        fields = {child.tag.rsplit("}", 1)[-1]: (child.text or "").strip() for child in entry}
+        if not fields.get("loc"):
+            continue
+        if entry.tag.endswith("sitemap"):
+            sitemaps.append(fields["loc"])
+        else:
+            try:
+                priority = float(fields.get("priority") or 0.5)
+            except ValueError:
+                priority = 0.5
+            pages.append((fields["loc"], priority))
+    return pages, sitemaps
+
+
+class CrawlFrontier(object):
+    """
+    The links waiting to be read, best first: the shallowest, then the highest sitemap priority,
+    then the shortest path, then the first found.  Holds at most `max_size` links, adding to a
+    full frontier drops its worst link.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.dropped = 0
+        # sorted worst first, so the best link pops from the end
+        self._entries: list[tuple[tuple[int, float, int, int], str, int]] = []
+        self._sequence = itertools.count()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def push(self, link: str, depth: int, priority: float = 0.5) -> None:
+        path_segments = len([segment for segment in urlsplit(link).path.split("/") if segment])
+        # the "smaller is better" parts negated, so the best link sorts last
+        key = (-depth, priority, -path_segments, -next(self._sequence))
+        bisect.insort(self._entries, (key, link, depth))
+        if len(self._entries) > self.max_size:
+            del self._entries[0]
+            self.dropped += 1
+
+    def pop(self) -> tuple[str, int]:
+        _, link, depth = self._entries.pop()
+        return link, depth
+
+
+class SiteCrawler(object):
+
+    def __init__(self, webpage_reader: WebpageReader, max_pages: int | None = None, max_depth: int | None = None,
+                 include_paths: Iterable[str] = (), exclude_paths: Iterable[str] = (),
+                 delay_seconds: float | None = None):
+        """
+        :param include_paths: glob patterns of the paths to follow, e.g. "/docs/*", default all paths
+        :param exclude_paths: glob patterns of the paths never to follow
+        """
+        self.webpage_reader = webpage_reader
+        self.CRAWL_MAX_PAGES = int(os.getenv("CRAWL_MAX_PAGES", 100))
+        self.CRAWL_MAX_DEPTH = int(os.getenv("CRAWL_MAX_DEPTH", 3))
+        self.CRAWL_MAX_FRONTIER = int(os.getenv("CRAWL_MAX_FRONTIER", 1000))
+        self.CRAWL_DELAY_SECONDS = float(os.getenv("CRAWL_DELAY_SECONDS", 1.0))
+        self.CRAWL_RESPECT_ROBOTS = os.getenv("CRAWL_RESPECT_ROBOTS", "true").lower() == "true"
+        self.max_pages = max_pages if max_pages is not None else self.CRAWL_MAX_PAGES
+        self.max_depth = max_depth if max_depth is not None else self.CRAWL_MAX_DEPTH
+        self.delay_seconds = delay_seconds if delay_seconds is not None else self.CRAWL_DELAY_SECONDS
+        self.include_paths = list(include_paths)
+        self.exclude_paths = list(exclude_paths)
+        self.stats = {"pages_read": 0, "pages_failed": 0, "links_found": 0, "links_queued": 0,
+                      "links_skipped": 0, "links_dropped": 0, "seconds": 0.0}
+        # host -> robots.txt rules, None when there are none
+        self._robots: dict[str, RobotFileParser | None] = {}
+        # host -> earliest time of the next request
+        self._next_request_time: dict[str, float] = {}
+
+    def crawl(self, seed: str) -> Iterator[Webpage]:
+        """reads the pages of the seed's site, yields each page as soon as it is read
+
+        :param seed: the url of the first page, or of a sitemap (a url ending in .xml or .xml.gz)
+        """
+        start = time.perf_counter()
+        site = self._site(seed)
+        frontier = CrawlFrontier(self.CRAWL_MAX_FRONTIER)
+        seen: set[str] = set()
+        if urlsplit(seed).path.lower().endswith((".xml", ".xml.gz")):
+            for link, priority in self._read_sitemap(seed):
+                self._enqueue(frontier, seen, site, link, 0, priority)
+        else:
+            # the seed is read whatever the path filters, to find the pages they let through
+            seen.add(canonical_url(seed))
+            robots = self._robots_for(seed)
+            if robots and not robots.can_fetch(USER_AGENT, seed):
+                logger.warning(f"robots.txt disallows crawling {seed}")
+            else:
+                frontier.push(seed, 0)
+        logger.info(f"Crawling {site} from {seed}, at most {self.max_pages} pages {self.max_depth} links deep")
+        try:
+            while frontier and self.stats["pages_read"] + self.stats["pages_failed"] < self.max_pages:
+                link, depth = frontier.pop()
+                self._wait_politely(link)
+                webpage, html, base_url = self.webpage_reader.read_with_html(link, keep_html=depth < self.max_depth)
+                if not webpage:
+                    self.stats["pages_failed"] += 1
+                    continue
+                self.stats["pages_read"] += 1
+                if depth < self.max_depth:
+                    links = extract_links(html, base_url)
+                    self.stats["links_found"] += len(links)
+                    for found_link in links:
+                        self._enqueue(frontier, seen, site, found_link, depth + 1)
+                del html
+                self.stats["seconds"] = time.perf_counter() - start
+                yield webpage
+        finally:
+            self.stats["links_dropped"] = frontier.dropped
+            self.stats["seconds"] = time.perf_counter() - start
+        logger.info(f"Crawled {self.stats['pages_read']} pages of {site} in {self.stats['seconds']:.1f}s, "
+                    f"{len(frontier)} links left in the frontier", extra={"metrics": {"event": "crawl", **self.stats}})
+
+    def report(self) -> dict[str, Any]:
+        """the crawl stats, with the pages read per minute"""
+        seconds = self.stats["seconds"]
+        return dict(self.stats, pages_per_minute=self.stats["pages_read"] / seconds * 60 if seconds else 0.0)
+
+    def _enqueue(self, frontier: CrawlFrontier, seen: set[str], site: str, link: str, depth: int,
+                 priority: float = 0.5) -> None:
+        url = canonical_url(link)
+        if url in seen:
+            return
+        seen.add(url)
+        if not self._should_follow(site, link):
+            self.stats["links_skipped"] += 1
+            return
+        self.stats["links_queued"] += 1
+        frontier.push(link, depth, priority)
+
+    def _should_follow(self, site: str, link: str) -> bool:
+        parts = urlsplit(link)
+        path = parts.path or "/"
+        if self._site(link) != site or path.lower().endswith(SKIPPED_EXTENSIONS):
+            return False
+        if self.include_paths and not any(fnmatchcase(path, pattern) for pattern in self.include_paths):
+            return False
+        if any(fnmatchcase(path, pattern) for pattern in self.exclude_paths):
+            return False
+        robots = self._robots_for(link)
+        return robots is None or robots.can_fetch(USER_AGENT, link)
+
+    def _site(self, link: str) -> str:
+        # www. and the scheme don't make another site
+        return urlsplit(canonical_url(link)).netloc
+
+    def _read_sitemap(self, sitemap_url: str) -> list[tuple[str, float]]:
+        """the pages of the sitemap and of the sitemaps it lists, up to the frontier size"""
+        pages: list[tuple[str, float]] = []
+        sitemap_urls, read_sitemaps = [sitemap_url], set()
+        while sitemap_urls and len(pages) < self.CRAWL_MAX_FRONTIER:
+            url = sitemap_urls.pop(0)
+            if url in read_sitemaps:
+                continue
+            read_sitemaps.add(url)
+            self._wait_politely(url)
+            try:
+                sitemap_pages, child_sitemaps = parse_sitemap(self.webpage_reader.fetch(url))
+            except Exception as e:
+                logger.error(f"Could not read the sitemap: {url}:  Error: {str(e)}")
+                continue
+            pages.extend(sitemap_pages)
+            sitemap_urls.extend(child_sitemaps)
+        logger.info(f"Found {len(pages)} pages in {len(read_sitemaps)} sitemaps of {sitemap_url}")
+        return pages[:self.CRAWL_MAX_FRONTIER]
+
+    def _robots_for(self, link: str) -> RobotFileParser | None:
+        if not self.CRAWL_RESPECT_ROBOTS:
+            return None
+        parts = urlsplit(link)
+        host = f"{parts.scheme}://{parts.netloc}"
+        if host not in self._robots:
+            robots_url = f"{host}/robots.txt"
+            self._wait_politely(robots_url)
+            robots: RobotFileParser | None = RobotFileParser(robots_url)
+            try:
+                robots.parse(  # type: ignore
+                    self.webpage_reader.fetch(robots_url).decode("utf-8", errors="replace").splitlines())
+            except httpx.HTTPStatusError as e:
+                # as robots.txt means it: access denied to robots.txt denies everything
+                if e.response.status_code in (401, 403):
+                    robots.disallow_all = True  # type: ignore
+                else:
+                    robots = None
+            except Exception as e:
+                logger.info(f"No robots.txt for {host}: {str(e)}")
+                robots = None
+            self._robots[host] = robots
+        return self._robots[host]
+
+    def _wait_politely(self, link: str) -> None:
+        """waits until the delay since the last request to the link's host has passed"""
+        parts = urlsplit(link)
+        host = parts.netloc
+        robots = self._robots.get(f"{parts.scheme}://{host}")
+        crawl_delay = robots.crawl_delay(USER_AGENT) if robots else None
+        delay = max(self.delay_seconds, float(crawl_delay or 0))
+        wait = self._next_request_time.get(host, 0.0) - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        self._next_request_time[host] = time.monotonic() + delay
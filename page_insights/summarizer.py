@@ -1,9 +1,16 @@
+import json
 import logging
 import re
 import os
-import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Any, Iterator, Mapping
+from page_insights.async_webpage_reader import AsyncWebpageReader
+from page_insights.dedup import DedupSession, FingerprintIndex, simhash
 from page_insights.llm_adapter import LlmAdapter
-from page_insights.prompts_manager import PromptsManager
+from page_insights.metrics import ERRORS, STAGE_SECONDS
+from page_insights.prompts_manager import PromptsManager, PromptTemplate, render_context
+from page_insights.webpage import Webpage
 
 logger = logging.getLogger(__name__)
 
@@ -11,12 +18,33 @@ logger = logging.getLogger(__name__)
 
 class Summarizer(object):
     def __init__(
-        self, prompts_manager: PromptsManager, llm_adapter: LlmAdapter
+        self, prompts_manager: PromptsManager, llm_adapter: LlmAdapter,
+        async_webpage_reader: AsyncWebpageReader | None = None, fingerprint_index: FingerprintIndex | None = None
     ):
         self.prompts_manager = prompts_manager
         self.llm_adapter = llm_adapter
-        self.LLM_API_SECONDS_BETWEEN_REQUESTS = float(os.getenv("LLM_API_SECONDS_BETWEEN_REQUESTS", 10.0))
-        logger.info(f"using llm api seconds between requests: {self.LLM_API_SECONDS_BETWEEN_REQUESTS}")
+        self.async_webpage_reader = async_webpage_reader
+        # the fingerprints of the saved research, near duplicates of its pages reuse their analyses
+        self.fingerprint_index = fingerprint_index
+        self.LLM_API_MAX_CONCURRENT_REQUESTS = int(os.getenv("LLM_API_MAX_CONCURRENT_REQUESTS", 4))
+        logger.info(f"using llm api max concurrent requests: {self.LLM_API_MAX_CONCURRENT_REQUESTS}")
+        # shared by every analysis, so the concurrency limit holds across users.  Long lived, the openai
+        # client's pooled HTTP session of each thread is reused from one analysis to the next
+        self._executor = ThreadPoolExecutor(max_workers=self.LLM_API_MAX_CONCURRENT_REQUESTS,
+                                            thread_name_prefix="summarizer")
+        self.DEDUP_ENABLED = os.getenv("DEDUP_ENABLED", "true").lower() == "true"
+        # the fingerprint index only finds pages up to FingerprintIndex.MAX_DISTANCE bits apart
+        self.DEDUP_MAX_HAMMING_DISTANCE = min(int(os.getenv("DEDUP_MAX_HAMMING_DISTANCE", 4)),
+                                              FingerprintIndex.MAX_DISTANCE)
+        logger.info(f"using dedup enabled: {self.DEDUP_ENABLED}, max hamming distance: "
+                    f"{self.DEDUP_MAX_HAMMING_DISTANCE}")
+
+    def new_dedup_session(self, links: list[str]) -> DedupSession | None:
+        """the duplicate detection for a batch of links analyzed with the same prompt and settings,
+        None when dedup is disabled"""
+        if not self.DEDUP_ENABLED:
+            return None
+        return DedupSession(links, self.fingerprint_index, self.DEDUP_MAX_HAMMING_DISTANCE)
 
     def get_all_summaries(
         self,
@@ -26,52 +54,275 @@ class Summarizer(object):
         summary_words_max_range
     ) -> tuple[str, str]:
         # get the prompt from the PromtsManager
-        prompt_txt = self.prompts_manager.get_prompt(prompt_name)
+        prompt_template = self.prompts_manager.get_prompt_template(prompt_name)
         # for each link, get the llm response
         llm_responses = []
         debug_resp = []
         prompt_replacements = self._populate_prompt_replacements(summary_words_max_range)
-
-        for index, link in enumerate(links):
-            try:
-                llm_resp, debug = self.llm_adapter.get_llm_response(
-                    link, temprature_input, prompt_txt, prompt_replacements
-                )
-                logger.info(f"llm_resp: {llm_resp}")
-                llm_responses.append(llm_resp)
+        dedup_session = self.new_dedup_session(links)
+        page_futures = self.prefetch_pages(links, dedup_session)
+        # Links are analyzed in parallel, the llm adapter's rate limiter keeps the requests
+        # within the RPM/TPM quota.  executor.map returns results in input order, and submits the
+        # links in that order, so a link's duplicates never take the threads ahead of it.
+        results = self._executor.map(
+            lambda link, page_future: self._get_link_summary(
+                link, temprature_input, prompt_name, prompt_template, prompt_replacements,
+                summary_words_max_range, page_future, dedup_session),
+            links, page_futures,
+        )
+        for llm_resp, debug in results:
+            llm_responses.append(llm_resp)
+            if debug:
                 debug_resp.append(debug)
-                # sleep for 30 seconds to avoid rate limiting
-                # openai.error.RateLimitError: Rate limit reached for 10KTPM-200RPM in organization org-5Zo... on
-                #     tokens per min. Limit: 10000 / min. Please try again in 6ms. Contact us through our help center at help.openai.com if you continue to have issues.
-                if index+1 < len(links):  # if not the last link
-                    logger.info(f"sleeping for {self.LLM_API_SECONDS_BETWEEN_REQUESTS} seconds to avoid rate limiting")
-                    time.sleep(self.LLM_API_SECONDS_BETWEEN_REQUESTS)
-            except Exception as e:
-                llm_responses.append(f"ERROR[{link}]: {str(e)}")
-                logger.error(
-                    f"An error occurred in the llm response for link: {link}:  Error: {str(e)}"
-                )
-                continue
+        if dedup_session:
+            debug_resp.append(json.dumps({"dedup": dedup_session.report()}, indent=4))
         # return sumaries as a concatenated string
         return "\n\n".join(llm_responses), "\n\n".join(debug_resp)
 
+    def prefetch_pages(
+        self, links: list[str], dedup_session: DedupSession | None = None
+    ) -> list["Future[Webpage] | None"]:
+        """starts downloading all the pages up front with the async webpage reader, so fetching the next
+        links overlaps with the llm calls for the current ones.  Pass the futures to analyze_link.
+
+        Links duplicating the url of an earlier link reuse its analysis and are never read, their future
+        is None, as are all the futures without an async webpage reader
+        """
+        return [self.async_webpage_reader.submit(link)
+                if self.async_webpage_reader and (not dedup_session or dedup_session.is_url_leader(link))
+                else None for link in links]
+
+    def _get_link_summary(
+        self, link: str, temprature_input, prompt_name: str, prompt_template: PromptTemplate,
+        prompt_replacements: Mapping[str, str], summary_words_max_range, page_future: "Future[Webpage] | None" = None,
+        dedup_session: DedupSession | None = None
+    ) -> tuple[str, str]:
+        try:
+            analysis, debug = self._analyze_link(link, temprature_input, prompt_name, prompt_template,
+                                                 prompt_replacements, summary_words_max_range,
+                                                 page_future=page_future, dedup_session=dedup_session)
+            llm_resp = analysis["summary"]
+            logger.info(f"llm_resp: {llm_resp}")
+        except Exception as e:
+            logger.error(
+                f"An error occurred in the llm response for link: {link}:  Error: {str(e)}"
+            )
+            llm_resp, debug = f"ERROR[{link}]: {str(e)}", ""
+        return llm_resp, debug
+
     def get_summary_for_url(
         self, url: str, temp: float, prompt_name: str, summary_words_max_range
     ) -> tuple[str, str]:
-        prompt_txt = self.prompts_manager.get_prompt(prompt_name)
+        analysis, debug = self.analyze_link(url, temp, prompt_name, summary_words_max_range)
+        return analysis["summary"], debug
+
+    def analyze_link(
+        self, url: str, temp: float, prompt_name: str, summary_words_max_range, webpage: Webpage | None = None,
+        dedup_session: DedupSession | None = None, page_future: "Future[Webpage] | None" = None
+    ) -> tuple[dict[str, Any], str]:
+        """like get_summary_for_url, but returns the summary in an analysis record which also holds the
+        content fingerprint and prompt version needed to refresh the analysis later
+
+        :param webpage: the page, when it has already been read
+        :param page_future: the page being read, see prefetch_pages
+        :param dedup_session: the duplicate detection of the batch the link belongs to (see
+            new_dedup_session).  The analysis of a duplicate is a copy of the analysis it duplicates,
+            with `duplicate_of` and `dedup_distance` set, and its debug output is the dedup decision
+        :return: the analysis record and the debug output
+        """
+        prompt_template = self.prompts_manager.get_prompt_template(prompt_name)
         prompt_replacements = self._populate_prompt_replacements(summary_words_max_range)
-        return self.llm_adapter.get_llm_response(url, temp, prompt_txt, prompt_replacements)
+        return self._analyze_link(url, temp, prompt_name, prompt_template, prompt_replacements,
+                                  summary_words_max_range, webpage=webpage, page_future=page_future,
+                                  dedup_session=dedup_session)
+
+    def _analyze_link(
+        self, url: str, temp: float, prompt_name: str, prompt_template: PromptTemplate,
+        prompt_replacements: Mapping[str, str], summary_words_max_range, webpage: Webpage | None = None,
+        page_future: "Future[Webpage] | None" = None, dedup_session: DedupSession | None = None
+    ) -> tuple[dict[str, Any], str]:
+        # the leader of a group of duplicates resolves its future with its analysis, None if it failed
+        future, leader_link = dedup_session.claim_url(url) if dedup_session else (None, None)
+        if leader_link:
+            leader_analysis = future.result()
+            if leader_analysis:
+                return self._reuse_analysis(url, leader_analysis, dedup_session, DedupSession.URL_DUPLICATE,
+                                            leader_link)
+            # the leader failed, try again as a leader of near duplicates only
+            future = Future()
+        try:
+            with STAGE_SECONDS.time(stage="analysis") as timer:
+                webpage = webpage or self._read_webpage(url, page_future)
+                content_simhash = simhash(webpage.content)
+                reused = self._reuse_near_duplicate(url, webpage, content_simhash, prompt_template, temp,
+                                                    summary_words_max_range, future, dedup_session) \
+                    if dedup_session else None
+                if not reused:
+                    summary, debug = self.llm_adapter.get_llm_response_for_page(
+                        webpage, temp, prompt_template, prompt_replacements)
+        except Exception as e:
+            ERRORS.inc(stage="analysis")
+            self._log_analysis(url, timer.seconds, str(e))
+            if future:
+                future.set_result(None)
+            raise
+        if reused:
+            analysis, debug = reused
+        else:
+            analysis = self._make_analysis(webpage, summary, prompt_name, prompt_template, temp,
+                                           summary_words_max_range, content_simhash)
+            if dedup_session:
+                dedup_session.record(url, DedupSession.UNIQUE)
+        if future:
+            future.set_result(analysis)
+        self._log_analysis(url, timer.seconds, None)
+        return analysis, debug
+
+    def _read_webpage(self, url: str, page_future: "Future[Webpage] | None") -> Webpage:
+        if not page_future:
+            return self.llm_adapter.read_webpage(url)
+        webpage = page_future.result()
+        if not webpage:
+            raise ValueError(f"Could not read the content of page: {url}")
+        return webpage
+
+    def _reuse_near_duplicate(
+        self, url: str, webpage: Webpage, content_simhash: int | None, prompt_template: PromptTemplate, temp: float,
+        summary_words_max_range, future: "Future[dict[str, Any] | None]", dedup_session: DedupSession
+    ) -> tuple[dict[str, Any], str] | None:
+        match = dedup_session.claim_content(url, content_simhash, prompt_template.version, temp,
+                                            summary_words_max_range, future)
+        if not match:
+            return None
+        decision, duplicate, duplicate_link, distance = match
+        # a leader of the batch may still fail, then the page is analyzed on its own
+        duplicate_analysis = duplicate.result() if isinstance(duplicate, Future) else duplicate
+        if not duplicate_analysis:
+            return None
+        return self._reuse_analysis(url, duplicate_analysis, dedup_session, decision, duplicate_link, distance,
+                                    webpage, content_simhash)
+
+    def _reuse_analysis(
+        self, url: str, analysis: dict[str, Any], dedup_session: DedupSession, decision: str, duplicate_link: str,
+        distance: int | None = None, webpage: Webpage | None = None, content_simhash: int | None = None
+    ) -> tuple[dict[str, Any], str]:
+        """the analysis of a duplicate: a copy of the analysis it duplicates, for its own link and page"""
+        reused = dict(analysis, link=url, duplicate_of=duplicate_link, dedup_distance=distance,
+                      verified_date=datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S %z"))
+        if webpage:
+            reused.update(content_fingerprint=webpage.fingerprint(), content_simhash=self._simhash_hex(content_simhash))
+        entry = dedup_session.record(url, decision, duplicate_link, distance)
+        return reused, json.dumps({"dedup": entry}, indent=4)
+
+    def analyze_link_with_prompts(
+        self, url: str, temp: float, prompt_names: list[str], summary_words_max_range
+    ) -> list[tuple[dict[str, Any], str]]:
+        """analyze_link for several prompts: the page is read once and the prompts are applied to it in
+        parallel, within the llm adapter's rate limits
+
+        :return: the analysis record and the debug output per prompt, in the order of the prompts.  The
+            analysis of a prompt that failed has its `error` set (see make_failed_analysis)
+        """
+        if not prompt_names:
+            raise ValueError("Select at least one prompt")
+        # fail fast on a bad prompt or word count range rather than after reading the page
+        for prompt_name in prompt_names:
+            self.prompts_manager.get_prompt_template(prompt_name)
+        self._populate_prompt_replacements(summary_words_max_range)
+        webpage = self.llm_adapter.read_webpage(url)
+
+        def analyze(prompt_name: str) -> tuple[dict[str, Any], str]:
+            try:
+                return self.analyze_link(url, temp, prompt_name, summary_words_max_range, webpage=webpage)
+            except Exception as e:
+                logger.error(f"An error occurred in the analysis of link: {url} with prompt: {prompt_name}:  "
+                             f"Error: {str(e)}")
+                return self.make_failed_analysis(url, str(e), prompt_name, temp, summary_words_max_range), ""
+
+        return list(self._executor.map(analyze, prompt_names))
+
+    def stream_summary_for_url(
+        self, url: str, temp: float, prompt_name: str, summary_words_max_range
+    ) -> Iterator[tuple[str, str, dict[str, Any] | None]]:
+        """yields `(delta, debug, analysis)` tuples as the llm streams its response, see
+        LlmAdapter.stream_llm_response.  The analysis record (see analyze_link) arrives with the final item"""
+        prompt_template = self.prompts_manager.get_prompt_template(prompt_name)
+        prompt_replacements = self._populate_prompt_replacements(summary_words_max_range)
+        summary_parts = []
+        try:
+            with STAGE_SECONDS.time(stage="analysis") as timer:
+                webpage = self.llm_adapter.read_webpage(url)
+                for delta, debug in self.llm_adapter.stream_llm_response_for_page(
+                        webpage, temp, prompt_template, prompt_replacements):
+                    summary_parts.append(delta)
+                    if not debug:
+                        yield delta, debug, None
+        except Exception as e:
+            ERRORS.inc(stage="analysis")
+            self._log_analysis(url, timer.seconds, str(e))
+            raise
+        self._log_analysis(url, timer.seconds, None)
+        yield "", debug, self._make_analysis(webpage, "".join(summary_parts), prompt_name, prompt_template, temp,
+                                             summary_words_max_range)
+
+    def make_failed_analysis(
+        self, link: str, error: str, prompt_name: str, temp: float, summary_words_max_range: str
+    ) -> dict[str, Any]:
+        """the analysis record of a link whose analysis failed, enough to analyze it again when the
+        research is refreshed"""
+        return {
+            "link": link,
+            "summary": None,
+            "error": error,
+            "prompt_name": prompt_name,
+            "prompt_version": None,
+            "temprature": temp,
+            "summary_words_max_range": summary_words_max_range,
+            "content_fingerprint": None,
+            "content_simhash": None,
+            "analyzed_date": None,
+            "verified_date": None,
+        }
+
+    def _make_analysis(
+        self, webpage: Webpage, summary: str, prompt_name: str, prompt_template: PromptTemplate, temp: float,
+        summary_words_max_range: str, content_simhash: int | None = None
+    ) -> dict[str, Any]:
+        now = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S %z")
+        if content_simhash is None:
+            content_simhash = simhash(webpage.content)
+        return {
+            "link": webpage.link,
+            "summary": summary,
+            "error": None,
+            "prompt_name": prompt_name,
+            "prompt_version": prompt_template.version,
+            "temprature": temp,
+            "summary_words_max_range": summary_words_max_range,
+            "content_fingerprint": webpage.fingerprint(),
+            "content_simhash": self._simhash_hex(content_simhash),
+            "analyzed_date": now,
+            "verified_date": now,
+        }
+
+    def _simhash_hex(self, content_simhash: int | None) -> str | None:
+        return f"{content_simhash:016x}" if content_simhash is not None else None
+
+    def _log_analysis(self, url: str, seconds: float, error: str | None) -> None:
+        logger.info(f"Analysis of {url} {'failed' if error else 'completed'} in {seconds:.2f}s", extra={
+            "metrics": {"event": "page_analysis", "url": url, "analysis_seconds": seconds, "error": error}})
     
 
-    def _populate_prompt_replacements(self, summary_words_max_range) -> dict[str, str]:
+    def _populate_prompt_replacements(self, summary_words_max_range) -> Mapping[str, str]:
+        """the request's own read-only placeholder values, shared by its parallel page analyses"""
         # throw exception if summary_words_max_range does not match pattern: '\d+\s*,\s*\d+'
         if not re.search(r"\d+\s*,\s*\d+", summary_words_max_range):
             raise ValueError(f"summary_words_max_range does not match pattern: digit, digit'")
         min, max = self._get_min_max_range(summary_words_max_range)
-        prompt_replacements = PromptsManager.PROMPT_PLACEHOLDERS
-        prompt_replacements[PromptsManager.MIN_RESP_WORD_COUNT_FIELD] = min
-        prompt_replacements[PromptsManager.MAX_RESP_WORD_COUNT_FIELD] = max
-        return prompt_replacements
+        return render_context(PromptsManager.PROMPT_PLACEHOLDERS, **{
+            PromptsManager.MIN_RESP_WORD_COUNT_FIELD: min,
+            PromptsManager.MAX_RESP_WORD_COUNT_FIELD: max,
+        })
 
     def _get_min_max_range(self, summary_words_max_range: str) -> list[str]:
         return [x.strip() for x in summary_words_max_range.split(",")]
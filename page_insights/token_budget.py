@@ -0,0 +1,111 @@
+"""
+Token budgeting for prompts sent to the LLM.
+
+Measures text against the model's context window and splits oversized web page content
+into chunks on heading / paragraph boundaries so each chunk fits a single request.
+"""
+import logging
+import math
+import os
+import re
+
+import tiktoken
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBudget(object):
+
+    # context window sizes, looked up by the longest matching model name prefix
+    MODEL_CONTEXT_WINDOWS: dict[str, int] = {
+        "gpt-3.5-turbo": 4096,
+        "gpt-3.5-turbo-16k": 16384,
+        "gpt-3.5-turbo-1106": 16384,
+        "gpt-4": 8192,
+        "gpt-4-32k": 32768,
+        "gpt-4-1106": 128000,
+        "gpt-4-turbo": 128000,
+    }
+    DEFAULT_CONTEXT_WINDOW = 4096
+    # head room for the chat message framing tokens and tokenizer differences
+    SAFETY_MARGIN_TOKENS = 64
+    # used when the tokenizer is unavailable (e.g. its encoding file can't be downloaded)
+    APPROX_CHARS_PER_TOKEN = 4
+    # markdown headings, or the short unpunctuated lines trafilatura emits for html headings
+    HEADING_PATTERN = re.compile(r"^(#{1,6}\s.*|[^\n]{1,80}(?<![.!?:;,]))$")
+    SENTENCE_END_PATTERN = re.compile(r"(?<=[.!?])\s+")
+
+    def __init__(self, model: str):
+        self.model = model
+        self.context_window = int(os.getenv("OPENAI_LLM_CONTEXT_WINDOW", 0)) or self._lookup_context_window(model)
+        try:
+            self._encoding = tiktoken.encoding_for_model(model)
+        except Exception as e:
+            logger.warning(f"Unable to load tokenizer for {model}, approximating token counts: {str(e)}")
+            self._encoding = None
+        logger.info(f"using context window of {self.context_window} tokens for model: {model}")
+
+    def count_tokens(self, text: str) -> int:
+        if self._encoding is None:
+            return math.ceil(len(text) / self.APPROX_CHARS_PER_TOKEN)
+        return len(self._encoding.encode(text, disallowed_special=()))
+
+    def available_tokens(self, prompt_overhead_tokens: int, resp_max_tokens: int) -> int:
+        """tokens left for page content once the prompt and the response are accounted for"""
+        return self.context_window - prompt_overhead_tokens - resp_max_tokens - self.SAFETY_MARGIN_TOKENS
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        if self._encoding is None:
+            return text[:max_tokens * self.APPROX_CHARS_PER_TOKEN]
+        return self._encoding.decode(self._encoding.encode(text, disallowed_special=())[:max_tokens])
+
+    def split_into_chunks(self, text: str, max_tokens: int) -> list[str]:
+        """splits text into chunks of at most `max_tokens`, preferring heading then paragraph
+        then sentence boundaries"""
+        chunks: list[str] = []
+        current: list[str] = []
+        current_tokens = 0
+        for block in self._split_blocks(text):
+            block_tokens = self.count_tokens(block)
+            if block_tokens > max_tokens:
+                pieces = self._split_oversized_block(block, max_tokens)
+            else:
+                pieces = [(block, block_tokens)]
+            for piece, piece_tokens in pieces:
+                starts_section = bool(self.HEADING_PATTERN.match(piece))
+                # start a new chunk when full, or at a heading once the chunk is reasonably filled
+                if current and (current_tokens + piece_tokens > max_tokens
+                                or (starts_section and current_tokens > max_tokens // 2)):
+                    chunks.append("\n".join(current))
+                    current, current_tokens = [], 0
+                current.append(piece)
+                current_tokens += piece_tokens
+        if current:
+            chunks.append("\n".join(current))
+        return chunks
+
+    def _split_blocks(self, text: str) -> list[str]:
+        # trafilatura emits one paragraph / heading / list item per line
+        return [block for block in text.split("\n") if block.strip()]
+
+    def _split_oversized_block(self, block: str, max_tokens: int) -> list[tuple[str, int]]:
+        pieces: list[tuple[str, int]] = []
+        for sentence in self.SENTENCE_END_PATTERN.split(block):
+            sentence_tokens = self.count_tokens(sentence)
+            if sentence_tokens <= max_tokens:
+                pieces.append((sentence, sentence_tokens))
+                continue
+            # a single run-on "sentence" larger than a chunk, cut it on token boundaries
+            remaining = sentence
+            while remaining:
+                piece = self.truncate(remaining, max_tokens)
+                pieces.append((piece, self.count_tokens(piece)))
+                remaining = remaining[len(piece):]
+        return pieces
+
+    def _lookup_context_window(self, model: str) -> int:
+        matches = [name for name in self.MODEL_CONTEXT_WINDOWS if model.startswith(name)]
+        if not matches:
+            logger.warning(f"Unknown context window for model: {model}, using {self.DEFAULT_CONTEXT_WINDOW}")
+            return self.DEFAULT_CONTEXT_WINDOW
+        return self.MODEL_CONTEXT_WINDOWS[max(matches, key=len)]
@@ -1,6 +1,47 @@
+import hashlib
+import os
+import tempfile
+
+
 class Webpage(object):
-    
-    def __init__(self, content, link):
-        self.content = content
+    """
+    The extracted text content of a web page.  Only the text is kept, never the html, and large
+    texts can be offloaded to a temporary file with `offload()`, so pages waiting to be analyzed
+    don't hold their content in memory.  `truncated` is set when only the start of the page
+    was read.
+    """
+    __slots__ = ("link", "truncated", "content_chars", "_content", "_content_file_path")
+
+    def __init__(self, content: str, link: str, truncated: bool = False):
         self.link = link
-        
\ No newline at end of file
+        self.truncated = truncated
+        self.content_chars = len(content)
+        self._content: str | None = content
+        self._content_file_path: str | None = None
+
+    @property
+    def content(self) -> str:
+        if self._content is not None:
+            return self._content
+        with open(self._content_file_path, encoding="utf-8") as content_file:  # type: ignore
+            return content_file.read()
+
+    def offload(self, folder: str | None = None) -> None:
+        """moves the content to a temporary file, removed again when the Webpage is garbage collected"""
+        if self._content is None:
+            return
+        fd, self._content_file_path = tempfile.mkstemp(prefix="page-insights-page-", suffix=".txt", dir=folder)
+        with os.fdopen(fd, "w", encoding="utf-8") as content_file:
+            content_file.write(self._content)
+        self._content = None
+
+    def fingerprint(self) -> str:
+        """hash of the page's text content, ignoring differences in whitespace"""
+        return hashlib.sha256(" ".join(self.content.split()).encode("utf-8")).hexdigest()
+
+    def __del__(self):
+        if self._content_file_path:
+            try:
+                os.remove(self._content_file_path)
+            except OSError:
+                pass
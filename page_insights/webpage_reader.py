@@ -1,9 +1,14 @@
 from copy import deepcopy
 import logging
+import os
+import httpx
 from trafilatura.settings import DEFAULT_CONFIG
+from trafilatura.downloads import USER_AGENT
+from page_insights.metrics import CACHE_REQUESTS, ERRORS, STAGE_SECONDS
+from page_insights.page_cache import PageCache
 from page_insights.webpage import Webpage
-from trafilatura import fetch_url, extract
-# hack needed to mitigate errro: 'signal only works in main thread of the main interpreter' 
+from trafilatura import extract
+# hack needed to mitigate errro: 'signal only works in main thread of the main interpreter'
 # turns off use of `signals`
 # https://github.com/adbar/trafilatura/issues/202
 my_config = deepcopy(DEFAULT_CONFIG)
@@ -11,31 +16,151 @@ my_config['DEFAULT']['EXTRACTION_TIMEOUT'] = '0'
 
 logger = logging.getLogger(__name__)
 
+# content types text is extracted from, other downloads are aborted as soon as their headers arrive
+HTML_CONTENT_TYPES = ("text/html", "application/xhtml+xml", "application/xml", "text/xml", "text/plain")
+
+
+def extract_text(downloaded: bytes) -> str:
+    """extracts the main text content from downloaded html.  A module level function so it can
+    also run in a process pool"""
+    text_content = extract(downloaded, include_comments=False, config=my_config)
+    if text_content is None:
+        raise ValueError("No text content could be extracted from the page")
+    return text_content
+
+
+def check_content_type(url: str, headers: httpx.Headers) -> None:
+    content_type = headers.get("content-type", "").split(";")[0].strip().lower()
+    if content_type and content_type not in HTML_CONTENT_TYPES:
+        raise ValueError(f"Not an HTML page ({content_type}): {url}")
+
+
+def append_capped(buffer: bytearray, chunk: bytes, max_bytes: int) -> bool:
+    """appends the chunk to the download without growing it past `max_bytes`, returns whether it had to be cut"""
+    cut = len(buffer) + len(chunk) > max_bytes
+    buffer += chunk[:max_bytes - len(buffer)]
+    return cut
+
+
+def make_webpage(text_content: str, url: str, truncated: bool, max_text_chars: int, offload_min_chars: int) -> Webpage:
+    if max_text_chars and len(text_content) > max_text_chars:
+        logger.warning(f"Page text of {len(text_content)} characters truncated to {max_text_chars}: {url}")
+        text_content = text_content[:max_text_chars]
+        truncated = True
+    webpage = Webpage(text_content, url, truncated)
+    if offload_min_chars and webpage.content_chars >= offload_min_chars:
+        webpage.offload()
+    return webpage
+
+
+def log_page_read(url: str, fetch_seconds: float, extract_seconds: float, html_bytes: int, text_chars: int) -> None:
+    logger.info(f"Read page in {fetch_seconds:.3f}s, extracted text in {extract_seconds:.3f}s: {url}", extra={
+        "metrics": {"event": "page_read", "url": url, "fetch_seconds": fetch_seconds,
+                    "extract_seconds": extract_seconds, "html_bytes": html_bytes, "text_chars": text_chars}})
+
 
 class WebpageReader:
     """
-    The PageReader class is responsible for reading the content of a list of URLs and returning a list of dictionaries
-    containing the page content and link for each URL. It uses the SeleniumURLLoader class to load the web pages and
-    extract their content.
+    The WebpageReader class is responsible for reading the content of a URL and returning a Webpage
+    containing the extracted text content and link.  Pages are downloaded over a pooled HTTP client
+    and, when a PageCache is supplied, served from the cache or revalidated with conditional requests.
+    Downloads are streamed and capped at PAGE_MAX_DOWNLOAD_MB, so a huge page costs a bounded
+    amount of memory, and only the extracted text outlives the read.
     """
 
-    @classmethod
-    def read(cls, url: str) -> Webpage:
+    FETCH_TIMEOUT_SECONDS = 30.0
+
+    def __init__(self, page_cache: PageCache | None = None):
+        self.page_cache = page_cache
+        self.PAGE_MAX_DOWNLOAD_BYTES = int(float(os.getenv("PAGE_MAX_DOWNLOAD_MB", 10)) * 1024 * 1024)
+        self.PAGE_MAX_TEXT_CHARS = int(os.getenv("PAGE_MAX_TEXT_CHARS", 0))
+        self.PAGE_OFFLOAD_MIN_CHARS = int(os.getenv("PAGE_OFFLOAD_MIN_CHARS", 0))
+        self._http_client = httpx.Client(
+            follow_redirects=True,
+            timeout=self.FETCH_TIMEOUT_SECONDS,
+            headers={"User-Agent": USER_AGENT},
+        )
+
+    def read(self, url: str) -> Webpage:
         """extracts the text content of a web page
 
         :param url: url of the web page
         :return: Webpage object
         """
+        webpage, _, _ = self.read_with_html(url, keep_html=False)
+        return webpage  # type: ignore
+
+    def read_with_html(self, url: str, keep_html: bool = True) -> tuple[Webpage | None, bytes, str]:
+        """like read, but also returns the html of the page and the url its relative links resolve
+        against (the url after redirects), e.g. to discover links while crawling
+
+        :return: the Webpage (None if it could not be read), the html and the base url
+        """
         try:
             logger.info(f"Reading content for page: {url}")
-            downloaded = fetch_url(url)
-            text_content = extract(downloaded, include_comments=False, config=my_config)
+            text_content, truncated, html, base_url = self._read_text(url, keep_html)
         except Exception as e:
+            ERRORS.inc(stage="read")
             logger.error(f"An error occurred: {str(e)}")
-            return None # type: ignore
-        else:
-            return Webpage(text_content, url)
+            return None, b"", url
+        webpage = make_webpage(text_content, url, truncated, self.PAGE_MAX_TEXT_CHARS, self.PAGE_OFFLOAD_MIN_CHARS)
+        return webpage, html, base_url
+
+    def fetch(self, url: str) -> bytes:
+        """downloads a resource of any content type, capped at PAGE_MAX_DOWNLOAD_MB, e.g. a sitemap or robots.txt"""
+        _, body, _ = self._fetch(url, check_type=False)
+        return body
+
+    def _read_text(self, url: str, keep_html: bool = False) -> tuple[str, bool, bytes, str]:
+        """returns the text content of the page, whether the download was truncated, and with
+        `keep_html` its html and the url after redirects"""
+        cached = self.page_cache.get(url) if self.page_cache else None
+        if cached and self.page_cache.is_fresh(cached):  # type: ignore
+            CACHE_REQUESTS.inc(cache="page", result="hit")
+            logger.info(f"Page cache hit: {url}")
+            return cached.text, False, cached.html if keep_html else b"", url
+
+        with STAGE_SECONDS.time(stage="fetch") as fetch_timer:
+            response, html, truncated = self._fetch(url, PageCache.conditional_headers(cached))
+        if cached and response.status_code == httpx.codes.NOT_MODIFIED:
+            CACHE_REQUESTS.inc(cache="page", result="revalidated")
+            logger.info(f"Page not modified since last fetch: {url}")
+            self.page_cache.mark_revalidated(url, response.headers.get("etag"),  # type: ignore
+                                             response.headers.get("last-modified"))
+            return cached.text, False, cached.html if keep_html else b"", url
+
+        with STAGE_SECONDS.time(stage="extract") as extract_timer:
+            text_content = extract_text(html)
+        html_bytes = len(html)
+        # a truncated download is not cached, the cache would serve it as the whole page
+        if self.page_cache and not truncated:
+            CACHE_REQUESTS.inc(cache="page", result="miss")
+            self.page_cache.put(url, html, text_content, response.headers.get("etag"),
+                                response.headers.get("last-modified"))
+        if not keep_html:
+            html = b""
+        log_page_read(url, fetch_timer.seconds, extract_timer.seconds, html_bytes, len(text_content))
+        return text_content, truncated, html, str(response.url)
+
+    def _fetch(self, url: str, headers: dict[str, str] | None = None,
+               check_type: bool = True) -> tuple[httpx.Response, bytes, bool]:
+        """streams the page, returns the response, its body and whether the body was cut at PAGE_MAX_DOWNLOAD_BYTES"""
+        with self._http_client.stream("GET", url, headers=headers) as response:
+            if response.status_code == httpx.codes.NOT_MODIFIED:
+                return response, b"", False
+            response.raise_for_status()
+            if check_type:
+                check_content_type(url, response.headers)
+            buffer = bytearray()
+            truncated = False
+            for chunk in response.iter_bytes():
+                if append_capped(buffer, chunk, self.PAGE_MAX_DOWNLOAD_BYTES):
+                    truncated = True
+                    logger.warning(f"Page larger than {self.PAGE_MAX_DOWNLOAD_BYTES} bytes, "
+                                   f"reading only the start of it: {url}")
+                    break
+        return response, bytes(buffer), truncated
 
 if __name__ == "__main__":
-    page = WebpageReader.read('https://github.com/srush/MiniChain')
-    print(page.content)
\ No newline at end of file
+    page = WebpageReader().read('https://github.com/srush/MiniChain')
+    print(page.content)